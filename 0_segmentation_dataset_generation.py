@@ -1,22 +1,28 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import rasterio.merge
 import shapely
 import shapely.geometry
 import shapely.ops
-import random
 import os
 import time
-import skimage
-import cv2
 import requests
-import urllib.request
 from argparse import ArgumentParser
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from utils import get_bbox, global_to_local_coords, check_if_inside_bbox, replace_at_bbox_borders
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from planet import PlanetClient
+from preprocessing import GROUND_TRUTH_PATH, GROUND_TRUTH_DEMO_PATH, load_ground_truth
+from downloads import TileDownloader
+from jobs import ChipPolygons, compile_chip_jobs, window_jobs
+from chips import init_worker, estimate_memory, estimate_read_memory, save_chip_set_with_usage
+from chipstore import CHIP_FORMATS, PngChipWriter, ShardedChipWriter
+from scheduler import MemoryBudget, longest_first
+from manifest import RunManifest
+from tilecache import CACHE_POLICIES, TileCache
+from splits import SPLITS
+from quads import NICFI_URLS, QuadCatalog, QuadGrid, CloudfreeIndex, parallel_process_tile, parallel_resolve_quads
 
 '''
 This script generates image datasets for training and inference of segmentation models.
@@ -66,541 +72,388 @@ Note: The ann_dir is only required for 2019, as the model was trained on this ye
 pd.options.mode.chained_assignment = None
 
 parser = ArgumentParser()
-parser.add_argument('-y', '--year', required=True, type=str, help="Year to process.")
+parser.add_argument('-y', '--year', required=False, default=None, type=str, help="Year to process.")
+parser.add_argument('--years', required=False, default=None, type=str, help="Years to process by a single run, e.g. 2016-2024 or 2016,2019,2024.")
 parser.add_argument('-d', '--demo', required=False, default=False, type=bool, help="Set this flag to run the script in demo mode.")
+parser.add_argument('-a', '--api_search', required=False, default=False, type=bool, help="Set this flag to search the quads of every polygon via the Planet API instead of calculating them on the NICFI quad grid.")
+parser.add_argument('-r', '--rate_limit', required=False, default=5, type=float, help="Maximum number of Planet API requests per second.")
+parser.add_argument('-w', '--api_workers', required=False, default=8, type=int, help="Number of concurrent Planet API requests.")
+parser.add_argument('--http_archive', required=False, default=None, type=str, help="Path of an archive, e.g. ./data/segmentation/planet_archive.sqlite, which Planet API responses are recorded to and replayed from by reruns.")
+parser.add_argument('--offline', required=False, default=False, type=bool, help="Set this flag to only use the responses recorded in --http_archive, and fail on requests missing from it instead of sending them.")
+parser.add_argument('--download_workers', required=False, default=4, type=int, help="Number of concurrent tile downloads.")
+parser.add_argument('-p', '--process_pool', required=False, default=False, type=bool, help="Set this flag to save chips using worker processes instead of worker threads.")
+parser.add_argument('-c', '--chip_workers', required=False, default=4, type=int, help="Number of worker threads or processes saving chips, shared by all years.")
+parser.add_argument('-v', '--verify', required=False, default=False, type=bool, help="Set this flag to verify the checksums of chips saved by previous runs before skipping them.")
+parser.add_argument('-f', '--chip_format', required=False, default='png', choices=CHIP_FORMATS, type=str, help="Output format of the chips, either separate .png files, or shards which can be read by gpkg_dataset_generation.py using --chip_format='shards'.")
+parser.add_argument('--tile_cache', required=False, default=None, type=float, help="Maximum size in GB of the downloaded quads of all years, which are deleted once it is exceeded.")
+parser.add_argument('--cache_policy', required=False, default='lfu', choices=CACHE_POLICIES, type=str, help="Order in which quads without remaining use are deleted from the tile cache, least frequently (lfu) or least recently (lru) used first.")
+parser.add_argument('--cog', required=False, default=False, type=bool, help="Set this flag to convert downloaded quads to Cloud-Optimized GeoTIFFs with overviews, which makes reading chips of large bboxes faster.")
+parser.add_argument('--mask_supersampling', required=False, default=1, type=int, help="Factor the segmentation masks are rasterized larger by before scaling them down to 512x512, so partly covered pixels are set if most of their area is covered.")
+parser.add_argument('--native_windows', required=False, default=False, type=bool, help="Set this flag to split bboxes larger than 512x512 into overlapping 512x512 windows at native resolution, instead of scaling them down to a single chip.")
+parser.add_argument('-m', '--memory_budget', required=False, default=8, type=float, help="Maximum estimated memory in GB used by chips which are saved at the same time.")
 
 # Eight options for year, from '2016' up to '2024'
 # If one wants to include data of more recent years, the corresponding Planet parameter needs to be added to the nicfi_urls dict below
 
 args = parser.parse_args()
-year = args.year
-demo = args.demo
+assert (args.year is None) != (args.years is None), "Either --year or --years needs to be set."
+
+
+def parse_years(years:str) -> list:
+    """
+    Parses a range of years like 2016-2024, or a comma separated list of years like 2016,2019,2024, into a list of years.
+    """
+
+    if '-' in years:
+        first, last = years.split('-')
+        return [str(year) for year in range(int(first), int(last) + 1)]
+    return [year.strip() for year in years.split(',')]
+
 
+# all years share the preprocessed polygons, the Planet client and the workers
+years = [args.year] if args.year is not None else parse_years(args.years)
+demo = args.demo
+api_search = args.api_search
+rate_limit = args.rate_limit
+api_workers = args.api_workers
+http_archive = args.http_archive
+offline = args.offline
+download_workers = args.download_workers
+process_pool = args.process_pool
+chip_workers = args.chip_workers
+memory_budget = args.memory_budget
+verify = args.verify
+chip_format = args.chip_format
+tile_cache = args.tile_cache
+cache_policy = args.cache_policy
+cog = args.cog
+mask_supersampling = args.mask_supersampling
+native_windows = args.native_windows
+
+# the ground truth dataset is preprocessed once, and afterwards read from the cache by all stages and years
 if demo:
     print("Running in demo mode.")
-    gdf = gpd.read_file("./data/segmentation/mining_polygons_combined_demo.gpkg")
+    gdf = load_ground_truth(GROUND_TRUTH_DEMO_PATH)
     
 else:
     print("Running in regular mode.")
-    gdf = gpd.read_file("./data/segmentation/mining_polygons_combined.gpkg")
-
-# Reading the union of two datasets
-'''
-We are using the union since they intersect a lot
-Maus, Victor, et al. "An update on global mining land use." Scientific data 9.1 (2022): 1-11.
-https://www.nature.com/articles/s41597-022-01547-4.
-Tang, Liang, and Tim T. Werner. "Global mining footprint mapped from high-resolution satellite imagery." Communications Earth & Environment 4.1 (2023): 134.
-https://www.nature.com/articles/s43247-023-00805-6
-'''
-
-countries = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
-# Loading a country code dataset
-# Will be deprecated sometime in the future
-
-assert (type(gdf) == gpd.geodataframe.GeoDataFrame), "gdf is not a GeoDataFrame."
-a = gdf['geometry'].apply(lambda x: x.intersects(countries.geometry))
-gdf['ISO3_CODE'] = (a * countries['iso_a3']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
-gdf['COUNTRY_NAME'] = (a * countries['name']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
-# Checking in which country the individual polygons are located
-gdf['AREA'] = gdf.geometry.area
-gdf['id'] = gdf.index
-
-gdf['bbox'] = None # bbox of polygon as shapely polygon object
-gdf['tile_ids'] = [np.array([], dtype=object, ndmin=1) for i in gdf.index] # id of tiles on which the polygon is located
-gdf['tile_urls'] = [np.array([], dtype=object, ndmin=1) for i in gdf.index] # url of tiles on which the polygon is located
-gdf['tile_bboxes'] = None #bboxes of tiles on which the polygon is located
-gdf['x_poly'] = None #x coordinates of polygon inside tile coordinate system
-gdf['y_poly'] = None #y coordinates of polygon inside tile coordinate system
-gdf['x_bbox'] = None #x coordinates of polygon bbox inside tile coordinate system
-gdf['y_bbox'] = None #y coordinates of polygon bbox inside tile coordinate system
-
-gdf.reset_index(drop=True, inplace=True)
+    gdf = load_ground_truth(GROUND_TRUTH_PATH)
 
+gdf['tile_ids'] = [np.array([], dtype=object, ndmin=1) for i in gdf.index] # id of tiles on which the polygon is located, their urls and bboxes are stored once per tile in the quad catalog
 
-iso_non_nicfi = ['USA', 'CHN', 'RUS', 'CAN', 'AUS', 'SAU', 'MRT', 'DZA', 'LBA', 'EGY', 'OMN', 'YEM', 'NCL', 'MAR', 'ESH', 'LBY', 'TUN', 'JOR', 'ISR', 'PSE', 'SYR', 'LBN', 'IRQ', 'KWT', 'IRN', 'AFG', 'PAK', 'URY', 'TWN', 'KOR', 'PRK', 'JPN', 'ARE', 'QAT', 'PRI']
-nicfi_bbox = gpd.GeoDataFrame(index=[0], crs=4326, geometry=[shapely.Polygon([(-180, 30), (180, 30), (180, -30), (-180, -30), (-180, 30)])])
+# offline runs do not need an API key, since they do not send any request
+PLANET_API_KEY = os.environ.get('API_KEY', '') if offline else os.environ['API_KEY']
+assert (type(PLANET_API_KEY) == str), "API_KEY is not a string."
+# setup Planet base URL, which can be pointed to a local server for testing
+API_URL = os.environ.get('API_URL', "https://api.planet.com/basemaps/v1/mosaics")
+# setup a rate limited client, which is shared by all threads and years
+client = PlanetClient(PLANET_API_KEY, rate=rate_limit, max_workers=api_workers, archive=http_archive, offline=offline)
+# authenticate
+print('Please note that, as things currently stand, the Planet NICFI program is scheduled to be discontinued on January 23, 2025.')
+print('So authentication with your Planet API key may fail, and the script may therefore not work as intended. \n')
 
-in_nicfi = gdf.intersects(nicfi_bbox.geometry[0])
-gdf = gdf[in_nicfi]
+for year in years:
+    assert (year in NICFI_URLS), "No NICFI mosaic known for {}.".format(year)
 
-nicfi_subset = [False if iso in iso_non_nicfi else True for iso in gdf['ISO3_CODE']]
-gdf = gdf[nicfi_subset]
+# quad searches are cached on disk, so reruns and the gpkg dataset generation do not need to query Planet again
+catalog = QuadCatalog('./data/segmentation/quad_catalog.sqlite')
+# an index of the cloudfree quads/tiles for the ground truth dataset used in our study, which is compiled once and shared by all years
+cloudfree = CloudfreeIndex('./data/segmentation/cloudfree_quads_info.csv')
 
-# This is the centroid of a really large and really badly delineated polygon contained in the ground truth dataset
-# We will remove this polygon from the dataset
-bad_centroid = shapely.geometry.Point(-2.02629645, 5.8978455)
-gdf = gdf[~gdf.geometry.contains(bad_centroid)]
 
-gdf.reset_index(drop=True, inplace=True)
+# the bboxes of all polygons are read with the preprocessed ground truth dataset, and are the same for all years
+if not api_search:
+    # NICFI quads lie on a fixed grid, which is the same for all years,
+    # so the quads of all polygons can be calculated locally at once
+    grid = QuadGrid()
+    grid_tile_ids = grid.quads_for_bounds(shapely.bounds(gdf['bbox'].to_numpy()))
+    required_quads = pd.Index(np.unique(np.concatenate(grid_tile_ids)))
 
-PLANET_API_KEY = os.environ['API_KEY']
-assert (type(PLANET_API_KEY) == str), "API_KEY is not a string."
-# setup Planet base URL
-API_URL = "https://api.planet.com/basemaps/v1/mosaics"
-# setup session
-session = requests.Session()
-# authenticate
-print('Please note that, as things currently stand, the Planet NICFI program is scheduled to be discontinued on January 23, 2025.')
-print('So authentication with your Planet API key may fail, and the script may therefore not work as intended. \n')
-session.auth = (PLANET_API_KEY, "")
 
-print()
-print('Processing', year)
-
-# This is the dict in which one needs to add the corresponding Planet parameters if one wants to include more recent data
-NICFI_URLS = {'2016':'planet_medres_normalized_analytic_2016-06_2016-11_mosaic',
-              '2017':'planet_medres_normalized_analytic_2017-06_2017-11_mosaic',
-              '2018':'planet_medres_normalized_analytic_2018-06_2018-11_mosaic',
-              '2019':'planet_medres_normalized_analytic_2019-06_2019-11_mosaic',
-              '2020':'planet_medres_normalized_analytic_2020-06_2020-08_mosaic',
-              '2021':'planet_medres_normalized_analytic_2021-11_mosaic',
-              '2022':'planet_medres_normalized_analytic_2022-11_mosaic',
-              '2023':'planet_medres_normalized_analytic_2023-11_mosaic',
-              '2024':'planet_medres_normalized_analytic_2024-11_mosaic'}
-
-# set params for search using name of primary mosaic
-parameters = {"name__is" : NICFI_URLS[year]}
-# make get request to access mosaic from basemaps API
-res = session.get(API_URL, params = parameters)
-mosaic = res.json()
-
-# get id
-MOSAIC_ID = mosaic['mosaics'][0]['id']
-
-
-def process_tile(j:int, gdf:gpd.geodataframe.GeoDataFrame, session:requests.Session):
+def find_tiles(gdf:gpd.geodataframe.GeoDataFrame, year:str) -> (gpd.geodataframe.GeoDataFrame, pd.DataFrame):
     """
-    Processes a single tile by retrieving its bounding box, searching for mosaic tiles 
-    using the area of interest (AOI), and extracting required tile URLs, IDs, and bounding boxes.
+    Finds the tiles of all polygons in the mosaic of a year, and replaces their download links by the ones of cloudfree tiles.
+    Returns a copy of the GeoDataFrame containing only the polygons located on at least one tile, with their tile IDs stored in 'tile_ids',
+    and a DataFrame of all quads of the mosaic.
 
     Parameters
     -------------
 
-    j: The index of the tile in the GeoDataFrame.
-    type: int
-    values: Positive integers corresponding to the row index in the GeoDataFrame.
-    default: No default value.
-
-    gdf: A GeoDataFrame.
+    gdf: A GeoDataFrame containing the bboxes of all polygons.
     type: geopandas.geodataframe.GeoDataFrame
     values: A valid GeoDataFrame.
     default: No default value.
 
-    session: The session object for making API requests.
-    type: requests.sessions.Session
-    values: A valid `Session` instance from the `requests` library.
+    year: The year of the mosaic.
+    type: str
+    values: A key of NICFI_URLS.
     default: No default value.
 
     Example
     -------------
 
-    process_tile(0, gdf, session)
+    gdf_2019, quads_2019 = find_tiles(gdf, '2019')
     """
 
-    try:
-        if gdf['tile_urls'][j].size == 0:
-            # Getting bboxes of all polygons
-            random.seed(int(gdf['id'][j]))
-            gdf['bbox'][j] = get_bbox(gdf['geometry'][j])
-
-            # Converting bbox to string for search params
-            bbox_for_request = list(gdf['bbox'][j].bounds)
-            string_bbox = ','.join(map(str, bbox_for_request))
-
-            # Search for mosaic tile using AOI
-            search_parameters = {
-                'bbox': string_bbox,
-                'minimal': False
-            }
-
-            # Accessing tiles using metadata from mosaic
-            quads_url = "{}/{}/quads".format(API_URL, MOSAIC_ID)
-
-            # Retry logic with exponential backoff
-            max_retries = 10
-            backoff_factor = 0.01  # Start with 10 milliseconds
-            for attempt in range(max_retries):
-                try:
-                    res = session.get(quads_url, params=search_parameters, stream=True)
-                    quads = res.json()
-                    break  # Exit the loop if the request is successful
-
-                except json.JSONDecodeError as e:
-                    print(f"Caught error when reading JSON response from Planet on attempt {attempt + 1}: {e}")
-                    print('Response:', res.content)
-                    time.sleep(backoff_factor)
-                    backoff_factor *= 2  # Exponential backoff
-
-                except requests.exceptions.RequestException as e:
-                    print(f"Request failed on attempt {attempt + 1}: {e}")
-                    time.sleep(backoff_factor)
-                    backoff_factor *= 2  # Exponential backoff
-                    
-            else:
-                print("Max retries reached. Exiting.")
-                return  # Exit the function if max retries are reached
-
-            items = quads['items']
-
-            # Getting all required tile IDs and URLs
-            urls = np.array([], dtype=object)
-            ids = np.array([], dtype=object)
-            bboxes = []
-
-            for item in items:
-                if 'download' in item['_links'].keys():
-                    urls = np.append(urls, item['_links']['download'])
-                    ids = np.append(ids, item['id'])
-                bboxes.append(item['bbox'])
-
-            gdf['tile_urls'][j] = urls
-            gdf['tile_ids'][j] = ids
-            gdf['tile_bboxes'][j] = bboxes
-
-    except json.JSONDecodeError as e:
-        print('Caught error when reading JSON response from Planet', e)
-        print('Response', res.content)
-        pass
-        
-    except requests.exceptions.RequestException as e:
-        print('Request failed', e)
-        pass
-
-
-def parallel_process_tile(gdf:gpd.geodataframe.GeoDataFrame, session:requests.Session):
+    print()
+    print('Processing', year)
+
+    # set params for search using name of primary mosaic
+    parameters = {"name__is" : NICFI_URLS[year]}
+    # make get request to access mosaic from basemaps API
+    mosaic = client.get_json(API_URL, params = parameters)
+
+    # get id
+    mosaic_id = mosaic['mosaics'][0]['id']
+
+    print('requesting tiles')
+    gdf = gdf.copy()
+
+    if api_search:
+        parallel_process_tile(gdf, mosaic_id, API_URL, client, catalog)
+
+    else:
+        # only the download links of quads which are not in the catalog yet need to be requested
+        gdf['tile_ids'] = grid_tile_ids
+        missing_quads = required_quads.difference(catalog.quads_frame(mosaic_id).index)
+        print('requesting {} out of {} quads'.format(str(len(missing_quads)), str(len(required_quads))))
+        parallel_resolve_quads(missing_quads, mosaic_id, API_URL, client, catalog)
+
+    # one record per quad, holding its bbox and download link
+    quads = catalog.quads_frame(mosaic_id)
+    if not api_search:
+        # making sure the calculated quads match the ones returned by Planet
+        mismatches = grid.validate(quads[quads.index.isin(required_quads)])
+        if len(mismatches) > 0:
+            print('Calculated bboxes do not match the Planet API for {} quads, consider setting --api_search.'.format(str(len(mismatches))))
+        # quads which could not be requested are not used
+        gdf['tile_ids'] = gdf['tile_ids'].apply(lambda ids: ids[np.isin(ids, quads.index)])
+    # only quads which can be downloaded are used for the mosaics
+    gdf['tile_ids'] = gdf['tile_ids'].apply(lambda ids: np.array([id for id in ids if pd.notna(quads.at[id, 'link'])], dtype=object))
+
+
+    # Planet does not cover a great amount of polygons
+    no_tiles_found = [False if tile_id.size == 0 else True for tile_id in gdf['tile_ids']]
+    print('no tiles found for {} out of {} polygons'.format(str(no_tiles_found.count(False)), str(len(gdf))))
+    gdf = gdf[no_tiles_found]
+    gdf.reset_index(drop=True, inplace=True)
+
+
+    print('checking for cloudfree tiles')
+    # since urls are stored once per quad, every quad only needs to be replaced once, regardless of how many polygons are located on it
+    used_quads = pd.Index(np.unique(np.concatenate(gdf['tile_ids'].to_list())))
+    cloudfree_links = cloudfree.links(year, used_quads)
+    has_cloudfree = cloudfree_links.notna().to_numpy()
+    for tile_id in used_quads[~has_cloudfree]:
+        # Print a message if no cloudfree tile is found
+        print('No cloudfree replacement found for tile', tile_id, 'therefore leaving it as is.')
+    # Get the cloudfree quad URL and append the API key
+    quads.loc[used_quads[has_cloudfree], 'link'] = cloudfree_links[has_cloudfree].values + PLANET_API_KEY
+
+    return gdf, quads
+
+
+def split_sets(gdf:gpd.geodataframe.GeoDataFrame) -> dict:
     """
-    Processes tiles in parallel by delegating each tile's processing to worker threads.
+    Splits the polygons of a year into a 0.89 train and 0.1 val split, and a hand validated 0.01 test set of 200 samples.
+    The splits are assigned once by the preprocessing from a hash of the polygon ids, so every polygon is in the same split in every year and run.
+    Returns a dict of set type to GeoDataFrame, which only contains 'test' if any hand validated polygon is located on a tile.
 
     Parameters
     -------------
 
-    gdf: A GeoDataFrame.
+    gdf: A GeoDataFrame of the polygons of a year, including their 'split'.
     type: geopandas.geodataframe.GeoDataFrame
     values: A valid GeoDataFrame.
     default: No default value.
 
-    session: The session object for making API requests.
-    type: requests.sessions.Session
-    values: A valid `Session` instance from the `requests` library.
-    default: No default value.
-
     Example
     -------------
 
-    parallel_process_tile(gdf, session)
+    sets = split_sets(gdf_2019)
     """
-    # Planet API requests are rate limited, so using only one worker is highly recommended
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        futures = [
-            executor.submit(process_tile, j, gdf, session)
-            for j in range(len(gdf))
-        ]
-
-        for future in as_completed(futures):
-            future.result()
-
 
-print('requesting tiles')
-parallel_process_tile(gdf, session)
+    sets = {}
+    for set_type in SPLITS:
+        gdf_set = gdf[gdf['split'].to_numpy() == set_type].copy()
+        gdf_set.reset_index(drop=True, inplace=True)
+        sets[set_type] = gdf_set
 
+    if len(sets['test']) > 0:
+        print('Train set size:', len(sets['train']), 'Test set size:', len(sets['test']), 'Validation set size:', len(sets['val']))
+    else:
+        del sets['test']
+        print('Train set size:', len(sets['train']), 'Validation set size:', len(sets['val']))
 
-# Planet does not cover a great amount of polygons
-no_tiles_found = [False if tile_id.size == 0 else True for tile_id in gdf['tile_ids']]
-print('no tiles found for {} out of {} polygons'.format(str(no_tiles_found.count(False)), str(len(gdf))))
-gdf = gdf[no_tiles_found]
-gdf.reset_index(drop=True, inplace=True)
+    return sets
 
 
-# calculating each polygons position on their own tile/mosaic, we will need those later one by one
-for i in range(len(gdf)):
-    gdf['x_poly'][i], gdf['y_poly'][i] = global_to_local_coords(gdf['geometry'][i], gdf['tile_bboxes'][i])
-    gdf['x_bbox'][i], gdf['y_bbox'][i] = global_to_local_coords(gdf['bbox'][i], gdf['tile_bboxes'][i], is_bbox=True)
-
-
-def process_cloudfree(j:int, gdf:gpd.geodataframe.GeoDataFrame, cloudfree_quads_this_year:pd.DataFrame):
-    """
-    Processes cloudfree tiles by updating the tile URLs in the GeoDataFrame based on the availability of cloudfree quads.
-    Parameters
-    -------------
-    j : int
-        The index of the tile in the GeoDataFrame.
-    gdf : geopandas.geodataframe.GeoDataFrame
-        A GeoDataFrame containing tile information, including tile IDs and URLs.
-    Example
-    -------------
-    process_cloudfree(0, gdf)
+def download_tiles(tile_ids:tuple, downloader:TileDownloader, quads:pd.DataFrame) -> list:
     """
-    # Extract tile IDs and URLs for the given index
-    tile_ids = gdf['tile_ids'][j]
-    tile_urls = gdf['tile_urls'][j]
-
-    # Reshape if the arrays are 0-dimensional
-    if tile_ids.ndim == 0:
-        tile_ids = tile_ids.reshape(1)
-
-    if tile_urls.ndim == 0:
-        tile_urls = tile_urls.reshape(1)
-    
-    # Iterate over each tile ID
-    for i in range(len(tile_ids)):
-        tile_id = tile_ids[i]
-        # Check if the tile ID is in the cloudfree quads for the current year
-        if tile_id in cloudfree_quads_this_year['quad'].to_list():
-            # Get the cloudfree quad URL and append the API key
-            cloudfree_quad_url = cloudfree_quads_this_year[cloudfree_quads_this_year['quad'] == tile_id]['link'].iloc[0]
-            tile_urls[i] = cloudfree_quad_url + PLANET_API_KEY
-        else:
-            # Print a message if no cloudfree tile is found
-            print('No cloudfree replacement found for tile', tile_id, 'therefore leaving it as is.')
-
-    # Update the tile URLs in the GeoDataFrame
-    gdf['tile_urls'][j] = tile_urls
-
-
-def parallel_process_cloudfree(gdf:gpd.geodataframe.GeoDataFrame, cloudfree_quads_this_year:pd.DataFrame):
-    """
-    Processes cloudfree tiles in parallel by delegating each tile's processing to worker threads.
+    Waits for the given tiles to be downloaded.
+    Returns a list of the file names of the tiles, or None if downloading failed.
 
     Parameters
     -------------
 
-    gdf: A GeoDataFrame.
-    type: geopandas.geodataframe.GeoDataFrame
-    values: A valid GeoDataFrame.
+    tile_ids: The IDs of the tiles forming the mosaic.
+    type: tuple
+    values: Any.
     default: No default value.
 
-    cloudfree_quads_this_year: A DataFrame.
+    downloader: The downloader of the year the tiles belong to.
+    type: downloads.TileDownloader
+    values: Any.
+    default: No default value.
+
+    quads: The quads of the year the tiles belong to, holding their download links.
     type: pandas.core.frame.DataFrame
-    values: A valid DataFrame containing cloudfree quad information for the current year.
+    values: Any.
     default: No default value.
 
     Example
     -------------
 
-    parallel_process_cloudfree(gdf, cloudfree_quads_this_year)
+    tile_filenames = download_tiles(jobs[0].tile_ids, downloader, quads)
     """
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [
-            executor.submit(process_cloudfree, j, gdf, cloudfree_quads_this_year)
-            for j in range(len(gdf))
-        ]
-
-        for future in as_completed(futures):
-            future.result()
+    # waiting for all required tiles, the client retries rate limited and failed requests itself
+    try:
+        return [downloader.fetch(id, quads.at[id, 'link']).result() for id in tile_ids]
 
+    except requests.exceptions.RequestException as e:
+        print('Downloading tiles', tile_ids, 'failed', e)
+        return None  # Exit the function if max retries are reached
 
-print('checking for cloudfree tiles')
-# reading a dataframe which contains information on cloudfree quads/tiles for the ground truth dataset used in our study
-cloudfree_quads = pd.read_csv('./data/segmentation/cloudfree_quads_info.csv', sep=',')
-cloudfree_quads_this_year = cloudfree_quads[cloudfree_quads['year'] == int(year)]
-parallel_process_cloudfree(gdf, cloudfree_quads_this_year)
+    # any other failure, e.g. writing or converting a tile, a missing download link, or a request missing from the archive in offline mode,
+    # only skips the polygons on these tiles instead of ending the run
+    except Exception as e:
+        print('Caught', repr(e), 'while downloading tiles', tile_ids)
+        return None
 
 
-def prepare_and_save(k:int, gdf:gpd.geodataframe.GeoDataFrame, set_type:str):
+def prepare_and_save_tile_set(jobs:list, polygons, writer, downloader:TileDownloader, quads:pd.DataFrame,
+                              executor:ProcessPoolExecutor=None, budget:MemoryBudget=None, manifest:RunManifest=None) -> int:
     """
-    Processes a single polygon in the GeoDataFrame, downloads corresponding tiles,
-    calculates polygon positions, creates mosaics, and saves the results as images
-    and segmentation masks.
+    Processes all polygons located on the same set of tiles, by waiting for their tiles to be downloaded,
+    and saving the images and segmentation masks of every polygon from them.
+    The time, CPU time and memory used by the tile set are printed next to its estimated memory.
+    Returns the number of polygons which were saved.
 
     Parameters
     -------------
 
-    k: The index of the polygon in the GeoDataFrame.
-    type: int
-    values: Positive integers corresponding to the row index in the GeoDataFrame.
+    jobs: The jobs of the polygons, which all need to be located on the same tiles.
+    type: list
+    values: A list of jobs.ChipJob.
     default: No default value.
 
-    gdf: A GeoDataFrame.
-    type: geopandas.geodataframe.GeoDataFrame
-    values: A valid GeoDataFrame.
+    polygons: The polygons of the set, used for finding the secondary polygons inside the primary polygons bbox.
+    type: jobs.ChipPolygons or str
+    values: The polygons, or their key in the polygons passed to the worker processes, or None if no segmentation masks are created.
     default: No default value.
 
-    set_type: The set type which is being processed, only needed for specifying in the right directory.
-    type: str
-    values: 'train', 'test', or 'val'.
+    writer: The writer of the output format, which also states if segmentation masks are created.
+    type: chipstore.PngChipWriter or chipstore.ShardedChipWriter
+    values: Any.
+    default: No default value.
+
+    downloader: The downloader of the year the tiles belong to.
+    type: downloads.TileDownloader
+    values: Any.
+    default: No default value.
+
+    quads: The quads of the year the tiles belong to, holding their download links.
+    type: pandas.core.frame.DataFrame
+    values: Any.
     default: No default value.
 
+    executor: The worker processes the chips are saved by, or None if they are saved by the calling thread.
+    type: concurrent.futures.ProcessPoolExecutor
+    values: Any.
+    default: None
+
+    budget: The memory budget shared by all tile sets which are saved at the same time.
+    type: scheduler.MemoryBudget
+    values: Any.
+    default: None
+
+    manifest: The manifest of the year, in which every saved image and segmentation mask is recorded.
+    type: manifest.RunManifest
+    values: Any.
+    default: None
+
     Example
     -------------
 
-    prepare_and_save(0, gdf, 'train', '2019')
+    jobs = compile_chip_jobs(gdf, quads)
+    prepare_and_save_tile_set([jobs[0], jobs[4], jobs[7]], ChipPolygons(gdf['geometry'].values), chip_writer('2019', 'train'), downloader, quads)
     """
 
+    # the tiles are pinned in the tile cache while they are downloaded and used, so they are not deleted in the meantime
+    tile_paths = [downloader.path(id) for id in jobs[0].tile_ids]
+    if downloader.cache is not None:
+        downloader.cache.pin(tile_paths)
+
+    start = time.perf_counter()
     try:
-        gdf['tile_urls'] = gdf['tile_urls'].apply(lambda x: np.array(x, ndmin=1))
-        gdf['tile_ids'] = gdf['tile_ids'].apply(lambda x: np.array(x, ndmin=1))
-
-        # downloading all required tiles
-        for url, id in zip(gdf['tile_urls'][k], gdf['tile_ids'][k]):
-            filename = './data/tiff_tiles/{}/{}.tiff'.format(year, id)
-            # checks if file already exists
-            if not os.path.isfile(filename):
-
-                # Retry logic with exponential backoff
-                max_retries = 10
-                backoff_factor = 0.01  # Start with 10 milliseconds
-                for attempt in range(max_retries):
-                    try:
-                        urllib.request.urlretrieve(url, filename)
-                        break  # Exit the loop if the request is successful
-
-                    except urllib.error.HTTPError as e:
-                        print(f'Caught HTTPError on attempt {attempt + 1}: {e}')
-                        time.sleep(backoff_factor)
-                        backoff_factor *= 2  # Exponential backoff
-
-                    except urllib.error.URLError as e:
-                        print(f'Caught URLError on attempt {attempt + 1}: {e}')
-                        time.sleep(backoff_factor)
-                        backoff_factor *= 2
-
-                    except OSError as e:
-                        print(f'Caught OSError on attempt {attempt + 1}: {e}')
-                        time.sleep(backoff_factor)
-                        backoff_factor *= 2 
-
-                else:
-                    print("Max retries reached. Exiting.")
-                    return  # Exit the function if max retries are reached
-
-        # getting all secondary polygons which are located on one of the tiles the primary polygon is located on
-        # and subsetting the dataset accordingly
-        on_same_tile = [any(id in id_list for id in gdf['tile_ids'][k]) for id_list in gdf['tile_ids']]
-        gdf_on_same_tile = gdf[on_same_tile]
-        gdf_on_same_tile.reset_index(drop=True, inplace=True)
-
-
-
-        # tile/mosaic bbox of the primary polygon
-        tile_bboxes = gdf['tile_bboxes'][k]
-
-        # calculating the position of all secondary polygons on the tile/mosaic, so we can calculate which are located inside the primary polygons bbox
-        for i in range(len(gdf_on_same_tile)):
-            x_poly_in_tile, y_poly_in_tile = global_to_local_coords(gdf_on_same_tile['geometry'][i], tile_bboxes)
-            gdf_on_same_tile['x_poly'][i] = x_poly_in_tile
-            gdf_on_same_tile['y_poly'][i] = y_poly_in_tile
-
-            x_bbox, y_bbox = global_to_local_coords(gdf_on_same_tile['bbox'][i], tile_bboxes, is_bbox=True)
-            gdf_on_same_tile['x_bbox'][i] = x_bbox
-            gdf_on_same_tile['y_bbox'][i] = y_bbox
-
-        # bbox of the primary polygon and its offset on the tile/mosaic
-        x_bbox = gdf['x_bbox'][k]
-        y_bbox = gdf['y_bbox'][k]
-        x_offset = int(x_bbox[2])
-        y_offset = int(y_bbox[0])
-        bbox_size = int(x_bbox[1] - x_bbox[3])
-
-
-
-        # checking which of the polygons on the tile/mosaic are actually located inside the primary polygons bbox
-        # since some polygons are located closely to each other, it can occur that secondary polygons are partly located inside the bbox of the primary polygon
-        in_same_bbox = []
-        for i in range(len(gdf_on_same_tile)):
-            x_poly = gdf_on_same_tile['x_poly'][i].copy()
-            y_poly = gdf_on_same_tile['y_poly'][i].copy()
-            poly_positions = check_if_inside_bbox(x_poly, y_poly, x_offset, y_offset, bbox_size)
-
-            #we will only count secondary polygons which have more than two points inside the primary polygons bbox
-            if poly_positions.count(True) > 2:
-                in_same_bbox.append(True)
+        tile_filenames = download_tiles(jobs[0].tile_ids, downloader, quads)
+        if tile_filenames is None:
+            return 0
+        downloaded = time.perf_counter() - start
+
+        # waiting until the chips fit into the memory budget, only after their tiles are downloaded
+        memory = estimate_memory(jobs, masks=writer.masks, supersampling=mask_supersampling)
+        reservation = budget.reserve(memory) if budget is not None else nullcontext(0.0)
+        with reservation as waited:
+            if executor is None:
+                saved, usage = save_chip_set_with_usage(jobs, tile_filenames, writer, polygons)
             else:
-                in_same_bbox.append(False)
-
-        # and again subsetting the dataset accordingly
-        gdf_in_same_bbox = gdf_on_same_tile[in_same_bbox]
-        gdf_in_same_bbox.reset_index(drop=True, inplace=True)
-
-
-
-        # merging all required tiles into a mosaic
-        tile_mosaic = []
-
-        # Retry logic with exponential backoff
-        max_retries = 10
-        backoff_factor = 0.01  # Start with 10 milliseconds
-        for attempt in range(max_retries):
-            try:
-                for id in gdf['tile_ids'][k]:
-                    img = rasterio.open('./data/tiff_tiles/{}/{}.tiff'.format(year, id))
-                    tile_mosaic.append(img)
-                break # Exit the loop if the loading is successful
-
-            except Exception as e:
-                print(f'Caught Error on attempt {attempt + 1}: {e}')
-                time.sleep(backoff_factor)
-                backoff_factor *= 2  # Exponential backoff
-
-        else:
-            print("Max retries reached. Exiting.")
-            return  # Exit the function if max retries are reached
-
-        # we have got four color channels, red, green, blue, and NIR
-        mosaic, _ = rasterio.merge.merge(tile_mosaic, indexes=[1,2,3,4])
-        # array needs to be cut according to the primary polygons bbox
-        rgb = mosaic[:, y_offset:y_offset+bbox_size, x_offset:x_offset+bbox_size]
-
-        # channels need to be scaled down to 512x512 if needed, using bicubic interpolation
-        rgb_resized = []
-        for channel in rgb:
-            channel_resized = cv2.resize(channel, dsize=(512,512), interpolation=cv2.INTER_CUBIC)
-            rgb_resized.append(channel_resized)
-
-        rgb_resized = np.array(rgb_resized).T
-        if not cv2.imwrite('./data/segmentation/{}/img_dir/{}/{}.png'.format(year, set_type, gdf['id'][k]), 255*rgb_resized):
-            print("Failed to save image of polygon", k)
-
-        # Closing the tiff files to free up memory
-        for img in tile_mosaic:
-            img.close()
-
-        if year == '2019':
-            # turning the polygons into a target array of zeros and ones
-            bbox_size = int(gdf['x_bbox'][k][1] - gdf['x_bbox'][k][3])
-            target = np.zeros((bbox_size, bbox_size), 'uint8')
-
-            for i in range(len(gdf_in_same_bbox)):
-                x_poly = gdf_in_same_bbox['x_poly'][i].copy()
-                y_poly = gdf_in_same_bbox['y_poly'][i].copy()
-                poly_positions = check_if_inside_bbox(x_poly, y_poly, x_offset, y_offset, bbox_size)
-
-                if poly_positions.count(True) > 2:
-                    x_poly -= x_offset
-                    y_poly -= y_offset
-                    x_poly, y_poly = replace_at_bbox_borders(x_poly, y_poly, bbox_size, poly_positions)
-
-                    rr, cc = skimage.draw.polygon(y_poly, x_poly, target.shape)
-                    target[rr,cc] = 1
-
-            # also downscaling the polygon target arrays to 512x512, using bicubic interpolation
-            target_resized = cv2.resize(target, dsize=(512,512), interpolation=cv2.INTER_CUBIC)
-            target_resized = np.array(target_resized).T
-            if not cv2.imwrite('./data/segmentation/{}/ann_dir/{}/{}.png'.format(year, set_type, gdf['id'][k]), target_resized):
-                print("Failed to save segmentation mask of polygon", k)
-
-    except OSError as e:
-        print('Caught OSError', e, 'on polygon', k)
-        pass
-
-    except FloatingPointError as e:
-        print('Caught normalization error caused by empty color channel on polygon', k)
-        print(e)
-        pass
-
-    except cv2.error:
-        print('Caught error caused by empty color channel on polygon', k)
-        pass
+                saved, usage = executor.submit(save_chip_set_with_usage, jobs, tile_filenames, writer, polygons).result()
 
-    except Exception as e:
-        print('Caught', e, 'on polygon', k)
-        pass
+    finally:
+        if downloader.cache is not None:
+            downloader.cache.unpin(tile_paths)
+
+    # the resources of every tile set are logged, so the memory estimates can be compared with the memory actually used
+    print('Saved {} of {} chips on tiles {} in {:.2f} s ({:.2f} s CPU), after waiting {:.2f} s for tiles and {:.2f} s for memory, estimated {:.0f} MB, peak RSS {:.0f} MB'.format(
+          str(len(saved)), str(len(jobs)), ','.join(jobs[0].tile_ids), usage['seconds'], usage['cpu_seconds'], downloaded, waited, memory / 2**20, usage['peak_rss'] / 2**20))
+
+    # the worker processes only return the checksums of the saved chips, which are recorded by this process
+    if manifest is not None:
+        manifest.record_many([entry for entries in saved for entry in entries])
+    return len(saved)
 
 
-def parallel_prepare_and_save(gdf: gpd.geodataframe.GeoDataFrame, set_type: str):
+def chip_writer(year:str, set_type:str):
     """
-    Iterates over all mining polygons in gdf, reads their corresponding .tiff tiles, calculates their positions on these tiles,
-    and produces .png images and segmentation masks of size 512x512 for training and prediction, using parallel processing.
+    Returns the writer of the chips of a set, either writing .png files to the img_dir and ann_dir of the set, or shards to its chip store.
+    Segmentation masks are only created for 2019.
+    """
+
+    masks = year == '2019'
+    if chip_format == 'shards':
+        return ShardedChipWriter('./data/segmentation/{}/chips/{}'.format(year, set_type), masks=masks)
+
+    img_dir = './data/segmentation/{}/img_dir/{}'.format(year, set_type)
+    ann_dir = './data/segmentation/{}/ann_dir/{}'.format(year, set_type) if masks else None
+    return PngChipWriter(img_dir, ann_dir)
+
+
+# the maximum number of windows saved by the same worker at once
+WINDOW_GROUP_SIZE = 16
+
+
+def parallel_prepare_and_save(gdf:gpd.geodataframe.GeoDataFrame, year:str, set_type:str, quads:pd.DataFrame, downloader:TileDownloader,
+                              dispatcher:ThreadPoolExecutor, polygons=None, executor:ProcessPoolExecutor=None, budget:MemoryBudget=None,
+                              manifest:RunManifest=None, verify:bool=False, group_by_tiles:bool=True, windows:bool=False) -> (list, int, int):
+    """
+    Schedules all mining polygons in gdf for being saved as .png images and segmentation masks of size 512x512 for training and prediction.
+    Returns the futures of the scheduled tile sets, which resolve to the number of saved chips,
+    the number of chips which were already saved by a previous run according to the manifest, and are therefore skipped, and the number of all chips.
+    The GeoDataFrame is compiled into immutable jobs first, so the workers never touch it.
+    By default, polygons located on the same set of tiles are processed together, so their tiles are only opened once.
+    Tile sets are scheduled longest first, estimated by the number of bytes read from their tiles, and the tiles of all polygons start downloading in this order.
 
     Parameters
     -------------
@@ -610,88 +463,193 @@ def parallel_prepare_and_save(gdf: gpd.geodataframe.GeoDataFrame, set_type: str)
     values: Any.
     default: No default value.
 
+    year: The year which is being processed, only needed for specifying in the right directory.
+    type: str
+    values: Any.
+    default: No default value.
+
     set_type: The set type which is being processed, only needed for specifying in the right directory.
     type: str
     values: 'train', 'test', or 'val'.
     default: No default value.
 
+    quads: The quads of the year, holding their download links.
+    type: pandas.core.frame.DataFrame
+    values: Any.
+    default: No default value.
+
+    downloader: The downloader of the year.
+    type: downloads.TileDownloader
+    values: Any.
+    default: No default value.
+
+    dispatcher: The worker threads shared by all years, which wait for the tiles and save the chips or hand them to the worker processes.
+    type: concurrent.futures.ThreadPoolExecutor
+    values: Any.
+    default: No default value.
+
+    polygons: The polygons of the set, or their key in the polygons passed to the worker processes.
+    type: jobs.ChipPolygons or str
+    values: Any, or None if no segmentation masks are created.
+    default: None
+
+    executor: The worker processes shared by all years, or None if the chips are saved by the worker threads.
+    type: concurrent.futures.ProcessPoolExecutor
+    values: Any.
+    default: None
+
+    budget: The memory budget shared by all years.
+    type: scheduler.MemoryBudget
+    values: Any.
+    default: None
+
+    manifest: The manifest of the year, which is used for skipping the polygons which were already saved.
+    type: manifest.RunManifest
+    values: Any.
+    default: None
+
+    verify: States if the checksums of already saved images and segmentation masks are verified before skipping their polygons.
+    type: bool
+    values: True or False.
+    default: False
+
+    group_by_tiles: States if polygons are grouped by their set of tiles, or if the tiles are opened for every polygon separately.
+    type: bool
+    values: True or False.
+    default: True
+
+    windows: States if bboxes larger than 512x512 are split into overlapping windows of 512x512 at native resolution, which are saved as separate chips.
+    Windows are named after the polygon id and their index, and stitched together again by gpkg_dataset_generation.py.
+    type: bool
+    values: True or False.
+    default: False
+
     Example
     -------------
 
-    parallel_prepare_and_save(gdf_train, set_type='train')
-    parallel_prepare_and_save(gdf_test, set_type='test')
-    parallel_prepare_and_save(gdf_val, set_type='val')
+    with ThreadPoolExecutor(max_workers=4) as dispatcher:
+        futures, skipped, n_chips = parallel_prepare_and_save(gdf_train, '2019', 'train', quads, downloader, dispatcher, ChipPolygons(gdf_train['geometry'].values))
+        saved = skipped + sum(future.result() for future in futures)
     """
 
-    print('Processing', set_type)
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [
-            executor.submit(prepare_and_save, k, gdf, set_type)
-            for k in range(len(gdf))
-        ]
-
-        for future in as_completed(futures):
-            future.result()  # Handle exceptions from threads if needed
-
-
-np.random.seed(2023)
-# These ids were hand validated
-# These polygons are validated to be well delineated mining areas for 2019
-HAND_VALIDATED_IDS = [1867, 2720, 3660, 3743, 3757, 3849, 3853, 4288, 4323, 4704, 4838, 4853, 
-                        5139, 5162, 6808, 6809, 9227, 9945, 10256, 10258, 10338, 10514, 10753, 10844, 
-                        11109, 11139, 11507, 11726, 12540, 13004, 13144, 13540, 14844, 15550, 15619, 
-                        15872, 16087, 16242, 16516, 16656, 17616, 17764, 17766, 17895, 18058, 18126, 
-                        18196, 18210, 18314, 18315, 18321, 18323, 18381, 18412, 18427, 18452, 18502, 
-                        18520, 18529, 18545, 18558, 18586, 18596, 18603, 18605, 18624, 18636, 18691, 
-                        18747, 18787, 18844, 18977, 18994, 19134, 19227, 19284, 19315, 19401, 19534, 
-                        19716, 20578, 21048, 21194, 21217, 21234, 21532, 21938, 22017, 22215, 22386, 
-                        23466, 23502, 23970, 24052, 24788, 26464, 26598, 26788, 26808, 27189, 27244, 
-                        27249, 27250, 27573, 27588, 27672, 27698, 27823, 28043, 28235, 28245, 28299, 
-                        28368, 28418, 28422, 28426, 28642, 28680, 28721, 28742, 29305, 29336, 29463, 
-                        29538, 29766, 29978, 29994, 30216, 30268, 30276, 30643, 30931, 31638, 36191, 
-                        36601, 37344, 37367, 37397, 37455, 37458, 37534, 37541, 37568, 37646, 37771, 
-                        37786, 37813, 38412, 38459, 38510, 38555, 38579, 41338, 41855, 42268, 42783, 
-                        43194, 43217, 43255, 43996, 44044, 44047, 44071, 44531, 44532, 44572, 45042, 
-                        45878, 46161, 59191, 60251, 60501, 60522, 60528, 60573, 61268, 61330, 61758, 
-                        62302, 62345, 63034, 63036, 64468, 64490, 64511, 64666, 65496, 66038, 67045, 
-                        72444, 72479, 72733, 72779, 73184, 73470, 73528, 75192, 75926, 76524, 79590]
-
-# Filter out the indices that are not in HAND_VALIDATED_IDS for training and validation
-non_hand_validated_indices = [i for i in range(len(gdf)) if (gdf['id'].iloc[i] not in HAND_VALIDATED_IDS)]
-
-# 0.89 train 0.1 val split, and a hand validated 0.01 test set of 200 samples
-val_indices = []
-while len(val_indices) < np.round(len(gdf) * 0.1):
-    r = np.random.choice(non_hand_validated_indices)
-    if r not in val_indices:
-        val_indices.append(r)
-
-train_indices = [i for i in non_hand_validated_indices if (i not in val_indices) ]
-
-gdf_train = gdf.iloc[train_indices].copy()
-gdf_train.reset_index(drop=True, inplace=True)
-
-gdf_val = gdf.iloc[val_indices].copy()
-gdf_val.reset_index(drop=True, inplace=True)
-
-has_hand_validated_indices = len(non_hand_validated_indices) < len(gdf)
-if has_hand_validated_indices:
-    gdf_test = gdf[gdf['id'].isin(HAND_VALIDATED_IDS)]
-    gdf_test.reset_index(drop=True, inplace=True)
-    print('Train set size:', len(gdf_train), 'Test set size:', len(gdf_test), 'Validation set size:', len(gdf_val))
-else:
-    print('Train set size:', len(gdf_train), 'Validation set size:', len(gdf_val))
+    print('Scheduling', year, set_type)
+    jobs = compile_chip_jobs(gdf, quads)
+    if windows:
+        n_polygons = len(jobs)
+        jobs = window_jobs(jobs)
+        print('Split {} polygons into {} chips'.format(str(n_polygons), str(len(jobs))))
+    n_chips = len(jobs)
+    writer = chip_writer(year, set_type)
+
+    # skipping all chips whose image and, if needed, segmentation mask were already saved
+    # the polygons of the whole set are still used for the segmentation masks of the remaining polygons
+    skipped = 0
+    if manifest is not None:
+        ids = [job.name for job in jobs]
+        done = manifest.completed(writer.image_kind, ids, verify)
+        if writer.masks:
+            done &= manifest.completed(writer.mask_kind, ids, verify)
+        jobs = [job for job in jobs if job.name not in done]
+        skipped = len(ids) - len(jobs)
+        print('{} out of {} chips were already saved, {} remain'.format(str(skipped), str(len(ids)), str(len(jobs))))
+
+    if group_by_tiles:
+        # polygons are grouped by the set of tiles their mosaic is formed by
+        groups = {}
+        for job in jobs:
+            groups.setdefault(tuple(sorted(job.tile_ids)), []).append(job)
+        groups = list(groups.values())
+        print('Reading {} mosaics for {} chips'.format(str(len(groups)), str(len(jobs))))
+        if windows:
+            # the many windows of a large bbox are spread over several workers, which open the same tiles
+            groups = [group[i:i + WINDOW_GROUP_SIZE] for group in groups for i in range(0, len(group), WINDOW_GROUP_SIZE)]
+    else:
+        groups = [[job] for job in jobs]
+    # the longest tile sets start first, so they do not keep a single worker busy at the end
+    groups = longest_first(groups, lambda group: sum(estimate_read_memory(job) for job in group))
+
+    tile_ids = list(dict.fromkeys(id for group in groups for id in group[0].tile_ids))
+    missing_tiles = [id for id in tile_ids if not os.path.isfile(downloader.path(id))]
+    print('{} out of {} tiles need to be downloaded'.format(str(len(missing_tiles)), str(len(tile_ids))))
+    if downloader.cache is not None:
+        # tiles needed by many polygons are kept in the tile cache until all of them are saved
+        downloader.cache.plan([downloader.path(id) for group in groups for id in group[0].tile_ids])
+
+    futures = [
+        dispatcher.submit(prepare_and_save_tile_set, group, polygons, writer, downloader, quads, executor, budget, manifest)
+        for group in groups
+    ]
+    # downloading the tiles of all remaining polygons in the order they are processed in
+    # with a bounded tile cache, tiles are only downloaded once they are needed, so they do not exceed its budget before they are used
+    if downloader.cache is None or downloader.cache.budget is None:
+        downloader.prefetch([(id, quads.at[id, 'link']) for id in tile_ids])
+
+    return futures, skipped, n_chips
+
+
+# the quads of every year are looked up one after another, since all requests share the rate limit of the client anyway
+year_sets = {}
+for year in years:
+    gdf_year, quads = find_tiles(gdf, year)
+    year_sets[year] = (quads, split_sets(gdf_year))
+    del gdf_year
+
+# the polygons used for segmentation masks, which are only created for 2019
+mask_polygons = {}
+for year, (quads, sets) in year_sets.items():
+    for set_type, gdf_set in sets.items():
+        if chip_writer(year, set_type).masks:
+            mask_polygons['{}/{}'.format(year, set_type)] = ChipPolygons(gdf_set['geometry'].values, supersampling=mask_supersampling)
 
+print()
 print('Preparing and saving data.')
-parallel_prepare_and_save(gdf_train, set_type='train')
-parallel_prepare_and_save(gdf_val, set_type='val')
-
-if has_hand_validated_indices:
-    parallel_prepare_and_save(gdf_test, set_type='test')
+executor = None
+if process_pool:
+    # the workers are forked, since this script can not be imported again by spawned workers
+    # they receive the polygons once when they are started, and afterwards only jobs and tile file names
+    executor = ProcessPoolExecutor(max_workers=chip_workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=init_worker, initargs=(mask_polygons,))
+    # all worker processes are started by the first task, before the download threads get busy
+    executor.submit(int).result()
+
+# the chips of all years are saved by the same workers, which together stay within the memory budget
+budget = MemoryBudget(int(memory_budget * 2**30))
+# every tile is downloaded once, regardless of how many polygons are located on it, and all years share the same number of downloads
+transfers = ThreadPoolExecutor(max_workers=download_workers)
+# the quads of all years share one tile cache, which deletes quads once they exceed its budget
+cache = TileCache('./data/tiff_tiles', budget=int(tile_cache * 2**30) if tile_cache is not None else None, policy=cache_policy)
+# the worker threads mostly wait for downloads if chips are saved by worker processes, so there are twice as many of them
+dispatcher = ThreadPoolExecutor(max_workers=2 * chip_workers if process_pool else chip_workers)
+
+scheduled = []
+for year, (quads, sets) in year_sets.items():
+    # completed downloads and chips are recorded per year, so interrupted runs can be resumed
+    manifest = RunManifest('./data/segmentation/{}/manifest.sqlite'.format(year))
+    downloader = TileDownloader(client, './data/tiff_tiles/{}'.format(year), executor=transfers, manifest=manifest, cache=cache, cog=cog)
+    for set_type, gdf_set in sets.items():
+        key = '{}/{}'.format(year, set_type)
+        polygons = (key if process_pool else mask_polygons[key]) if key in mask_polygons else None
+        futures, skipped, n_chips = parallel_prepare_and_save(gdf_set, year, set_type, quads, downloader, dispatcher, polygons, executor, budget, manifest,
+                                                              verify, windows=native_windows)
+        scheduled.append((year, set_type, n_chips, futures, skipped))
+
+for year, set_type, n_chips, futures, skipped in scheduled:
+    # chips saved by previous runs are counted as well
+    saved = skipped + sum(future.result() for future in futures)
+    print('Saved {} out of {} chips of {} {}'.format(str(saved), str(n_chips), year, set_type))
+print('Chips saved at the same time were estimated to use at most {:.1f} out of {:.1f} GB'.format(budget.peak / 2**30, memory_budget))
+
+dispatcher.shutdown()
+transfers.shutdown()
+cache.close()
+if executor is not None:
+    executor.shutdown()
+if client.replay is not None:
+    print('Replayed {} Planet API responses from {}, sent {} requests'.format(str(client.replay.hits), http_archive, str(client.replay.misses)))
 
 
 if demo:
-    print(year, 'Demo done.')
-    
+    print(', '.join(years), 'Demo done.')
+
 else:
-    print(year, 'Done.')
+    print(', '.join(years), 'Done.')
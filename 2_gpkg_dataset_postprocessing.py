@@ -2,6 +2,9 @@ import numpy as np
 import geopandas as gpd
 from argparse import ArgumentParser
 
+from countries import CountryLookup, equal_area
+from postprocessing import temporal_filter
+
 #This script is used for the postprocessing of .gpkg polygon datasets.
 #It removes any polygons that do not have an intersecting polygon in the previous or subsequent year.
 #This means that the years 2016 and 2024, which only have a single ‘neighboring’ year, which we can compare the polygons to, feature a lower number of polygons.
@@ -9,6 +12,7 @@ from argparse import ArgumentParser
 
 parser = ArgumentParser()
 parser.add_argument('-s', '--buffer_size', required=False, default=None, type=float, help="Rough estimate of buffer size in meters.")
+parser.add_argument('-l', '--largest_overlap', required=False, default=False, type=bool, help="Set this flag to assign polygons intersecting multiple countries to the country with the largest overlap.")
 
 args = parser.parse_args()
 use_buffer = args.buffer_size is not None
@@ -42,78 +46,13 @@ for year in np.arange(2016, 2025).astype(str):
     global_datasets[year] = global_data
 
 
-global_datasets_postprocessed = {}
-for year, dataset in global_datasets.items():
-    global_datasets_postprocessed[year] = dataset.copy()
-
-
 #Removing any polygons that do not have an intersecting polygon in the previous or subsequent year
-for i in range(len(global_datasets.keys())):
-    year = list(global_datasets.keys())[i]
-    print('Postprocessing', year)
-    previous_year = None
-    following_year = None
-
-    if i != 0:
-        previous_year = str(int(year) - 1)
-        global_datasets_postprocessed[year]['tempid'] = range(global_datasets_postprocessed[year].shape[0])
-
-        if use_buffer:
-            # Adding a buffer for more generous postprocessing
-            buffered_current_year = global_datasets_postprocessed[year].copy()
-            buffered_current_year['geometry'] = buffered_current_year['geometry'].buffer(buffer_size)
-            matches_previous_year = gpd.sjoin(
-                left_df=buffered_current_year,
-                right_df=global_datasets[previous_year],
-                how="inner"
-            ).tempid
-
-        else:
-            matches_previous_year = gpd.sjoin(
-                left_df=global_datasets_postprocessed[year],
-                right_df=global_datasets[previous_year],
-                how="inner"
-            ).tempid
-
-
-    if i != len(global_datasets.keys())-1:
-        following_year = str(int(year) + 1)
-        global_datasets_postprocessed[year]['tempid'] = range(global_datasets_postprocessed[year].shape[0])
-
-        if use_buffer:
-            # Adding a buffer for more generous postprocessing
-            buffered_current_year = global_datasets_postprocessed[year].copy()
-            buffered_current_year['geometry'] = buffered_current_year['geometry'].buffer(buffer_size)
-            matches_following_year = gpd.sjoin(
-                left_df=buffered_current_year,
-                right_df=global_datasets[following_year],
-                how="inner"
-            ).tempid
-
-        else:
-            matches_following_year = gpd.sjoin(
-                left_df=global_datasets_postprocessed[year],
-                right_df=global_datasets[following_year],
-                how="inner"
-            ).tempid
-
-    if (previous_year is not None) and (following_year is not None):
-        subset = [any(tup) for tup in zip(global_datasets_postprocessed[year].tempid.isin(matches_previous_year), global_datasets_postprocessed[year].tempid.isin(matches_following_year))]
-        global_datasets_postprocessed[year] = global_datasets_postprocessed[year].loc[subset].drop(columns="tempid")
-
-    elif (previous_year is not None):
-        global_datasets_postprocessed[year] = global_datasets_postprocessed[year].loc[global_datasets_postprocessed[year].tempid.isin(matches_previous_year)].drop(columns="tempid")
-
-    else:
-        global_datasets_postprocessed[year] = global_datasets_postprocessed[year].loc[global_datasets_postprocessed[year].tempid.isin(matches_following_year)].drop(columns="tempid")
-
-    global_datasets_postprocessed[year].reset_index(drop=True, inplace=True) 
+global_datasets_postprocessed = temporal_filter(global_datasets, buffer_size if use_buffer else None)
 
 
-#Reading a country dataset provided by NaturalEarth
+#Reading a country dataset provided by NaturalEarth and its spatial index
 #https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/10m/cultural/ne_10m_admin_0_countries.zip
-countries = gpd.read_file('./data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp')
-countries = countries.to_crs('EPSG:4326')
+countries = CountryLookup.from_file('./data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp')
 
 
 #Assigning the correct country names and iso3 codes by comparing the polygons to the NaturalEarth dataset
@@ -121,12 +60,10 @@ for year in global_datasets_postprocessed.keys():
     print('Assigning country names and iso3 codes for', year)
     global_data = global_datasets_postprocessed[year]
 
-    a = global_data['geometry'].apply(lambda x: x.intersects(countries.geometry))
-    global_data['iso_a3'] = (a * countries['ISO_A3']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
-    global_data['country_name'] = (a * countries['NAME']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
+    global_data['iso_a3'], global_data['country_name'] = countries.lookup(global_data.geometry.values, largest_overlap=args.largest_overlap)
 
-    copy_for_area = global_data.copy().to_crs('+proj=igh +lon_0=0 +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs +type=crs')
-    global_data['area'] = copy_for_area.geometry.area
+    # only the coordinates are projected to an equal-area projection, instead of copying the whole dataset
+    global_data['area'] = equal_area(global_data.geometry.values)
     global_data['id'] = global_data.index
     global_data.geometry = global_data.geometry.make_valid()
     global_data['year'] = [year] * len(global_data)
@@ -0,0 +1,122 @@
+import time
+from argparse import ArgumentParser
+import numpy as np
+import shapely
+
+from utils import get_bbox, get_bbox_batch, count_tiles_batch, global_to_local_coords, global_to_local_coords_batch, check_if_inside_bbox, check_if_inside_bbox_batch
+
+'''
+This script is a microbenchmark for the geometry helpers in utils.py.
+It compares calling the single polygon helpers for every row, as the generation scripts used to do, with a single call of their batch counterparts.
+Run it from the repository root using python -m benchmarks.geometry_helpers
+'''
+
+parser = ArgumentParser()
+parser.add_argument('-n', '--n_polygons', required=False, default=5000, type=int, help="Number of synthetic polygons.")
+parser.add_argument('-v', '--n_vertices', required=False, default=64, type=int, help="Number of vertices per synthetic polygon.")
+parser.add_argument('-r', '--repeat', required=False, default=3, type=int, help="Number of repetitions, the fastest one is reported.")
+
+args = parser.parse_args()
+
+# the size of a zoom 15 quad in degrees
+QUAD_SIZE = 360 / 2**13
+
+
+def synthetic_polygons(n:int, n_vertices:int, seed:int=2023) -> (np.ndarray, list):
+    """
+    Returns n random star shaped polygons inside the tropics and the bounding boxes of the 2x2 quads each of them lies upon.
+    """
+
+    rng = np.random.default_rng(seed)
+    centers = np.stack([rng.uniform(-170, 170, n), rng.uniform(-25, 25, n)], axis=1)
+    angles = np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    radii = rng.uniform(0.002, 0.01, (n, 1)) * rng.uniform(0.5, 1, (n, n_vertices))
+
+    rings = np.stack([centers[:, [0]] + radii*np.cos(angles), centers[:, [1]] + radii*np.sin(angles)], axis=2)
+    polygons = shapely.polygons(np.concatenate([rings, rings[:, :1]], axis=1))
+
+    # every polygon gets the four quads around the quad corner closest to its center
+    corners = np.round(centers / QUAD_SIZE) * QUAD_SIZE
+    tile_bboxes = [[[x + dx, y + dy, x + dx + QUAD_SIZE, y + dy + QUAD_SIZE] for dx in (-QUAD_SIZE, 0) for dy in (-QUAD_SIZE, 0)] for x, y in corners]
+
+    return polygons, tile_bboxes
+
+
+def global_to_local_coords_loop(poly, tile_bboxes:list) -> np.ndarray:
+    # the per vertex loop global_to_local_coords used before it was vectorized, as reference
+    mosaic_bbox = [min(b[0] for b in tile_bboxes), min(b[1] for b in tile_bboxes), max(b[2] for b in tile_bboxes), max(b[3] for b in tile_bboxes)]
+    x_tile_counter, y_tile_counter = 2, 2
+    tile_size_x = (mosaic_bbox[2] - mosaic_bbox[0])
+    tile_size_y = (mosaic_bbox[3] - mosaic_bbox[1])
+    poly = np.array(poly.exterior.coords)
+
+    for i in range(len(poly)):
+        poly[i][0] -= mosaic_bbox[0]
+        poly[i][0] = np.round((poly[i][0]/tile_size_x) * 4096 * x_tile_counter)
+        poly[i][1] -= mosaic_bbox[1]
+        poly[i][1] = np.round((poly[i][1]/tile_size_y) * 4096 * y_tile_counter)
+
+    for i in range(len(poly)):
+        poly[i][1] = 4096 * y_tile_counter - poly[i][1]
+
+    poly_x, poly_y = zip(*poly)
+    return np.array(poly_x), np.array(poly_y)
+
+
+def check_if_inside_bbox_loop(x, y, x_offset, y_offset, bbox_size) -> list:
+    # the per point loop check_if_inside_bbox used before it was vectorized, as reference
+    poly_positions = []
+    for x_poly, y_poly in zip(x, y):
+        if (x_poly >= x_offset) and (x_poly <= x_offset+bbox_size) and (y_poly >= y_offset) and (y_poly <= y_offset+bbox_size):
+            poly_positions.append(True)
+        else:
+            poly_positions.append(False)
+    return poly_positions
+
+
+def best_of(function, repeat:int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_loop_version(polygons, tile_bboxes):
+    for poly, bboxes in zip(polygons, tile_bboxes):
+        get_bbox(poly)
+        x, y = global_to_local_coords_loop(poly, bboxes)
+        check_if_inside_bbox_loop(x, y, 1024, 1024, 4096)
+
+
+def run_wrapper_version(polygons, tile_bboxes):
+    for poly, bboxes in zip(polygons, tile_bboxes):
+        get_bbox(poly)
+        x, y = global_to_local_coords(poly, bboxes)
+        check_if_inside_bbox(x, y, 1024, 1024, 4096)
+
+
+def run_batch_version(polygons, tile_bboxes):
+    get_bbox_batch(polygons)
+    offsets = np.arange(0, 4*len(tile_bboxes) + 1, 4)
+    mosaic_bboxes, x_tile_counters, y_tile_counters = count_tiles_batch(np.concatenate(tile_bboxes), offsets)
+    x, y, _ = global_to_local_coords_batch(polygons, mosaic_bboxes, x_tile_counters, y_tile_counters)
+    check_if_inside_bbox_batch(x, y, 1024, 1024, 4096)
+
+
+polygons, tile_bboxes = synthetic_polygons(args.n_polygons, args.n_vertices)
+
+# making sure all versions calculate the same coordinates before timing them
+x_loop, y_loop = global_to_local_coords_loop(polygons[0], tile_bboxes[0])
+x_batch, y_batch = global_to_local_coords(polygons[0], tile_bboxes[0])
+assert np.array_equal(x_loop, x_batch) and np.array_equal(y_loop, y_batch), "Batch and loop versions differ."
+
+print('Benchmarking {} polygons with {} vertices each'.format(args.n_polygons, args.n_vertices))
+loop_time = best_of(lambda: run_loop_version(polygons, tile_bboxes), args.repeat)
+wrapper_time = best_of(lambda: run_wrapper_version(polygons, tile_bboxes), args.repeat)
+batch_time = best_of(lambda: run_batch_version(polygons, tile_bboxes), args.repeat)
+
+print('per vertex loops:   {:.3f} s'.format(loop_time))
+print('per polygon calls:  {:.3f} s ({:.1f}x)'.format(wrapper_time, loop_time / wrapper_time))
+print('single batch call:  {:.3f} s ({:.1f}x)'.format(batch_time, loop_time / batch_time))
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
+
+from planet import PlanetClient
+from quads import QuadCatalog, QuadGrid, plan_searches, parallel_process_tile, parallel_resolve_quads
+from jobs import ChipPolygons, compile_chip_jobs, window_jobs, window_margins
+from chips import save_chip_set, rasterize_mask
+from chipstore import CHIP_FORMATS, PngChipWriter, ShardedChipWriter
+from downloads import TileDownloader
+from utils import vectorize_prediction
+from postprocessing import temporal_filter
+from benchmarks.world import MOSAIC_ID, StubPlanetAPI, synthetic_mines, synthetic_predictions, quads_frame, write_quads
+
+'''
+This script benchmarks the stages of the pipeline on a synthetic world, without a Planet account, network access or a trained model.
+It runs the quad search and lookup of stages 0 and 1 against a local stub of the Planet API, the downloading and saving of chips of stage 0,
+the vectorization of predictions of stage 1 using a dummy model which predicts the ground truth, and the temporal filter of stage 2.
+Every stage runs in its own process, and its time, peak memory, and written files and bytes are appended to a JSON Lines report,
+together with the commit and the parameters, so regressions can be tracked over time.
+Run it from the repository root using python -m benchmarks.pipeline
+'''
+
+STAGES = ['search', 'resolve', 'chips', 'vectorize', 'temporal']
+
+parser = ArgumentParser()
+parser.add_argument('-n', '--n_polygons', required=False, default=1000, type=int, help="Number of synthetic mining polygons.")
+parser.add_argument('--n_districts', required=False, default=None, type=int, help="Number of mining districts the polygons are clustered in, by default one per 50 polygons.")
+parser.add_argument('-s', '--stages', required=False, default=','.join(STAGES), type=str, help="Comma separated stages to run, out of {}.".format(', '.join(STAGES)))
+parser.add_argument('-w', '--workers', required=False, default=4, type=int, help="Number of worker threads and concurrent requests.")
+parser.add_argument('-l', '--latency', required=False, default=0, type=float, help="Delay of every response of the stub API in seconds.")
+parser.add_argument('-f', '--chip_format', required=False, default='png', choices=CHIP_FORMATS, type=str, help="Output format of the chips.")
+parser.add_argument('--native_windows', required=False, default=False, type=bool, help="Set this flag to split large bboxes into native resolution windows.")
+parser.add_argument('--mask_supersampling', required=False, default=1, type=int, help="Supersampling factor of the segmentation masks.")
+parser.add_argument('--http_archive', required=False, default=None, type=str, help="Path of an archive the responses of the search and resolve stages are recorded to and replayed from.")
+parser.add_argument('--offline', required=False, default=False, type=bool, help="Set this flag to only use the responses recorded in --http_archive.")
+parser.add_argument('--seed', required=False, default=2023, type=int, help="Seed of the synthetic world.")
+parser.add_argument('--world_dir', required=False, default='./data/benchmark/world', type=str, help="Directory of the synthetic quads, which are reused by later runs.")
+parser.add_argument('--output_dir', required=False, default='./data/benchmark/output', type=str, help="Directory the stages write to, which is emptied before every stage.")
+parser.add_argument('-r', '--report', required=False, default='./data/benchmark/results.jsonl', type=str, help="JSON Lines file the results are appended to.")
+
+args = parser.parse_args()
+stages = args.stages.split(',')
+assert all(stage in STAGES for stage in stages), "Unknown stage in {}.".format(args.stages)
+
+quad_dir = os.path.join(args.world_dir, 'quads')
+grid = QuadGrid()
+
+
+def world():
+    """
+    Returns the synthetic polygons, with the ids of the quads each of them is located on, and the ids of all these quads.
+    """
+
+    gdf = synthetic_mines(args.n_polygons, args.n_districts, seed=args.seed)
+    gdf['tile_ids'] = grid.quads_for_bounds(shapely.bounds(gdf['bbox'].to_numpy()))
+    quad_ids = np.unique(np.concatenate(gdf['tile_ids'].to_list()))
+    return gdf, quad_ids
+
+
+def chip_jobs(gdf, quads) -> list:
+    jobs = compile_chip_jobs(gdf, quads)
+    return window_jobs(jobs) if args.native_windows else jobs
+
+
+def bench_world(output_dir:str) -> dict:
+    gdf, quad_ids = world()
+    written = write_quads(quad_ids, quad_dir, seed=args.seed)
+    return {'polygons': len(gdf), 'quads': len(quad_ids), 'written_quads': written}
+
+
+def bench_search(output_dir:str) -> dict:
+    # the same searches as both generation scripts with --api_search, grouping neighbouring polygons into regions
+    gdf, _ = world()
+    gdf['tile_ids'] = [np.array([], dtype=object) for _ in range(len(gdf))]
+    regions = plan_searches(shapely.bounds(gdf['bbox'].to_numpy()))
+    catalog = QuadCatalog(os.path.join(output_dir, 'quad_catalog.sqlite'))
+
+    with StubPlanetAPI(quad_dir, latency=args.latency) as api:
+        client = PlanetClient('benchmark', rate=1e6, burst=10**6, max_workers=args.workers, archive=args.http_archive, offline=args.offline)
+        parallel_process_tile(gdf, MOSAIC_ID, api.url, client, catalog)
+
+    catalog.close()
+    return {'polygons': len(gdf), 'regions': len(regions), 'requests': api.requests}
+
+
+def bench_resolve(output_dir:str) -> dict:
+    # the quads of all polygons calculated on the quad grid, whose download links are requested one by one
+    _, quad_ids = world()
+    catalog = QuadCatalog(os.path.join(output_dir, 'quad_catalog.sqlite'))
+
+    with StubPlanetAPI(quad_dir, latency=args.latency) as api:
+        client = PlanetClient('benchmark', rate=1e6, burst=10**6, max_workers=args.workers, archive=args.http_archive, offline=args.offline)
+        parallel_resolve_quads(quad_ids, MOSAIC_ID, api.url, client, catalog)
+
+    resolved = len(catalog.quads_frame(MOSAIC_ID))
+    catalog.close()
+    return {'quads': len(quad_ids), 'resolved': resolved, 'requests': api.requests}
+
+
+def bench_chips(output_dir:str) -> dict:
+    # downloading the quads of all tile sets from the stub API and saving their chips, as prepare_and_save_tile_set does
+    gdf, quad_ids = world()
+    polygons = ChipPolygons(gdf['geometry'].values, supersampling=args.mask_supersampling)
+
+    if args.chip_format == 'shards':
+        writer = ShardedChipWriter(os.path.join(output_dir, 'chips'), masks=True)
+    else:
+        os.makedirs(os.path.join(output_dir, 'img_dir'))
+        os.makedirs(os.path.join(output_dir, 'ann_dir'))
+        writer = PngChipWriter(os.path.join(output_dir, 'img_dir'), os.path.join(output_dir, 'ann_dir'))
+
+    with StubPlanetAPI(quad_dir, latency=args.latency) as api:
+        client = PlanetClient('benchmark', rate=1e6, burst=10**6, max_workers=args.workers)
+        quads = quads_frame(quad_ids, api.url, grid)
+        jobs = chip_jobs(gdf, quads)
+
+        groups = {}
+        for job in jobs:
+            groups.setdefault(tuple(sorted(job.tile_ids)), []).append(job)
+        groups = list(groups.values())
+
+        os.makedirs(os.path.join(output_dir, 'tiff_tiles'))
+        downloader = TileDownloader(client, os.path.join(output_dir, 'tiff_tiles'), max_transfers=args.workers)
+        downloader.prefetch([(id, quads.at[id, 'link']) for group in groups for id in group[0].tile_ids])
+
+        def save_group(group):
+            tile_filenames = [downloader.fetch(id, quads.at[id, 'link']).result() for id in group[0].tile_ids]
+            return len(save_chip_set(group, tile_filenames, writer, polygons))
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            saved = sum(executor.map(save_group, groups))
+        downloader.shutdown()
+
+    return {'polygons': len(gdf), 'chips': len(jobs), 'saved': saved, 'tile_sets': len(groups), 'requests': api.requests, 'downloaded_bytes': api.bytes_sent}
+
+
+def bench_vectorize(output_dir:str) -> dict:
+    # the dummy model predicts the ground truth mask of every chip, with noisy logits
+    gdf, quad_ids = world()
+    polygons = ChipPolygons(gdf['geometry'].values)
+    jobs = compile_chip_jobs(gdf, quads_frame(quad_ids, grid=grid))
+    rng = np.random.default_rng(args.seed)
+
+    model_seconds = 0
+    vectorize_seconds = 0
+    n_chips = 0
+    predicted = []
+    for job in jobs:
+        windows = window_jobs([job]) if args.native_windows else [job]
+        job_polygons = []
+        for window in windows:
+            start = time.perf_counter()
+            pred_logits = rasterize_mask(window, polygons).astype(np.float32) * 8 - 4 + rng.normal(0, 1, (512, 512)).astype(np.float32)
+            model_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            margins = window_margins(job, window.window) if window.window is not None else None
+            job_polygons.extend(vectorize_prediction(pred_logits, window, 0.5, margins))
+            vectorize_seconds += time.perf_counter() - start
+            n_chips += 1
+
+        start = time.perf_counter()
+        if len(windows) > 1:
+            stitched = shapely.get_parts(shapely.unary_union(shapely.make_valid(np.array(job_polygons, dtype=object))))
+            job_polygons = [poly for poly in stitched if poly.geom_type == 'Polygon']
+        predicted.append(shapely.MultiPolygon(job_polygons))
+        vectorize_seconds += time.perf_counter() - start
+
+    gdf_pred = gdf[['id']].set_geometry(predicted, crs=gdf.crs)
+    gdf_pred.to_file(os.path.join(output_dir, 'predicted.gpkg'), driver='GPKG')
+    return {'polygons': len(gdf), 'chips': n_chips, 'predicted_polygons': int(shapely.get_num_geometries(np.array(predicted)).sum()),
+            'model_seconds': model_seconds, 'vectorize_seconds': vectorize_seconds}
+
+
+def bench_temporal(output_dir:str) -> dict:
+    gdf, _ = world()
+    predictions = synthetic_predictions(gdf, range(2016, 2025), seed=args.seed)
+    postprocessed = temporal_filter(predictions)
+    for year, dataset in postprocessed.items():
+        dataset.to_file(os.path.join(output_dir, 'predicted_{}_postprocessed.gpkg'.format(year)), driver='GPKG')
+    return {'polygons': sum(len(dataset) for dataset in predictions.values()), 'kept': sum(len(dataset) for dataset in postprocessed.values())}
+
+
+def directory_size(directory:str) -> (int, int):
+    n_files, n_bytes = 0, 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(root, filename))
+    return n_files, n_bytes
+
+
+def current_rss() -> int:
+    # the resident memory of this process in bytes, which is only available on Linux
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def stage_process(function, output_dir:str, connection):
+    try:
+        start_rss = current_rss()
+        start = time.perf_counter()
+        metrics = function(output_dir)
+        metrics['seconds'] = time.perf_counter() - start
+        # the peak resident memory of this process, which is reported in KB on Linux
+        metrics['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        metrics['start_rss_mb'] = start_rss / 2**20 if start_rss is not None else None
+        metrics['files'], metrics['bytes'] = directory_size(output_dir)
+    except Exception as e:
+        metrics = {'error': repr(e)}
+    connection.send(metrics)
+    connection.close()
+
+
+def run_stage(name:str, function) -> dict:
+    """
+    Runs a stage in a forked process with an empty output directory, and returns its metrics,
+    so the peak memory of every stage is measured separately.
+    """
+
+    output_dir = os.path.join(args.output_dir, name)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_process, args=(function, output_dir, sender))
+    process.start()
+    sender.close()
+    try:
+        metrics = receiver.recv()
+    except EOFError:
+        metrics = {'error': 'stage process exited with code {}'.format(process.exitcode)}
+    process.join()
+    return metrics
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+functions = {'search': bench_search, 'resolve': bench_resolve, 'chips': bench_chips, 'vectorize': bench_vectorize, 'temporal': bench_temporal}
+
+print('Generating synthetic world with {} polygons'.format(args.n_polygons))
+world_metrics = run_stage('world', bench_world)
+if 'error' in world_metrics:
+    print('Generating the synthetic world failed:', world_metrics['error'])
+    sys.exit(1)
+print('{} quads, {} of them written by this run'.format(world_metrics['quads'], world_metrics['written_quads']))
+
+results = {}
+for stage in stages:
+    print('Benchmarking', stage)
+    results[stage] = run_stage(stage, functions[stage])
+    if 'error' in results[stage]:
+        print('  failed:', results[stage]['error'])
+    else:
+        print('  {:.2f} s, {:.0f} MB peak RSS, {} files, {:.1f} MB written'.format(results[stage]['seconds'], results[stage]['peak_rss_mb'],
+                                                                               results[stage]['files'], results[stage]['bytes'] / 2**20))
+
+report = {
+    'timestamp': datetime.now(timezone.utc).isoformat(),
+    'commit': git_commit(),
+    'host': platform.node(),
+    'python': platform.python_version(),
+    'cpus': os.cpu_count(),
+    'params': vars(args),
+    'world': world_metrics,
+    'stages': results,
+}
+os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+with open(args.report, 'a') as file:
+    file.write(json.dumps(report) + '\n')
+print('Results appended to', args.report)
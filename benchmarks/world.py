@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+import cv2
+
+from quads import QuadGrid
+from utils import get_bbox_batch
+
+'''
+This script contains a synthetic world for the benchmarks, which is imported into benchmarks/pipeline.py.
+It generates mining polygons with realistic sizes which are clustered into mining districts, quad GeoTIFFs on the NICFI quad grid below them,
+and serves both through a local stub of the Planet basemaps API, so the pipeline can be run without a Planet account or network access.
+'''
+
+MOSAIC_ID = 'benchmark_mosaic_id'
+MOSAIC_NAME = 'benchmark_mosaic'
+# the region of the world, in the middle of the NICFI area
+WORLD_BOUNDS = (20.0, -5.0, 21.0, -4.0)
+# roughly 111 km per degree, used for turning areas into radii
+KM_PER_DEGREE = 111.32
+
+
+def synthetic_mines(n_polygons:int, n_districts:int=None, bounds:tuple=WORLD_BOUNDS, seed:int=2023) -> gpd.geodataframe.GeoDataFrame:
+    """
+    Returns synthetic mining polygons in the same format as the ground truth dataset after preprocessing, i.e. with 'id', 'bbox' and 'geometry'.
+    The polygons are clustered into mining districts, whose members are scattered normally around the district center,
+    and their areas follow a lognormal distribution with a median of 0.05 km², so most polygons are small and a few are very large open-pit mines.
+
+    Parameters
+    -------------
+
+    n_polygons: The number of polygons.
+    type: int
+    values: Any positive integer.
+    default: No default value.
+
+    n_districts: The number of mining districts.
+    type: int
+    values: Any positive integer.
+    default: One district per 50 polygons.
+
+    bounds: The region the district centers are located in, as (minx, miny, maxx, maxy) in degrees.
+    type: tuple
+    values: Any inside the NICFI area.
+    default: (20.0, -5.0, 21.0, -4.0)
+
+    seed: The seed of the random number generator.
+    type: int
+    values: Any.
+    default: 2023
+
+    Example
+    -------------
+
+    from benchmarks.world import synthetic_mines
+    gdf = synthetic_mines(2000)
+    """
+
+    rng = np.random.default_rng(seed)
+    n_districts = n_districts if n_districts is not None else max(1, n_polygons // 50)
+    minx, miny, maxx, maxy = bounds
+
+    districts = np.stack([rng.uniform(minx + 0.1, maxx - 0.1, n_districts), rng.uniform(miny + 0.1, maxy - 0.1, n_districts)], axis=1)
+    members = rng.integers(0, n_districts, n_polygons)
+    centers = districts[members] + rng.normal(0, 0.03, (n_polygons, 2))
+    centers[:, 0] = np.clip(centers[:, 0], minx, maxx)
+    centers[:, 1] = np.clip(centers[:, 1], miny, maxy)
+
+    areas = np.minimum(rng.lognormal(np.log(0.05), 1.5, n_polygons), 50)
+    radii = np.sqrt(areas / np.pi) / KM_PER_DEGREE
+
+    # star shaped polygons with irregular outlines
+    n_vertices = 32
+    angles = np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    ring_radii = radii[:, None] * rng.uniform(0.6, 1, (n_polygons, n_vertices))
+    rings = np.stack([centers[:, [0]] + ring_radii*np.cos(angles), centers[:, [1]] + ring_radii*np.sin(angles)], axis=2)
+    polygons = shapely.polygons(np.concatenate([rings, rings[:, :1]], axis=1))
+
+    gdf = gpd.GeoDataFrame({'id': np.arange(n_polygons)}, geometry=polygons, crs='EPSG:4326')
+    gdf['bbox'] = get_bbox_batch(gdf['geometry'].values)
+    return gdf
+
+
+def synthetic_predictions(gdf:gpd.geodataframe.GeoDataFrame, years:list, seed:int=2023) -> dict:
+    """
+    Returns synthetic predicted polygons of several years, by moving the given polygons slightly every year,
+    dropping some of them and adding some spurious ones, which the temporal filter is supposed to remove.
+    """
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = gdf.total_bounds
+    predictions = {}
+    for year in years:
+        kept = gdf[rng.uniform(size=len(gdf)) > 0.1]
+        geometries = shapely.transform(kept.geometry.values, lambda coords: coords + rng.normal(0, 1e-4, 2))
+
+        n_spurious = len(gdf) // 20
+        spurious = shapely.buffer(shapely.points(rng.uniform(minx, maxx, n_spurious), rng.uniform(miny, maxy, n_spurious)), 0.002)
+        predictions[str(year)] = gpd.GeoDataFrame(geometry=np.concatenate([geometries, spurious]), crs='EPSG:4326')
+    return predictions
+
+
+def quads_frame(quad_ids, api_url:str=None, grid:QuadGrid=None) -> pd.DataFrame:
+    """
+    Returns the given quads in the same format as QuadCatalog.quads_frame, calculated on the quad grid,
+    with the download links of the stub API if its url is given.
+    """
+
+    grid = grid if grid is not None else QuadGrid()
+    quad_ids = list(quad_ids)
+    x, y = grid.parse_quad_id(quad_ids)
+    bounds = grid.quad_bounds(x, y)
+    quads = pd.DataFrame(bounds, index=pd.Index(quad_ids, name='quad_id'), columns=['minx', 'miny', 'maxx', 'maxy'])
+    quads['link'] = [download_url(api_url, id) for id in quad_ids] if api_url is not None else None
+    return quads
+
+
+def download_url(api_url:str, quad_id:str) -> str:
+    return '{}/{}/quads/{}/full'.format(api_url, MOSAIC_ID, quad_id)
+
+
+def write_quads(quad_ids, directory:str, seed:int=2023, grid:QuadGrid=None) -> int:
+    """
+    Writes a synthetic four band uint16 GeoTIFF of 4096x4096 pixels for every given quad which does not exist yet,
+    georeferenced the same way as the NICFI quads. The images are smooth noise, which compresses similarly to satellite images.
+    Returns the number of written quads.
+
+    Parameters
+    -------------
+
+    quad_ids: The ids of the quads.
+    type: list
+    values: Any.
+    default: No default value.
+
+    directory: The directory the quads are written to, as '<quad id>.tiff'.
+    type: str
+    values: Any.
+    default: No default value.
+
+    seed: The seed of the random number generator, which is combined with the quad id.
+    type: int
+    values: Any.
+    default: 2023
+
+    Example
+    -------------
+
+    write_quads(np.unique(np.concatenate(grid.quads_for_bounds(shapely.bounds(gdf['bbox'].values)))), './data/benchmark/world/quads')
+    """
+
+    grid = grid if grid is not None else QuadGrid()
+    os.makedirs(directory, exist_ok=True)
+    written = 0
+    for quad_id in quad_ids:
+        path = os.path.join(directory, '{}.tiff'.format(quad_id))
+        if os.path.isfile(path):
+            continue
+
+        x, y = grid.parse_quad_id([quad_id])
+        rng = np.random.default_rng([seed, int(x[0]), int(y[0])])
+        coarse = rng.uniform(0, 3000, (64, 64, 4)).astype(np.float32)
+        image = cv2.resize(coarse, dsize=(grid.quad_pixels, grid.quad_pixels), interpolation=cv2.INTER_CUBIC)
+        image = np.clip(image, 0, 65535).astype(np.uint16).transpose(2, 0, 1)
+
+        # writing to a temporary file first, so an interrupted run never leaves an incomplete quad
+        profile = dict(driver='GTiff', width=grid.quad_pixels, height=grid.quad_pixels, count=4, dtype='uint16', crs='EPSG:3857',
+                       transform=grid.quad_transform(int(x[0]), int(y[0])), compress='deflate', predictor=2, tiled=False)
+        with rasterio.open(path + '.tmp', 'w', **profile) as dst:
+            dst.write(image)
+        os.replace(path + '.tmp', path)
+        written += 1
+
+    return written
+
+
+class StubPlanetAPI:
+    """
+    A local stub of the Planet basemaps API, serving a single mosaic made of the quads in a directory.
+    It answers mosaic lookups, paginated quad searches by bbox, single quad requests, and quad downloads including HTTP Range requests,
+    in the same format as the Planet API, and counts the requests and bytes it served.
+
+    Parameters
+    -------------
+
+    quad_dir: The directory containing the quads as '<quad id>.tiff'.
+    type: str
+    values: Any.
+    default: No default value.
+
+    latency: The delay of every response in seconds, simulating the round trip to the Planet API.
+    type: float
+    values: Any.
+    default: 0
+
+    page_size: The maximum number of quads per page of a search.
+    type: int
+    values: Any positive integer.
+    default: 50
+
+    Example
+    -------------
+
+    from benchmarks.world import StubPlanetAPI
+    with StubPlanetAPI('./data/benchmark/world/quads') as api:
+        client.get_json(api.url, params={'name__is': MOSAIC_NAME})
+
+    """
+
+    def __init__(self, quad_dir:str, latency:float=0, page_size:int=50):
+        self.quad_dir = quad_dir
+        self.latency = latency
+        self.page_size = page_size
+        self.grid = QuadGrid()
+        self.quad_ids = set(name[:-len('.tiff')] for name in os.listdir(quad_dir) if name.endswith('.tiff'))
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._server.handle_error = self._handle_error
+        self.url = 'http://127.0.0.1:{}/basemaps/v1/mosaics'.format(self._server.server_address[1])
+        self._thread = None
+
+
+    def _handle_error(self, request, client_address):
+        # clients closing the connection during a download, e.g. when a stage is interrupted, are not an error of the stub
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self._server, request, client_address)
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def item(self, quad_id:str) -> dict:
+        x, y = self.grid.parse_quad_id([quad_id])
+        return {'id': quad_id, 'bbox': self.grid.quad_bounds(x, y)[0].tolist(), '_links': {'download': download_url(self.url, quad_id)}}
+
+
+    def _send(self, handler:BaseHTTPRequestHandler, status:int, body:bytes, content_type:str='application/json', headers:dict=None):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self._lock:
+            self.bytes_sent += len(body)
+
+
+    def _handle(self, handler:BaseHTTPRequestHandler):
+        with self._lock:
+            self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        url = urlparse(handler.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        base = urlparse(self.url).path
+        parts = url.path[len(base):].strip('/').split('/') if url.path.startswith(base) else None
+
+        if parts == ['']:
+            mosaics = [{'id': MOSAIC_ID, 'name': MOSAIC_NAME}] if params.get('name__is') == MOSAIC_NAME else []
+            return self._send(handler, 200, json.dumps({'mosaics': mosaics}).encode())
+
+        if parts is None or len(parts) < 2 or parts[0] != MOSAIC_ID or parts[1] != 'quads':
+            return self._send(handler, 404, b'{}')
+
+        if len(parts) == 2:
+            # searching all quads intersecting the bbox, which are paginated like the Planet API
+            bounds = [float(value) for value in params['bbox'].split(',')]
+            quad_ids = [id for id in self.grid.quads_for_bounds([bounds])[0] if id in self.quad_ids]
+            page = int(params.get('page', 0))
+            items = [self.item(id) for id in quad_ids[page * self.page_size:(page + 1) * self.page_size]]
+            links = {}
+            if (page + 1) * self.page_size < len(quad_ids):
+                links['_next'] = '{}/{}/quads?{}'.format(self.url, MOSAIC_ID, urlencode({'bbox': params['bbox'], 'page': page + 1}))
+            return self._send(handler, 200, json.dumps({'items': items, '_links': links}).encode())
+
+        quad_id = parts[2]
+        if quad_id not in self.quad_ids:
+            return self._send(handler, 404, b'{}')
+
+        if len(parts) == 3:
+            return self._send(handler, 200, json.dumps(self.item(quad_id)).encode())
+
+        with open(os.path.join(self.quad_dir, '{}.tiff'.format(quad_id)), 'rb') as file:
+            data = file.read()
+        byte_range = handler.headers.get('Range')
+        if byte_range is not None:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                return self._send(handler, 416, b'')
+            return self._send(handler, 206, data[start:], 'image/tiff', {'Content-Range': 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data))})
+        return self._send(handler, 200, data, 'image/tiff')
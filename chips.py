@@ -0,0 +1,389 @@
+import time
+import resource
+import numpy as np
+import rasterio
+import rasterio.merge
+import rasterio.features
+import rasterio.transform
+from rasterio.enums import Resampling
+import cv2
+import shapely
+
+from jobs import ChipJob, ChipPolygons
+
+'''
+This script contains the CPU-bound part of the segmentation dataset generation, i.e. reading, scaling and encoding image chips and rasterizing segmentation masks,
+which is imported into segmentation_dataset_generation.py.
+These functions only receive jobs, file names and the writer of the output format, so they can be run by worker threads as well as by worker processes.
+They return the checksums of all written chips, so the calling process can record them in the manifest of the run.
+'''
+
+# the polygons used for segmentation masks of the current worker process by their keys, set by init_worker
+_polygons = {}
+
+
+def init_worker(polygons:dict):
+    """
+    Initializes a worker process of a process pool, by storing the polygons used for segmentation masks once per process,
+    instead of sending them along with every job. Jobs refer to these polygons by their keys.
+
+    Parameters
+    -------------
+
+    polygons: The polygons of all sets segmentation masks are created for, by any key.
+    type: dict
+    values: A dict of jobs.ChipPolygons.
+    default: No default value.
+
+    Example
+    -------------
+
+    from concurrent.futures import ProcessPoolExecutor
+    from chips import init_worker
+    executor = ProcessPoolExecutor(max_workers=64, initializer=init_worker, initargs=({'2019/train': polygons},))
+
+    """
+
+    global _polygons
+    _polygons = polygons
+
+
+# the side length, number of bands and bytes per band of the pixels of a quad
+QUAD_SIZE = 4096
+QUAD_BANDS = 4
+QUAD_ITEMSIZE = 2
+
+
+def estimate_read_memory(job:ChipJob, tile_size:int=QUAD_SIZE, bands:int=QUAD_BANDS, itemsize:int=QUAD_ITEMSIZE) -> int:
+    """
+    Returns the estimated memory in bytes GDAL needs for reading the bbox of a job from its tiles.
+    Tiles stored in strips are decoded at full resolution, even if the bbox is read at a reduced resolution,
+    so every row of the bbox is decoded for the whole width of every tile it overlaps.
+    Tiles with internal tiles and overviews, e.g. after converting them with cog.convert_to_cog, need less, so this is an upper bound for them.
+
+    Parameters
+    -------------
+
+    job: The job of the polygon.
+    type: jobs.ChipJob
+    values: Any.
+    default: No default value.
+
+    tile_size: The side length of the tiles in pixels.
+    type: int
+    values: Any.
+    default: 4096
+
+    bands: The number of bands of the tiles.
+    type: int
+    values: Any.
+    default: 4
+
+    itemsize: The number of bytes per band of a pixel.
+    type: int
+    values: Any.
+    default: 2
+
+    Example
+    -------------
+
+    memory = estimate_read_memory(jobs[0])
+    """
+
+    # parts of the bbox outside the mosaic are filled with zeros, and not read from any tile
+    top, bottom = max(job.y_offset, 0), min(job.y_offset + job.bbox_size, job.y_tiles * tile_size)
+    left, right = max(job.x_offset, 0), min(job.x_offset + job.bbox_size, job.x_tiles * tile_size)
+    if bottom <= top or right <= left:
+        return 0
+
+    columns = (right - 1) // tile_size - left // tile_size + 1
+    return (bottom - top) * columns * tile_size * bands * itemsize
+
+
+def estimate_memory(jobs:list, masks:bool=False, chip_size:int=512, supersampling:int=1) -> int:
+    """
+    Returns the estimated peak memory in bytes needed for saving the chips of the given jobs, which are saved one after another,
+    i.e. the estimated memory of the job which needs the most.
+    Reading a job needs memory depending on its tiles and bbox size, as estimated by estimate_read_memory. The image chip is always read at chip_size,
+    and the segmentation mask is rasterized at chip_size times the supersampling factor, so neither depends on the size of the bbox.
+
+    Parameters
+    -------------
+
+    jobs: The jobs of the polygons.
+    type: list
+    values: A list of jobs.ChipJob.
+    default: No default value.
+
+    masks: States if segmentation masks are created for the jobs.
+    type: bool
+    values: True or False.
+    default: False
+
+    chip_size: The side length of the image chips in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    supersampling: The factor the segmentation masks are rasterized larger by.
+    type: int
+    values: Any positive integer.
+    default: 1
+
+    Example
+    -------------
+
+    budget.acquire(estimate_memory(my_jobs, masks=True))
+    """
+
+    # four float64 color channels of the chip, and if needed the supersampled uint8 mask and the mask scaled down to chip_size
+    image = 4 * 8 * chip_size**2
+    chip = image + ((chip_size * supersampling)**2 + 2 * chip_size**2 if masks else 0)
+    return chip + max((estimate_read_memory(job) for job in jobs), default=0)
+
+
+def read_chip(tiles:list, x_offset:int, y_offset:int, bbox_size:int, chip_size:int=512) -> np.ndarray:
+    """
+    Reads a square window of the mosaic formed by the given tiles, without merging the whole mosaic.
+    Only the pixels inside the window are read from every tile, and windows larger than chip_size are read at a reduced resolution,
+    so the result always has a size of chip_size x chip_size. Parts of the window outside the tiles are filled with zeros.
+    If the tiles have overviews, e.g. after converting them with cog.convert_to_cog, GDAL reads reduced resolution windows from the closest overview.
+
+    Parameters
+    -------------
+
+    tiles: The opened tiles forming the mosaic.
+    type: list
+    values: A list of rasterio datasets.
+    default: No default value.
+
+    x_offset: The x axis offset of the window in pixels of the mosaic.
+    type: int
+    values: Any.
+    default: No default value.
+
+    y_offset: The y axis offset of the window in pixels of the mosaic, counting from top to bottom.
+    type: int
+    values: Any.
+    default: No default value.
+
+    bbox_size: The side length of the window in pixels of the mosaic.
+    type: int
+    values: Any.
+    default: No default value.
+
+    chip_size: The side length of the returned chip in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    Example
+    -------------
+
+    rgb = read_chip(tiles, 1024, 512, 2048)
+    """
+
+    # the upper left corner of the mosaic and its resolution, in the coordinate system of the tiles
+    left = min(tile.bounds.left for tile in tiles)
+    top = max(tile.bounds.top for tile in tiles)
+    res = tiles[0].res[0]
+
+    window_left = left + x_offset * res
+    window_top = top - y_offset * res
+    window_size = bbox_size * res
+
+    # we have got four color channels, red, green, blue, and NIR
+    # using bicubic interpolation when reading at a reduced resolution
+    chip, _ = rasterio.merge.merge(tiles, bounds=(window_left, window_top - window_size, window_left + window_size, window_top),
+                                   res=window_size / chip_size, indexes=[1,2,3,4], resampling=Resampling.cubic)
+    return chip
+
+
+def rasterize_mask(job:ChipJob, polygons:ChipPolygons, chip_size:int=512) -> np.ndarray:
+    """
+    Rasterizes the primary polygon of a job and all secondary polygons inside its bbox into a segmentation mask of zeros and ones,
+    directly at chip_size instead of at the size of the bbox. The polygons are clipped to the bbox first, and all of them are rasterized at once.
+    If the polygons are supersampled, the mask is rasterized larger and every pixel is set if most of its area is covered.
+    The mask has the same orientation as the image chips, i.e. its first axis is the x axis.
+
+    Parameters
+    -------------
+
+    job: The job of the polygon.
+    type: jobs.ChipJob
+    values: Any.
+    default: No default value.
+
+    polygons: The polygons of the set, and their supersampling factor.
+    type: jobs.ChipPolygons
+    values: Any.
+    default: No default value.
+
+    chip_size: The side length of the mask in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    Example
+    -------------
+
+    mask = rasterize_mask(jobs[0], ChipPolygons(gdf['geometry'].values, supersampling=4))
+    """
+
+    clipped, bounds = polygons.clip_to_bbox(job)
+    size = chip_size * polygons.supersampling
+
+    # the pixels of the mask have the same positions as the pixels of the image chip, which is read from the same bounds
+    transform = rasterio.transform.from_bounds(*bounds, size, size)
+    # clipping can split polygons into several parts, and leave lines or points along the borders of the bbox, which are not rasterized
+    parts = shapely.get_parts(clipped)
+    parts = parts[(shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)]
+    # supersampled masks are rasterized as 255, so their coverage can be averaged without leaving uint8
+    value = 255 if polygons.supersampling > 1 else 1
+    if len(parts) == 0:
+        target = np.zeros((size, size), 'uint8')
+    else:
+        target = rasterio.features.rasterize(parts, out_shape=(size, size), transform=transform, fill=0, default_value=value, dtype='uint8')
+
+    if polygons.supersampling > 1:
+        coverage = cv2.resize(target, dsize=(chip_size, chip_size), interpolation=cv2.INTER_AREA)
+        target = (coverage >= 128).astype('uint8')
+
+    return target.T
+
+
+def save_chip(job:ChipJob, tiles:list, writer, polygons:ChipPolygons=None) -> list:
+    """
+    Saves the image of a single polygon read from its already opened tiles, and optionally its segmentation mask.
+    Returns the manifest entries of the written chips as (kind, polygon id, path, checksum, size) tuples if everything was saved, and None otherwise.
+
+    Parameters
+    -------------
+
+    job: The job of the polygon, as compiled by compile_chip_jobs.
+    type: jobs.ChipJob
+    values: Any.
+    default: No default value.
+
+    tiles: The opened tiles the polygon is located on.
+    type: list
+    values: A list of rasterio datasets.
+    default: No default value.
+
+    writer: The writer of the output format, which also states if a segmentation mask is created.
+    type: chipstore.PngChipWriter or chipstore.ShardedChipWriter
+    values: Any.
+    default: No default value.
+
+    polygons: The polygons of the set, used for finding the secondary polygons inside the primary polygons bbox.
+    type: jobs.ChipPolygons or str
+    values: The polygons, or their key in the polygons passed to init_worker.
+    default: None, only needed if the writer creates segmentation masks.
+
+    Example
+    -------------
+
+    save_chip(jobs[0], tiles, PngChipWriter('./data/segmentation/2019/img_dir/train', './data/segmentation/2019/ann_dir/train'), polygons)
+    """
+
+    try:
+        # only the primary polygons bbox is read from the tiles, already scaled down to 512x512 if needed
+        rgb_resized = read_chip(tiles, job.x_offset, job.y_offset, job.bbox_size)
+        rgb_resized = rgb_resized.T
+
+        target_resized = None
+        if writer.masks:
+            # turning the primary polygon and all secondary polygons inside its bbox into a target array of zeros and ones of size 512x512
+            if isinstance(polygons, str):
+                polygons = _polygons[polygons]
+            target_resized = rasterize_mask(job, polygons)
+
+        return writer.write(job, 255*rgb_resized, target_resized)
+
+    except OSError as e:
+        print('Caught OSError', e, 'on polygon', job.name)
+
+    except FloatingPointError as e:
+        print('Caught normalization error caused by empty color channel on polygon', job.name)
+        print(e)
+
+    except cv2.error:
+        print('Caught error caused by empty color channel on polygon', job.name)
+
+    except Exception as e:
+        print('Caught', e, 'on polygon', job.name)
+
+    return None
+
+
+def save_chip_set(jobs:list, tile_filenames:list, writer, polygons:ChipPolygons=None) -> list:
+    """
+    Saves the images and optionally segmentation masks of all polygons located on the same set of tiles,
+    by opening their tiles once, before the tiles are closed.
+    Returns a list with the manifest entries of every polygon which was saved, as returned by save_chip.
+
+    Parameters
+    -------------
+
+    jobs: The jobs of the polygons, which all need to be located on the same tiles.
+    type: list
+    values: A list of jobs.ChipJob.
+    default: No default value.
+
+    tile_filenames: The file names of the downloaded tiles.
+    type: list
+    values: Any.
+    default: No default value.
+
+    writer: The writer of the output format, which also states if segmentation masks are created.
+    type: chipstore.PngChipWriter or chipstore.ShardedChipWriter
+    values: Any.
+    default: No default value.
+
+    polygons: The polygons of the set, used for finding the secondary polygons inside the primary polygons bbox.
+    type: jobs.ChipPolygons or str
+    values: The polygons, or their key in the polygons passed to init_worker.
+    default: None, only needed if the writer creates segmentation masks.
+
+    Example
+    -------------
+
+    save_chip_set([jobs[0], jobs[4]], ['./data/tiff_tiles/2019/1080-1019.tiff'], PngChipWriter('./data/segmentation/2019/img_dir/train'))
+    """
+
+    try:
+        # tiles are written atomically, so they are always complete once they exist
+        tiles = [rasterio.open(filename) for filename in tile_filenames]
+
+    except Exception as e:
+        print('Caught', e, 'on polygons', [job.name for job in jobs])
+        return []
+
+    try:
+        saved = [save_chip(job, tiles, writer, polygons) for job in jobs]
+        return [entries for entries in saved if entries is not None]
+
+    finally:
+        # Closing the tiff files to free up memory
+        for img in tiles:
+            img.close()
+
+
+def save_chip_set_with_usage(jobs:list, tile_filenames:list, writer, polygons:ChipPolygons=None) -> (list, dict):
+    """
+    Saves the chips of a tile set like save_chip_set, and additionally returns the resources used by the calling thread or worker process,
+    i.e. the 'seconds' it took, the 'cpu_seconds' of the thread, and the 'peak_rss' in bytes the process has used so far.
+    The peak memory is the one of the whole process, which is shared by all worker threads if the chips are not saved by worker processes.
+
+    Example
+    -------------
+
+    saved, usage = save_chip_set_with_usage([jobs[0], jobs[4]], ['./data/tiff_tiles/2019/1080-1019.tiff'], PngChipWriter('./data/segmentation/2019/img_dir/train'))
+    """
+
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    saved = save_chip_set(jobs, tile_filenames, writer, polygons)
+    # ru_maxrss is given in kilobytes on Linux
+    usage = {'seconds': time.perf_counter() - start, 'cpu_seconds': time.thread_time() - cpu_start,
+             'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    return saved, usage
@@ -0,0 +1,367 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import cv2
+
+from jobs import ChipJob
+from utils import local_to_global_bounds
+
+'''
+This script contains the output formats of the image chips and segmentation masks, which is imported into segmentation_dataset_generation.py and gpkg_dataset_generation.py.
+Chips are either written as loose .png files, which is the format MMSegmentation trains on,
+or packed into shards of fixed size uint8 records with an index, which can be read without copying using memory mapping.
+Both writers only hold their settings, so they can be sent to worker processes.
+'''
+
+CHIP_FORMATS = ['png', 'shards']
+
+
+def to_uint8(image:np.ndarray) -> np.ndarray:
+    """
+    Converts an image chip to the uint8 pixels gpkg_dataset_generation.py and MMSegmentation read, which is the same conversion for all output formats.
+    uint16 images are scaled down by dropping their low byte, as OpenCV does when reading 16 bit .png files as 8 bit images,
+    and all other images are rounded and clipped to 0 to 255, as cv2.imwrite does when writing them as .png.
+
+    Parameters
+    -------------
+
+    image: The image chip.
+    type: np.ndarray
+    values: Any numeric array.
+    default: No default value.
+
+    Example
+    -------------
+
+    pixels = to_uint8(255*rgb_resized)
+    """
+
+    if image.dtype == np.uint16:
+        return (image >> 8).astype(np.uint8)
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+def write_png(path:str, array:np.ndarray) -> (str, int):
+    """
+    Encodes an array as .png and writes it atomically, so a chip which exists is always complete, even if the run was interrupted.
+    Returns the sha256 checksum and the size of the written file, or None if the array could not be encoded.
+
+    Parameters
+    -------------
+
+    path: The path of the .png file.
+    type: str
+    values: Any.
+    default: No default value.
+
+    array: The image.
+    type: np.ndarray
+    values: Any array cv2 can encode as .png.
+    default: No default value.
+
+    Example
+    -------------
+
+    checksum, size = write_png('./data/segmentation/2019/img_dir/train/1867.png', image)
+    """
+
+    encoded, buffer = cv2.imencode('.png', array)
+    if not encoded:
+        return None
+
+    data = buffer.tobytes()
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+
+class PngChipWriter:
+    """
+    Writes every image chip and segmentation mask as a separate .png file named after the chip, i.e. the polygon id and for windows of large bboxes the window index.
+    Images are converted by to_uint8 and written as 8 bit .png files, so they hold the same pixels as the records of ShardedChipWriter.
+
+    Parameters
+    -------------
+
+    img_dir: The directory the images are saved to.
+    type: str
+    values: Any.
+    default: No default value.
+
+    ann_dir: The directory the segmentation masks are saved to, or None if no segmentation masks are created.
+    type: str
+    values: Any.
+    default: None
+
+    Example
+    -------------
+
+    from chipstore import PngChipWriter
+    writer = PngChipWriter('./data/segmentation/2019/img_dir/train', './data/segmentation/2019/ann_dir/train')
+    entries = writer.write(job, image, mask)
+
+    """
+
+    # the kinds of the manifest entries of images and segmentation masks
+    image_kind, mask_kind = 'image', 'mask'
+
+    def __init__(self, img_dir:str, ann_dir:str=None):
+        self.img_dir = img_dir
+        self.ann_dir = ann_dir
+
+
+    @property
+    def masks(self) -> bool:
+        return self.ann_dir is not None
+
+
+    def write(self, job:ChipJob, image:np.ndarray, mask:np.ndarray=None) -> list:
+        """
+        Writes the image and optionally the segmentation mask of a polygon.
+        Returns the manifest entries of the written files as (kind, chip name, path, checksum, size) tuples, or None if writing failed.
+        """
+
+        img_path = '{}/{}.png'.format(self.img_dir, job.name)
+        written = write_png(img_path, to_uint8(image))
+        if written is None:
+            print("Failed to save image of polygon", job.name)
+            return None
+        entries = [(self.image_kind, job.name, img_path, *written)]
+
+        if mask is not None:
+            ann_path = '{}/{}.png'.format(self.ann_dir, job.name)
+            written = write_png(ann_path, mask)
+            if written is None:
+                print("Failed to save segmentation mask of polygon", job.name)
+                return None
+            entries.append((self.mask_kind, job.name, ann_path, *written))
+
+        return entries
+
+
+
+def write_record(path:str, data:bytes):
+    """
+    Appends a record to a shard file and flushes it to disk.
+    """
+
+    with open(path, 'ab') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# the shards which are currently written, by the directory of their store and the process writing them, since forked processes inherit this dict
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+class ShardedChipWriter:
+    """
+    Appends image chips and segmentation masks to shards of fixed size uint8 records, each with an index of the chip names and their georeferencing.
+    Every process writes to its own shards, so worker processes never write to the same file,
+    and a shard is only extended by whole records, whose index entry is written after the record itself.
+
+    Parameters
+    -------------
+
+    directory: The directory of the chip store.
+    type: str
+    values: Any.
+    default: No default value.
+
+    masks: States if segmentation masks are stored next to the images.
+    type: bool
+    values: True or False.
+    default: False
+
+    chip_size: The side length of the chips in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    shard_size: The maximum number of records per shard.
+    type: int
+    values: Any positive integer.
+    default: 1024
+
+    Example
+    -------------
+
+    from chipstore import ShardedChipWriter
+    writer = ShardedChipWriter('./data/segmentation/2019/chips/train', masks=True)
+    entries = writer.write(job, image, mask)
+
+    """
+
+    # the kinds of the manifest entries of images and segmentation masks, which differ from the ones of .png files
+    image_kind, mask_kind = 'shard_image', 'shard_mask'
+
+    def __init__(self, directory:str, masks:bool=False, chip_size:int=512, shard_size:int=1024):
+        self.directory = directory
+        self.masks = masks
+        self.chip_size = chip_size
+        self.shard_size = shard_size
+
+
+    def write(self, job:ChipJob, image:np.ndarray, mask:np.ndarray=None) -> list:
+        """
+        Appends the image and optionally the segmentation mask of a polygon to the current shard of this process.
+        Returns the manifest entries of the records as (kind, chip name, shard file, checksum, size, offset) tuples, or None if writing failed.
+        The records are flushed to disk before they are returned, so a record in the manifest is never lost by a crash.
+        """
+
+        # the same conversion as the .png files of PngChipWriter
+        image = to_uint8(image)
+        if image.shape != (self.chip_size, self.chip_size, 4) or (self.masks and mask is None):
+            print("Failed to save chip of polygon", job.name, "with shape", image.shape)
+            return None
+
+        image_bytes = np.ascontiguousarray(image).tobytes()
+        if self.masks:
+            mask_bytes = np.ascontiguousarray(mask, dtype=np.uint8).tobytes()
+
+        bounds = local_to_global_bounds(job.x_offset, job.y_offset, job.bbox_size, job.tile_bboxes).bounds
+        record = {'name': job.name, 'id': job.id, 'window': job.window, 'bounds': list(bounds), 'mosaic_bbox': list(job.mosaic_bbox), 'x_tiles': job.x_tiles, 'y_tiles': job.y_tiles,
+                  'x_offset': job.x_offset, 'y_offset': job.y_offset, 'bbox_size': job.bbox_size}
+
+        with _shards_lock:
+            shard = _shards.get((self.directory, os.getpid()))
+            if shard is None or shard['records'] >= self.shard_size:
+                # a new shard is named after this process and a random suffix, so reruns never append to shards of another run
+                os.makedirs(self.directory, exist_ok=True)
+                name = os.path.join(self.directory, '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8]))
+                shard = {'name': name, 'records': 0}
+                if self.masks:
+                    # the masks file exists from the start, so readers can tell a record whose mask was not written yet
+                    open(name + '.masks', 'ab').close()
+                _shards[(self.directory, os.getpid())] = shard
+
+            # the manifest entries point to the records inside the shard files, so reruns can check that they were completely written
+            entries = [(self.image_kind, job.name, shard['name'] + '.images', hashlib.sha256(image_bytes).hexdigest(), len(image_bytes),
+                        shard['records'] * len(image_bytes))]
+            write_record(shard['name'] + '.images', image_bytes)
+            if self.masks:
+                entries.append((self.mask_kind, job.name, shard['name'] + '.masks', hashlib.sha256(mask_bytes).hexdigest(), len(mask_bytes),
+                                shard['records'] * len(mask_bytes)))
+                write_record(shard['name'] + '.masks', mask_bytes)
+
+            record['record'] = shard['records']
+            write_record(shard['name'] + '.index.jsonl', (json.dumps(record) + '\n').encode())
+            shard['records'] += 1
+
+        return entries
+
+
+
+class ChipStore:
+    """
+    Reads a chip store written by ShardedChipWriter. Images and segmentation masks are returned as read-only views of memory mapped shards,
+    so they are only read from disk once they are used. Chips are looked up by their name, i.e. the polygon id and for windows of large bboxes the window index.
+    If a chip was written multiple times, e.g. by a rerun, its latest record is used.
+
+    Parameters
+    -------------
+
+    directory: The directory of the chip store.
+    type: str
+    values: Any.
+    default: No default value.
+
+    chip_size: The side length of the chips in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    Example
+    -------------
+
+    from chipstore import ChipStore
+    store = ChipStore('./data/segmentation/2019/chips/train')
+    for name, image, mask in store.items():
+        ...
+
+    """
+
+    def __init__(self, directory:str, chip_size:int=512):
+        self.directory = directory
+        self.chip_size = chip_size
+        self._maps = {}
+
+        shards = [name[:-len('.index.jsonl')] for name in os.listdir(directory) if name.endswith('.index.jsonl')] if os.path.isdir(directory) else []
+        # older shards first, so the latest record of every polygon is kept
+        shards.sort(key=lambda shard: os.path.getmtime(os.path.join(directory, shard + '.index.jsonl')))
+
+        records = []
+        for shard in shards:
+            n_records = os.path.getsize(os.path.join(directory, shard + '.images')) // (4 * chip_size**2)
+            # the mask of a record is written after its image, so a record is only complete once both are written
+            masks_path = os.path.join(directory, shard + '.masks')
+            if os.path.isfile(masks_path):
+                n_records = min(n_records, os.path.getsize(masks_path) // chip_size**2)
+            with open(os.path.join(directory, shard + '.index.jsonl')) as file:
+                for line in file:
+                    # records whose data was not completely written are skipped
+                    if line.endswith('\n'):
+                        record = json.loads(line)
+                        if record['record'] < n_records:
+                            record['shard'] = shard
+                            # records of shards written before windows existed only hold the polygon id
+                            record.setdefault('name', str(record['id']))
+                            records.append(record)
+
+        self.index = pd.DataFrame(records, columns=['name', 'id', 'window', 'shard', 'record', 'bounds', 'mosaic_bbox', 'x_tiles', 'y_tiles', 'x_offset', 'y_offset', 'bbox_size'])
+        self.index = self.index.drop_duplicates('name', keep='last').set_index('name')
+
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+    def _map(self, shard:str, kind:str) -> np.ndarray:
+        if (shard, kind) not in self._maps:
+            path = os.path.join(self.directory, '{}.{}'.format(shard, kind))
+            if not os.path.isfile(path):
+                self._maps[(shard, kind)] = None
+            else:
+                shape = (self.chip_size, self.chip_size, 4) if kind == 'images' else (self.chip_size, self.chip_size)
+                n_records = os.path.getsize(path) // int(np.prod(shape))
+                self._maps[(shard, kind)] = np.memmap(path, dtype=np.uint8, mode='r', shape=(n_records, *shape))
+        return self._maps[(shard, kind)]
+
+
+    def image(self, name:str) -> np.ndarray:
+        """
+        Returns the image of a chip as array of shape (chip_size, chip_size, 4), in the same channel order as the .png images.
+        """
+
+        shard, record = self.index.at[str(name), 'shard'], self.index.at[str(name), 'record']
+        return self._map(shard, 'images')[record]
+
+
+    def mask(self, name:str) -> np.ndarray:
+        """
+        Returns the segmentation mask of a chip as array of shape (chip_size, chip_size), or None if the store has no segmentation masks.
+        """
+
+        shard, record = self.index.at[str(name), 'shard'], self.index.at[str(name), 'record']
+        masks = self._map(shard, 'masks')
+        return None if masks is None else masks[record]
+
+
+    def items(self):
+        """
+        Yields the name, image, and segmentation mask of every chip in the store, ordered by shard and record.
+        """
+
+        for name, row in self.index.sort_values(['shard', 'record']).iterrows():
+            masks = self._map(row['shard'], 'masks')
+            yield name, self._map(row['shard'], 'images')[row['record']], None if masks is None else masks[row['record']]
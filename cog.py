@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+'''
+This script contains the conversion of downloaded quads to Cloud-Optimized GeoTIFFs, which is imported into downloads.py.
+The quads are rewritten with internal tiles, lossless compression and overviews, so windowed reads of chips only decode the blocks they need,
+and chips of large bboxes, which are read at a reduced resolution, are read from the overviews instead of the full resolution quad.
+'''
+
+OVERVIEW_FACTORS = (2, 4, 8)
+
+
+def convert_to_cog(src_path:str, dst_path:str, blocksize:int=512, overview_factors:tuple=OVERVIEW_FACTORS, compress:str='deflate'):
+    """
+    Rewrites a GeoTIFF as Cloud-Optimized GeoTIFF, i.e. with internal tiles, lossless compression, and overviews stored in front of the full resolution image.
+    The converted file is written to a temporary file first and renamed to dst_path once it is complete, so dst_path is always a complete file.
+    src_path and dst_path may be the same file.
+
+    Parameters
+    -------------
+
+    src_path: The path of the GeoTIFF.
+    type: str
+    values: Any.
+    default: No default value.
+
+    dst_path: The path the Cloud-Optimized GeoTIFF is written to.
+    type: str
+    values: Any.
+    default: No default value.
+
+    blocksize: The side length of the internal tiles in pixels.
+    type: int
+    values: Any multiple of 16.
+    default: 512
+
+    overview_factors: The factors the overviews are downscaled by.
+    type: tuple
+    values: Any powers of two.
+    default: (2, 4, 8)
+
+    compress: The lossless compression of the tiles.
+    type: str
+    values: 'deflate', 'lzw', or 'zstd', if supported by GDAL.
+    default: 'deflate'
+
+    Example
+    -------------
+
+    convert_to_cog('./data/tiff_tiles/2019/1080-1019.tiff.raw', './data/tiff_tiles/2019/1080-1019.tiff')
+    """
+
+    with rasterio.open(src_path) as src:
+        # horizontal differencing makes the compression of integer images much more effective
+        predictor = 2 if np.issubdtype(np.dtype(src.dtypes[0]), np.integer) else 3
+        options = dict(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize, compress=compress, predictor=predictor,
+                       interleave='pixel', bigtiff='IF_SAFER')
+
+        # the overviews are built in a tiled copy first, since GDAL can only place existing overviews in front of the image while copying
+        tiled_path = dst_path + '.tiled.tmp'
+        profile = src.profile.copy()
+        profile.update(options)
+        with rasterio.open(tiled_path, 'w', **profile) as tiled:
+            tiled.write(src.read())
+            # averaging the pixels, which is the same as downscaling them for the chips of large bboxes
+            tiled.build_overviews(list(overview_factors), Resampling.average)
+            tiled.update_tags(ns='rio_overview', resampling='average')
+
+    try:
+        temp_path = dst_path + '.cog.tmp'
+        rasterio.shutil.copy(tiled_path, temp_path, copy_src_overviews=True, **options)
+        os.replace(temp_path, dst_path)
+    finally:
+        os.remove(tiled_path)
+
+
+def is_cog(path:str, overview_factors:tuple=OVERVIEW_FACTORS) -> bool:
+    """
+    Returns True if a GeoTIFF has internal tiles and all given overviews, i.e. it does not need to be converted again.
+
+    Parameters
+    -------------
+
+    path: The path of the GeoTIFF.
+    type: str
+    values: Any.
+    default: No default value.
+
+    overview_factors: The factors of the overviews it needs to have.
+    type: tuple
+    values: Any.
+    default: (2, 4, 8)
+
+    Example
+    -------------
+
+    if not is_cog(filename):
+        convert_to_cog(filename, filename)
+    """
+
+    with rasterio.open(path) as src:
+        return src.profile.get('tiled', False) and set(overview_factors) <= set(src.overviews(1))
@@ -0,0 +1,233 @@
+import os
+import numpy as np
+import geopandas as gpd
+import pyproj
+import shapely
+
+'''
+This script contains a spatial index for assigning countries and equal-area areas to polygons, which is imported into all three scripts.
+Instead of intersecting every polygon with every country, candidate countries are looked up in an STRtree and only these are tested using prepared geometries.
+The country dataset is serialized into a compact index file next to it on first use, so later runs do not need to parse the shapefile again.
+'''
+
+# NaturalEarth country dataset
+# https://www.naturalearthdata.com/http//www.naturalearthdata.com/download/10m/cultural/ne_10m_admin_0_countries.zip
+NATURAL_EARTH_PATH = './data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+# Interrupted Goode Homolosine, an equal-area projection
+EQUAL_AREA_CRS = '+proj=igh +lon_0=0 +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs +type=crs'
+
+
+class CountryLookup:
+    """
+    Assigns the country name and iso3 code of the country every polygon intersects with.
+    If a polygon intersects with multiple countries, either the last of these countries in the country dataset is used, like the scripts always did,
+    or the country which has the largest overlap with the polygon.
+
+    Parameters
+    -------------
+
+    geometries: The country geometries in EPSG:4326.
+    type: np.ndarray
+    values: An array of shapely polygons or multipolygons.
+    default: No default value.
+
+    names: The country names.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    iso_codes: The iso3 codes of the countries.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from countries import CountryLookup
+    countries = CountryLookup.from_file()
+    gdf['ISO3_CODE'], gdf['COUNTRY_NAME'] = countries.lookup(gdf['geometry'].values)
+
+    """
+
+    def __init__(self, geometries:np.ndarray, names:np.ndarray, iso_codes:np.ndarray):
+        self.geometries = np.asarray(geometries)
+        self.names = np.asarray(names, dtype=object)
+        self.iso_codes = np.asarray(iso_codes, dtype=object)
+
+        # countries are large and detailed, so preparing them speeds up every intersection test against them
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+
+    @classmethod
+    def from_file(cls, path:str=NATURAL_EARTH_PATH, name_column:str='NAME', iso_column:str='ISO_A3', index_path:str=None):
+        """
+        Loads the country index which belongs to the given country dataset, or builds and saves it if it does not exist or is outdated.
+
+        Parameters
+        -------------
+
+        path: The path of the country dataset.
+        type: str
+        values: Any file readable by geopandas.
+        default: './data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+        name_column: The column of the country names.
+        type: str
+        values: Any.
+        default: 'NAME'
+
+        iso_column: The column of the iso3 codes.
+        type: str
+        values: Any.
+        default: 'ISO_A3'
+
+        index_path: The path of the serialized country index.
+        type: str
+        values: Any.
+        default: The path of the country dataset with the suffix _index.npz.
+
+        Example
+        -------------
+
+        countries = CountryLookup.from_file('./data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp')
+
+        """
+
+        if index_path is None:
+            index_path = os.path.splitext(path)[0] + '_index.npz'
+
+        # the index is rebuilt whenever the country dataset changes
+        source_stat = os.stat(path)
+        source_key = np.array([source_stat.st_size, source_stat.st_mtime_ns], dtype=np.int64)
+
+        if os.path.isfile(index_path):
+            try:
+                with np.load(index_path) as index:
+                    if np.array_equal(index['source_key'], source_key) and index['columns'].tolist() == [name_column, iso_column]:
+                        return cls._from_index(index)
+            except (OSError, KeyError, ValueError) as e:
+                print('Caught', e, 'while loading the country index, rebuilding it')
+
+        print('Building country index from', path)
+        countries = gpd.read_file(path, columns=[name_column, iso_column]).to_crs('EPSG:4326')
+        lookup = cls(countries.geometry.values, countries[name_column].values, countries[iso_column].values)
+        lookup.save(index_path, source_key=source_key, columns=[name_column, iso_column])
+
+        return lookup
+
+
+    @classmethod
+    def _from_index(cls, index):
+        wkb = index['wkb'].tobytes()
+        offsets = index['wkb_offsets']
+        geometries = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+
+        return cls(geometries, index['names'], index['iso_codes'])
+
+
+    def save(self, path:str, **metadata):
+        """
+        Saves the countries as one flat WKB buffer with offsets, which can be loaded without parsing the country dataset or unpickling any objects.
+        """
+
+        wkb = shapely.to_wkb(self.geometries)
+        offsets = np.concatenate([[0], np.cumsum([len(geom) for geom in wkb])])
+
+        # writing to a temporary file of this process first, so concurrently running scripts never read or write a partially written index
+        temp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(temp_path, wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), wkb_offsets=offsets,
+                 names=self.names.astype(str), iso_codes=self.iso_codes.astype(str), **metadata)
+        os.replace(temp_path, path)
+
+
+    def lookup(self, polygons, largest_overlap:bool=False) -> (np.ndarray, np.ndarray):
+        """
+        Returns the iso3 codes and names of the countries the polygons are located in, which are nan for polygons outside of any country.
+
+        Parameters
+        -------------
+
+        polygons: The polygons in EPSG:4326.
+        type: np.ndarray or geopandas.array.GeometryArray
+        values: Any.
+        default: No default value.
+
+        largest_overlap: States if polygons intersecting multiple countries are assigned the country with the largest overlap,
+        instead of the last of these countries in the country dataset.
+        type: bool
+        values: True or False.
+        default: False
+
+        Example
+        -------------
+
+        iso_codes, names = countries.lookup(gdf['geometry'].values, largest_overlap=True)
+
+        """
+
+        polygons = np.asarray(polygons)
+
+        # candidates are all countries whose bbox intersects the polygons bbox, which are then tested against the prepared country
+        poly_ids, country_ids = self.tree.query(polygons)
+        intersecting = shapely.intersects(self.geometries[country_ids], polygons[poly_ids])
+        poly_ids, country_ids = poly_ids[intersecting], country_ids[intersecting]
+
+        # sorting the matches of every polygon, so the chosen country is the last one
+        if largest_overlap:
+            overlap = shapely.area(shapely.intersection(self.geometries[country_ids], polygons[poly_ids]))
+            order = np.lexsort((country_ids, overlap, poly_ids))
+        else:
+            order = np.lexsort((country_ids, poly_ids))
+        poly_ids, country_ids = poly_ids[order], country_ids[order]
+        last = np.append(poly_ids[1:] != poly_ids[:-1], True) if len(poly_ids) > 0 else np.array([], dtype=bool)
+
+        iso_codes = np.full(len(polygons), np.nan, dtype=object)
+        names = np.full(len(polygons), np.nan, dtype=object)
+        iso_codes[poly_ids[last]] = self.iso_codes[country_ids[last]]
+        names[poly_ids[last]] = self.names[country_ids[last]]
+
+        return iso_codes, names
+
+
+
+def equal_area(polygons, crs:str='EPSG:4326', area_crs:str=EQUAL_AREA_CRS) -> np.ndarray:
+    """
+    Returns the area of every polygon in square meters, by projecting only the polygon coordinates into an equal-area projection,
+    instead of copying and reprojecting a whole GeoDataFrame.
+
+    Parameters
+    -------------
+
+    polygons: The polygons.
+    type: np.ndarray or geopandas.array.GeometryArray
+    values: Any.
+    default: No default value.
+
+    crs: The coordinate reference system of the polygons.
+    type: str
+    values: Any crs understood by pyproj.
+    default: 'EPSG:4326'
+
+    area_crs: The equal-area coordinate reference system the areas are calculated in.
+    type: str
+    values: Any crs understood by pyproj.
+    default: Interrupted Goode Homolosine
+
+    Example
+    -------------
+
+    from countries import equal_area
+    gdf['area'] = equal_area(gdf.geometry.values)
+
+    """
+
+    transformer = pyproj.Transformer.from_crs(crs, area_crs, always_xy=True)
+
+    def project(coords:np.ndarray) -> np.ndarray:
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.stack([x, y], axis=1)
+
+    return shapely.area(shapely.transform(np.asarray(polygons), project))
@@ -0,0 +1,200 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from planet import PlanetClient
+from manifest import RunManifest
+from tilecache import TileCache
+from cog import convert_to_cog, is_cog
+
+'''
+This script contains a download manager for quads, which is imported into segmentation_dataset_generation.py.
+Every quad is downloaded at most once, even if many polygons located on it are processed at the same time,
+and downloads run in the background, so chips can already be generated while further quads are downloaded.
+'''
+
+
+class TileDownloader:
+    """
+    Downloads quads into a directory using a bounded number of concurrent transfers.
+    All threads requesting the same quad share a single future, and quads are written atomically,
+    so existing files are always complete and interrupted downloads are resumed on the next run.
+
+    Parameters
+    -------------
+
+    client: The client used for downloading, whose connection pool is reused for all transfers.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    directory: The directory the quads are saved to.
+    type: str
+    values: Any.
+    default: No default value.
+
+    max_transfers: The maximum number of concurrent downloads.
+    type: int
+    values: Any positive integer.
+    default: 4
+
+    executor: An executor shared with other downloaders, so all of them together use at most its number of concurrent downloads.
+    It is not shut down by this downloader, and max_transfers is ignored if it is given.
+    type: concurrent.futures.ThreadPoolExecutor
+    values: Any.
+    default: None
+
+    manifest: The manifest every completed download is recorded in, with the checksum of the quad.
+    type: manifest.RunManifest
+    values: Any.
+    default: None
+
+    cache: The tile cache every completed download is registered in, which may delete quads again once its budget is exceeded.
+    type: tilecache.TileCache
+    values: Any.
+    default: None
+
+    cog: States if downloaded quads are converted to Cloud-Optimized GeoTIFFs with internal tiles, lossless compression and overviews,
+    which makes reading chips faster, especially of large bboxes. Quads which already exist are converted in place the first time they are fetched.
+    type: bool
+    values: True or False.
+    default: False
+
+    Example
+    -------------
+
+    from downloads import TileDownloader
+    downloader = TileDownloader(client, './data/tiff_tiles/2019')
+    filename = downloader.fetch(my_quad_id, my_quad_url).result()
+
+    """
+
+    def __init__(self, client:PlanetClient, directory:str, max_transfers:int=4, executor:ThreadPoolExecutor=None, manifest:RunManifest=None,
+                 cache:TileCache=None, cog:bool=False):
+        self.client = client
+        self.directory = directory
+        self.manifest = manifest
+        self.cache = cache
+        self.cog = cog
+        self._owns_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers=max_transfers) if executor is None else executor
+        self._futures = {}
+        self._lock = threading.Lock()
+
+
+    def path(self, quad_id:str) -> str:
+        """
+        Returns the path a quad is saved to.
+        """
+
+        return os.path.join(self.directory, '{}.tiff'.format(quad_id))
+
+
+    def fetch(self, quad_id:str, url:str) -> Future:
+        """
+        Starts downloading a quad unless it already exists or is being downloaded,
+        and returns a future which resolves to the path of the quad once it is downloaded, and converted if cog is set.
+
+        Parameters
+        -------------
+
+        quad_id: The id of the quad.
+        type: str
+        values: Any.
+        default: No default value.
+
+        url: The download url of the quad.
+        type: str
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        filename = downloader.fetch(my_quad_id, my_quad_url).result()
+
+        """
+
+        filename = self.path(quad_id)
+        with self._lock:
+            future = self._futures.get(quad_id)
+            # quads which were deleted by the tile cache after being downloaded are downloaded again
+            if future is not None and not (future.done() and future.exception() is None and not os.path.isfile(filename)):
+                return future
+
+            if os.path.isfile(filename) and not self.cog:
+                future = Future()
+                future.set_result(filename)
+            else:
+                # quads which were downloaded before cog was set are converted the same way as new downloads
+                download = self._convert if os.path.isfile(filename) else self._download
+                future = self._executor.submit(download, quad_id, url, filename)
+                future.add_done_callback(lambda f: self._forget_failed(quad_id, f))
+
+            self._futures[quad_id] = future
+            return future
+
+
+    def prefetch(self, quad_urls:list):
+        """
+        Starts downloading all given quads in the given order, without waiting for them.
+
+        Parameters
+        -------------
+
+        quad_urls: A list of (quad id, url) tuples.
+        type: list
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        downloader.prefetch([(id, quads.at[id, 'link']) for id in my_quad_ids])
+
+        """
+
+        for quad_id, url in quad_urls:
+            self.fetch(quad_id, url)
+
+
+    def _download(self, quad_id:str, url:str, filename:str) -> str:
+        if self.cog:
+            # the quad is only moved to filename once it is converted, and a completely downloaded quad is not downloaded again if converting it was interrupted
+            raw_filename = filename + '.raw'
+            if not os.path.isfile(raw_filename):
+                self.client.download(url, raw_filename)
+            convert_to_cog(raw_filename, filename)
+            os.remove(raw_filename)
+        else:
+            self.client.download(url, filename)
+        if self.cache is not None:
+            self.cache.add(filename)
+        if self.manifest is not None:
+            self.manifest.record('download', quad_id, filename)
+        return filename
+
+
+    def _convert(self, quad_id:str, url:str, filename:str) -> str:
+        if is_cog(filename):
+            return filename
+        convert_to_cog(filename, filename)
+        # the converted quad has a different size and checksum
+        if self.cache is not None:
+            self.cache.add(filename)
+        if self.manifest is not None:
+            self.manifest.record('download', quad_id, filename)
+        return filename
+
+
+    def _forget_failed(self, quad_id:str, future:Future):
+        # failed downloads are forgotten, so they are retried the next time they are requested
+        if future.exception() is not None:
+            with self._lock:
+                if self._futures.get(quad_id) is future:
+                    del self._futures[quad_id]
+
+
+    def shutdown(self):
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,353 @@
+from dataclasses import dataclass, replace
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from utils import get_bbox_batch, count_tiles_batch, global_to_local_coords_batch, local_to_global_bounds, check_if_inside_bbox_batch
+from quads import tile_bboxes_batch
+
+'''
+This script contains immutable per-polygon job records, which are imported into segmentation_dataset_generation.py and gpkg_dataset_generation.py.
+The GeoDataFrame is compiled into one job per polygon before any worker is started, so workers only read their job and return results,
+instead of reading and writing the shared GeoDataFrame from multiple threads.
+'''
+
+
+@dataclass(frozen=True, slots=True)
+class ChipJob:
+    """
+    Everything needed for producing the image chip of a single polygon, i.e. the tiles forming its mosaic and the position of its bbox on this mosaic.
+
+    Parameters
+    -------------
+
+    id: The id of the polygon, used as file name of its chip.
+    type: int
+
+    tile_ids: The ids of the tiles forming the mosaic.
+    type: tuple
+
+    tile_bboxes: The bounding boxes of these tiles as (minx, miny, maxx, maxy).
+    type: tuple
+
+    mosaic_bbox: The bounding box of the mosaic as (minx, miny, maxx, maxy).
+    type: tuple
+
+    x_tiles: How many tiles wide the mosaic is.
+    type: int
+
+    y_tiles: How many tiles high the mosaic is.
+    type: int
+
+    x_offset: The x axis offset of the polygons bbox on the mosaic in pixels.
+    type: int
+
+    y_offset: The y axis offset of the polygons bbox on the mosaic in pixels.
+    type: int
+
+    bbox_size: The sidelength of the polygons bbox in pixels, which is a multiple of 512.
+    type: int
+
+    window: The index of the window if the job is one of the native resolution windows of a larger bbox, as created by window_jobs, and None otherwise.
+    type: int
+
+    """
+
+    id: int
+    tile_ids: tuple
+    tile_bboxes: tuple
+    mosaic_bbox: tuple
+    x_tiles: int
+    y_tiles: int
+    x_offset: int
+    y_offset: int
+    bbox_size: int
+    window: int = None
+
+
+    @property
+    def name(self) -> str:
+        """
+        The name of the chip, i.e. its file name and manifest key, which is the polygon id followed by the window index for windows.
+        """
+
+        return str(self.id) if self.window is None else '{}_{}'.format(self.id, self.window)
+
+
+
+def compile_chip_jobs(gdf:gpd.geodataframe.GeoDataFrame, quads:pd.DataFrame) -> list:
+    """
+    Compiles a job for every polygon of the GeoDataFrame in a single pass, in the order of its rows.
+    Every polygon needs to be located on at least one tile.
+
+    Parameters
+    -------------
+
+    gdf: A GeoDataFrame with the columns 'id' and 'tile_ids', and optionally 'bbox'.
+    type: geopandas.geodataframe.GeoDataFrame
+    values: A valid GeoDataFrame.
+    default: No default value.
+
+    quads: A DataFrame of quads as returned by QuadCatalog.quads_frame.
+    type: pandas.core.frame.DataFrame
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from jobs import compile_chip_jobs
+    jobs = compile_chip_jobs(gdf_train, quads)
+
+    """
+
+    tile_bboxes, tile_offsets = tile_bboxes_batch(quads, gdf['tile_ids'])
+    mosaic_bboxes, x_tile_counters, y_tile_counters = count_tiles_batch(tile_bboxes, tile_offsets)
+
+    bboxes = gdf['bbox'].values if 'bbox' in gdf.columns else get_bbox_batch(gdf['geometry'].values)
+    x_bbox, y_bbox, bbox_offsets = global_to_local_coords_batch(bboxes, mosaic_bboxes, x_tile_counters, y_tile_counters, is_bbox=True)
+
+    # the bbox corners, in the same order as they were used before jobs were compiled
+    starts = bbox_offsets[:-1]
+    x_offsets = x_bbox[starts+2].astype(int)
+    y_offsets = y_bbox[starts].astype(int)
+    bbox_sizes = (x_bbox[starts+1] - x_bbox[starts+3]).astype(int)
+
+    jobs = []
+    for i, (id, tile_ids) in enumerate(zip(gdf['id'], gdf['tile_ids'])):
+        jobs.append(ChipJob(
+            id=int(id),
+            tile_ids=tuple(np.array(tile_ids, ndmin=1).tolist()),
+            tile_bboxes=tuple(map(tuple, tile_bboxes[tile_offsets[i]:tile_offsets[i+1]].tolist())),
+            mosaic_bbox=tuple(mosaic_bboxes[i].tolist()),
+            x_tiles=int(x_tile_counters[i]),
+            y_tiles=int(y_tile_counters[i]),
+            x_offset=int(x_offsets[i]),
+            y_offset=int(y_offsets[i]),
+            bbox_size=int(bbox_sizes[i]),
+        ))
+
+    return jobs
+
+
+# the number of pixels neighbouring windows of a large bbox overlap by, so predictions can be stitched without seams
+WINDOW_OVERLAP = 64
+
+
+def window_starts(bbox_size:int, chip_size:int=512, overlap:int=WINDOW_OVERLAP) -> np.ndarray:
+    """
+    Returns the offsets of the windows along one side of a bbox, relative to the bbox. The last window ends at the border of the bbox,
+    so it may overlap its neighbour by more than the overlap.
+
+    Parameters
+    -------------
+
+    bbox_size: The sidelength of the bbox in pixels.
+    type: int
+    values: Any multiple of chip_size.
+    default: No default value.
+
+    chip_size: The sidelength of the windows in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    overlap: The minimum number of pixels neighbouring windows overlap by.
+    type: int
+    values: Any smaller than chip_size.
+    default: 64
+
+    Example
+    -------------
+
+    window_starts(1536)
+    """
+
+    stride = chip_size - overlap
+    n_windows = int(np.ceil(max(bbox_size - chip_size, 0) / stride)) + 1
+    return np.minimum(np.arange(n_windows) * stride, bbox_size - chip_size)
+
+
+def window_jobs(jobs:list, chip_size:int=512, overlap:int=WINDOW_OVERLAP) -> list:
+    """
+    Splits the jobs of all bboxes larger than chip_size into overlapping windows of chip_size x chip_size at the native resolution of the tiles.
+    The windows of a bbox are numbered row by row from its upper left corner, so the same bbox always results in the same window indices.
+    Jobs of bboxes which are not larger than chip_size are kept as they are.
+
+    Parameters
+    -------------
+
+    jobs: The jobs of the polygons, as compiled by compile_chip_jobs.
+    type: list
+    values: A list of ChipJob.
+    default: No default value.
+
+    chip_size: The sidelength of the windows in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    overlap: The minimum number of pixels neighbouring windows overlap by.
+    type: int
+    values: Any smaller than chip_size.
+    default: 64
+
+    Example
+    -------------
+
+    from jobs import compile_chip_jobs, window_jobs
+    jobs = window_jobs(compile_chip_jobs(gdf_train, quads))
+
+    """
+
+    windows = []
+    for job in jobs:
+        if job.bbox_size <= chip_size:
+            windows.append(job)
+            continue
+
+        starts = window_starts(job.bbox_size, chip_size, overlap)
+        for row, y_start in enumerate(starts):
+            for col, x_start in enumerate(starts):
+                windows.append(replace(job, x_offset=job.x_offset + int(x_start), y_offset=job.y_offset + int(y_start),
+                                       bbox_size=chip_size, window=row * len(starts) + col))
+    return windows
+
+
+def window_margins(job:ChipJob, window:int, chip_size:int=512, overlap:int=WINDOW_OVERLAP) -> (int, int, int, int):
+    """
+    Returns the part of a window of a job which is used when stitching the predictions of all its windows, as (left, top, right, bottom) in pixels of the window.
+    A quarter of the overlap is cut off at every side which borders another window, since predictions are least reliable close to the borders of a chip,
+    while the remaining parts of neighbouring windows still overlap, so the stitched prediction has no gaps.
+
+    Parameters
+    -------------
+
+    job: The job of the whole bbox, as compiled by compile_chip_jobs.
+    type: ChipJob
+    values: Any.
+    default: No default value.
+
+    window: The index of the window.
+    type: int
+    values: Any.
+    default: No default value.
+
+    chip_size: The sidelength of the windows in pixels.
+    type: int
+    values: Any.
+    default: 512
+
+    overlap: The minimum number of pixels neighbouring windows overlap by.
+    type: int
+    values: Any smaller than chip_size.
+    default: 64
+
+    Example
+    -------------
+
+    left, top, right, bottom = window_margins(job, 3)
+    """
+
+    n_windows = len(window_starts(job.bbox_size, chip_size, overlap))
+    row, col = divmod(window, n_windows)
+    margin = overlap // 4
+
+    left = margin if col > 0 else 0
+    top = margin if row > 0 else 0
+    right = chip_size - margin if col < n_windows - 1 else chip_size
+    bottom = chip_size - margin if row < n_windows - 1 else chip_size
+    return left, top, right, bottom
+
+
+def parse_chip_name(name:str) -> (int, int):
+    """
+    Returns the polygon id and window index of a chip name as given by ChipJob.name, where the window index is None for chips of whole bboxes.
+
+    Parameters
+    -------------
+
+    name: The name of the chip, e.g. its file name without extension.
+    type: str
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    id, window = parse_chip_name('1867_4')
+    """
+
+    id, _, window = str(name).partition('_')
+    return int(id), int(window) if window else None
+
+
+
+class ChipPolygons:
+    """
+    The polygons of a dataset split and a spatial index over them, which are shared read-only by all jobs of this split,
+    for finding all polygons which are located inside the bbox of a job.
+
+    Parameters
+    -------------
+
+    geometries: The polygons.
+    type: np.ndarray or geopandas.array.GeometryArray
+    values: Any.
+    default: No default value.
+
+    supersampling: The factor the segmentation masks of this split are rasterized larger by, before they are scaled down to the chip size,
+    so pixels which are only partly covered by polygons are set if most of them is covered.
+    type: int
+    values: Any positive integer, 1 for no supersampling.
+    default: 1
+
+    Example
+    -------------
+
+    from jobs import ChipPolygons
+    polygons = ChipPolygons(gdf_train['geometry'].values)
+    clipped = polygons.clip_to_bbox(jobs[0])
+
+    """
+
+    __slots__ = ('geometries', 'tree', 'supersampling')
+
+    def __init__(self, geometries, supersampling:int=1):
+        self.geometries = np.asarray(geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self.supersampling = supersampling
+
+
+    def clip_to_bbox(self, job:ChipJob) -> (np.ndarray, tuple):
+        """
+        Returns the outlines of all polygons located inside the bbox of a job as polygons clipped to this bbox, and the bounds of the bbox.
+        Since some polygons are located closely to each other, also secondary polygons partly located inside the bbox are returned,
+        if more than two of their points are located inside it. Holes of the polygons are filled, the same as for the primary polygons.
+        Windows of large bboxes often contain no point of the polygons they are located in, so for windows all polygons intersecting them are returned,
+        including the primary polygon.
+        """
+
+        bbox = local_to_global_bounds(job.x_offset, job.y_offset, job.bbox_size, job.tile_bboxes)
+        if job.window is not None:
+            # the filled outlines are tested, so windows inside holes are covered like the holes of whole bboxes
+            outlines = shapely.polygons(shapely.get_exterior_ring(self.geometries[np.sort(self.tree.query(bbox))]))
+            outlines = outlines[shapely.intersects(outlines, bbox)]
+            return shapely.clip_by_rect(outlines, *bbox.bounds), bbox.bounds
+
+        # getting all polygons whose bboxes intersect the bbox from the spatial index
+        candidates = self.geometries[np.sort(self.tree.query(bbox))]
+        n_candidates = len(candidates)
+
+        # calculating the position of these polygons on the tile/mosaic of the job in a single pass
+        x, y, offsets = global_to_local_coords_batch(candidates, [job.mosaic_bbox] * n_candidates, [job.x_tiles] * n_candidates, [job.y_tiles] * n_candidates)
+        poly_ids = np.repeat(np.arange(n_candidates), np.diff(offsets))
+
+        #we will only count polygons which have more than two points inside the bbox
+        poly_positions = check_if_inside_bbox_batch(x, y, job.x_offset, job.y_offset, job.bbox_size)
+        in_bbox = np.bincount(poly_ids, weights=poly_positions, minlength=n_candidates) > 2
+
+        # clipping the outlines of all these polygons to the bbox at once, instead of moving their points outside the bbox onto its borders
+        outlines = shapely.polygons(shapely.get_exterior_ring(candidates[in_bbox]))
+        return shapely.clip_by_rect(outlines, *bbox.bounds), bbox.bounds
@@ -0,0 +1,232 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+'''
+This script contains a per-year completion manifest, which is imported into segmentation_dataset_generation.py.
+Every finished step of a run, i.e. mosaic lookups, downloaded tiles, and saved chips and segmentation masks, is appended to the manifest with the checksum of its file,
+so an interrupted or preempted run can be restarted, skips all completed work, and reports what remains.
+'''
+
+
+def file_checksum(path:str, chunk_size:int=2**20) -> str:
+    """
+    Returns the sha256 checksum of a file.
+
+    Parameters
+    -------------
+
+    path: The path of the file.
+    type: str
+    values: Any.
+    default: No default value.
+
+    chunk_size: The number of bytes read at once.
+    type: int
+    values: Any positive integer.
+    default: 1048576
+
+    Example
+    -------------
+
+    checksum = file_checksum('./data/tiff_tiles/2019/1080-1019.tiff')
+    """
+
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def record_checksum(path:str, offset:int, size:int) -> str:
+    """
+    Returns the sha256 checksum of a record of size bytes at offset inside a file.
+
+    Example
+    -------------
+
+    checksum = record_checksum('./data/segmentation/2019/chips/train/1234-0a1b2c3d.images', 3 * 4 * 512**2, 4 * 512**2)
+    """
+
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return hashlib.sha256(file.read(size)).hexdigest()
+
+
+class RunManifest:
+    """
+    An append-only log of the completed steps of the runs for a year, stored in SQLite.
+    Every entry consists of its kind, e.g. 'download', 'image', or 'mask', a key, e.g. a quad or polygon id, and optionally a file with its checksum and size.
+    Entries of records inside a larger file, e.g. a shard of a chip store, also hold the offset of the record in the file.
+    If a step is recorded multiple times, the latest entry is used. The manifest can be shared by multiple threads.
+
+    Parameters
+    -------------
+
+    path: The path of the SQLite file, which is created if it does not exist.
+    type: str
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from manifest import RunManifest
+    manifest = RunManifest('./data/segmentation/2019/manifest.sqlite')
+    manifest.record('image', '1867', './data/segmentation/2019/img_dir/test/1867.png', checksum, size)
+    done = manifest.completed('image', ['1867', '2720'])
+
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                            kind TEXT NOT NULL,
+                                            key TEXT NOT NULL,
+                                            path TEXT,
+                                            checksum TEXT,
+                                            size INTEGER,
+                                            recorded REAL NOT NULL,
+                                            file_offset INTEGER)''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_kind_key ON entries (kind, key)')
+            # manifests written before records had offsets are extended
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(entries)')]
+            if 'file_offset' not in columns:
+                self._connection.execute('ALTER TABLE entries ADD COLUMN file_offset INTEGER')
+
+
+    def record(self, kind:str, key:str, path:str=None, checksum:str=None, size:int=None, offset:int=None):
+        """
+        Appends a completed step to the manifest. If a path is given without checksum, the checksum and size of the file are calculated.
+
+        Parameters
+        -------------
+
+        kind: The kind of the step.
+        type: str
+        values: Any, e.g. 'mosaic', 'download', 'image', or 'mask'.
+        default: No default value.
+
+        key: The key of the step, e.g. the id of a quad or polygon.
+        type: str
+        values: Any.
+        default: No default value.
+
+        path: The path of the file written by the step.
+        type: str
+        values: Any.
+        default: None
+
+        checksum: The sha256 checksum of the file.
+        type: str
+        values: Any.
+        default: None
+
+        size: The size of the file in bytes, or of the record if an offset is given.
+        type: int
+        values: Any.
+        default: None
+
+        offset: The offset in bytes of the record in the file, if the step wrote a record inside a larger file.
+        type: int
+        values: Any.
+        default: None
+
+        Example
+        -------------
+
+        manifest.record('download', quad_id, filename)
+
+        """
+
+        if path is not None and checksum is None:
+            checksum, size = file_checksum(path), os.path.getsize(path)
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT INTO entries (kind, key, path, checksum, size, recorded, file_offset) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (kind, str(key), path, checksum, size, time.time(), offset))
+
+
+    def record_many(self, entries:list):
+        """
+        Appends many completed steps at once, as (kind, key, path, checksum, size) or (kind, key, path, checksum, size, offset) tuples.
+        """
+
+        rows = [(kind, str(key), path, checksum, size, time.time(), offset[0] if offset else None) for kind, key, path, checksum, size, *offset in entries]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT INTO entries (kind, key, path, checksum, size, recorded, file_offset) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+    def get(self, kind:str, key:str):
+        """
+        Returns the latest entry of a step as (path, checksum, size) tuple, or None if the step has not been completed yet.
+        """
+
+        with self._lock:
+            return self._connection.execute('SELECT path, checksum, size FROM entries WHERE kind = ? AND key = ? ORDER BY rowid DESC LIMIT 1',
+                                            (kind, str(key))).fetchone()
+
+
+    def completed(self, kind:str, keys:list, verify:bool=False) -> set:
+        """
+        Returns the keys of all given steps which have been completed, and whose files still exist with the recorded size.
+        Records inside a larger file count as completed if the file still holds all of their bytes.
+
+        Parameters
+        -------------
+
+        kind: The kind of the steps.
+        type: str
+        values: Any.
+        default: No default value.
+
+        keys: The keys of the steps.
+        type: list
+        values: Any.
+        default: No default value.
+
+        verify: States if the checksums of the files are calculated again and compared to the recorded ones, which requires reading every file.
+        type: bool
+        values: True or False.
+        default: False
+
+        Example
+        -------------
+
+        saved_ids = manifest.completed('image', [job.id for job in jobs])
+
+        """
+
+        keys = set(str(key) for key in keys)
+        with self._lock:
+            # the latest entry of every step is the one with the largest rowid
+            rows = self._connection.execute('''SELECT key, path, checksum, size, file_offset FROM entries WHERE rowid IN
+                                                   (SELECT MAX(rowid) FROM entries WHERE kind = ? GROUP BY key)''', (kind,)).fetchall()
+
+        done = set()
+        for key, path, checksum, size, offset in rows:
+            if key not in keys:
+                continue
+            if path is not None and offset is not None:
+                if not os.path.isfile(path) or os.path.getsize(path) < offset + size:
+                    continue
+                if verify and record_checksum(path, offset, size) != checksum:
+                    continue
+            elif path is not None:
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    continue
+                if verify and file_checksum(path) != checksum:
+                    continue
+            done.add(key)
+        return done
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
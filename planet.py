@@ -0,0 +1,453 @@
+import email.utils
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from replay import ReplayAdapter, archive_key
+
+'''
+This script contains a rate limit aware client for the Planet API, which is imported into segmentation_dataset_generation.py and gpkg_dataset_generation.py.
+All requests of a script share a single token bucket, so as many requests can be in flight as the quota allows,
+while 429 responses and their Retry-After header pause all requests, and persistent failures trip a circuit breaker.
+Quad downloads are limited by a token bucket of their own, so they do not use up the quota of the API requests.
+'''
+
+# status codes which are worth retrying, since they are caused by rate limits or temporary server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, which limits the rate of requests shared by all threads.
+
+    Parameters
+    -------------
+
+    rate: The number of tokens added per second, i.e. the sustained number of requests per second.
+    type: float
+    values: Any positive number.
+    default: No default value.
+
+    capacity: The maximum number of tokens, i.e. the number of requests which can be sent in a burst.
+    type: int
+    values: Any positive integer.
+    default: 1
+
+    Example
+    -------------
+
+    from planet import TokenBucket
+    bucket = TokenBucket(rate=5, capacity=10)
+    bucket.acquire()
+
+    """
+
+    def __init__(self, rate:float, capacity:int=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+    def pause(self, seconds:float):
+        """
+        Stops handing out tokens to all threads for the given number of seconds, e.g. as requested by a Retry-After header.
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker, which opens after a number of consecutive failures and stays open for a cooldown period.
+    After the cooldown, requests are let through again, and a single further failure opens it again.
+
+    Parameters
+    -------------
+
+    failure_threshold: The number of consecutive failures after which the circuit breaker opens.
+    type: int
+    values: Any positive integer.
+    default: 10
+
+    cooldown: The number of seconds the circuit breaker stays open.
+    type: float
+    values: Any positive number.
+    default: 60
+
+    Example
+    -------------
+
+    from planet import CircuitBreaker
+    breaker = CircuitBreaker(failure_threshold=10, cooldown=60)
+    breaker.check()
+
+    """
+
+    def __init__(self, failure_threshold:int=10, cooldown:float=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+
+    def check(self):
+        """
+        Raises a CircuitOpenError if the circuit breaker is open.
+        """
+
+        with self._lock:
+            if self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown:
+                raise CircuitOpenError('Circuit breaker is open after {} consecutive failures.'.format(self._failures))
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None or time.monotonic() - self._opened_at >= self.cooldown:
+                    print('Opening circuit breaker for {} seconds after {} consecutive failures.'.format(self.cooldown, self._failures))
+                self._opened_at = time.monotonic()
+
+
+
+def retry_after(res:requests.Response):
+    """
+    Returns the number of seconds to wait as requested by the Retry-After header of a response, or None if there is no such header.
+    The header can either contain a number of seconds or an HTTP date.
+
+    Example
+    -------------
+
+    from planet import retry_after
+    wait = retry_after(res)
+
+    """
+
+    value = res.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+
+class PlanetClient:
+    """
+    A thread-safe client for the Planet API, which can be shared by all worker threads of a script.
+    Requests are limited by a token bucket, 429 and temporary server errors are retried using the Retry-After header
+    or a jittered exponential backoff, and a circuit breaker stops sending requests after persistent failures.
+
+    Parameters
+    -------------
+
+    api_key: The Planet API key.
+    type: str
+    values: Any.
+    default: No default value.
+
+    rate: The maximum sustained number of requests per second.
+    type: float
+    values: Any positive number.
+    default: 5
+
+    burst: The maximum number of requests which can be sent in a burst.
+    type: int
+    values: Any positive integer.
+    default: 10
+
+    max_workers: The number of worker threads which should send requests concurrently, also used as size of the connection pool.
+    type: int
+    values: Any positive integer.
+    default: 8
+
+    download_rate: The maximum sustained number of downloads started per second, which are limited separately from the API requests.
+    type: float
+    values: Any positive number.
+    default: 10
+
+    max_retries: The maximum number of attempts per request, and per download.
+    type: int
+    values: Any positive integer.
+    default: 10
+
+    backoff_base: The backoff in seconds after the first failed attempt, which doubles for every further attempt.
+    type: float
+    values: Any positive number.
+    default: 0.5
+
+    backoff_max: The maximum backoff in seconds.
+    type: float
+    values: Any positive number.
+    default: 60
+
+    failure_threshold: The number of consecutive failed attempts after which the circuit breaker opens.
+    type: int
+    values: Any positive integer.
+    default: 20
+
+    cooldown: The number of seconds the circuit breaker stays open.
+    type: float
+    values: Any positive number.
+    default: 60
+
+    archive: The path of an archive, which responses are recorded to and replayed from, or None to send all requests.
+    type: str
+    values: Any.
+    default: None
+
+    offline: States if requests whose response is not in the archive fail instead of being sent.
+    type: bool
+    values: True or False.
+    default: False
+
+    Example
+    -------------
+
+    from planet import PlanetClient
+    client = PlanetClient(PLANET_API_KEY, rate=5)
+    mosaic = client.get_json(API_URL, params={"name__is": NICFI_URLS[year]})
+
+    """
+
+    def __init__(self, api_key:str, rate:float=5, burst:int=10, max_workers:int=8, download_rate:float=10, max_retries:int=10,
+                 backoff_base:float=0.5, backoff_max:float=60, failure_threshold:int=20, cooldown:float=60, archive:str=None, offline:bool=False):
+        assert (archive is not None or not offline), "The offline mode requires an archive."
+
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate, burst)
+        self.download_bucket = TokenBucket(download_rate, max_workers)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+
+        # setup session
+        self.session = requests.Session()
+        # authenticate
+        self.session.auth = (api_key, "")
+        if archive is not None:
+            # temporary errors are not recorded, so they are retried by reruns
+            adapter = ReplayAdapter(archive, api_key, offline, RETRY_STATUS_CODES, pool_connections=max_workers, pool_maxsize=max_workers)
+        else:
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.replay = adapter if archive is not None else None
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def _backoff(self, attempt:int) -> float:
+        # full jitter, so retrying threads do not hit the API at the same time
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+
+    def get(self, url:str, params:dict=None, ok_status_codes:tuple=(), bucket:TokenBucket=None, **kwargs) -> requests.Response:
+        """
+        Sends a GET request, retrying rate limited and failed attempts.
+        Returns the response, or raises a requests.exceptions.RequestException if all attempts failed.
+
+        Parameters
+        -------------
+
+        url: The url to request.
+        type: str
+        values: Any.
+        default: No default value.
+
+        params: The query parameters of the request.
+        type: dict
+        values: Any.
+        default: None
+
+        ok_status_codes: Error status codes which should be returned instead of raising an exception, e.g. 404.
+        type: tuple
+        values: Any.
+        default: ()
+
+        bucket: The token bucket limiting the request, which is paused by 429 responses.
+        type: TokenBucket
+        values: Any.
+        default: The token bucket of the API requests.
+
+        kwargs: Further keyword arguments passed to requests.Session.get.
+
+        Example
+        -------------
+
+        res = client.get(quads_url, params=search_parameters)
+
+        """
+
+        if self.replay is not None and archive_key('GET', url, params) in self.replay:
+            # recorded responses are answered locally, so they neither count towards the rate limit nor need to be retried
+            res = self.session.get(url, params=params, **kwargs)
+            if res.status_code not in ok_status_codes:
+                res.raise_for_status()
+            return res
+
+        bucket = bucket if bucket is not None else self.bucket
+        for attempt in range(self.max_retries):
+            self.breaker.check()
+            bucket.acquire()
+
+            try:
+                res = self.session.get(url, params=params, **kwargs)
+
+                if res.status_code in RETRY_STATUS_CODES:
+                    wait = retry_after(res)
+                    if wait is not None:
+                        # the server tells us how long to wait, which applies to all threads
+                        bucket.pause(wait)
+                    else:
+                        wait = self._backoff(attempt)
+                    print(f'Caught status {res.status_code} on attempt {attempt + 1}, retrying in {wait:.2f} seconds.')
+                    res.close()
+                    # being rate limited is expected, only server errors count towards the circuit breaker
+                    if res.status_code != 429:
+                        self.breaker.record_failure()
+                    time.sleep(wait)
+                    continue
+
+                if res.status_code not in ok_status_codes:
+                    res.raise_for_status()
+                self.breaker.record_success()
+                return res
+
+            except requests.exceptions.HTTPError:
+                # other client errors will not be fixed by retrying
+                self.breaker.record_success()
+                raise
+
+            except requests.exceptions.RequestException as e:
+                wait = self._backoff(attempt)
+                print(f'Request failed on attempt {attempt + 1}: {e}')
+                self.breaker.record_failure()
+                time.sleep(wait)
+
+        raise requests.exceptions.RetryError('Max retries reached for {}'.format(url))
+
+
+    def get_json(self, url:str, params:dict=None, **kwargs) -> dict:
+        """
+        Sends a GET request like get and returns the decoded JSON response.
+
+        Example
+        -------------
+
+        mosaic = client.get_json(API_URL, params={"name__is": NICFI_URLS[year]})
+
+        """
+
+        return self.get(url, params=params, **kwargs).json()
+
+
+    def download(self, url:str, filename:str, chunk_size:int=2**20):
+        """
+        Downloads a file, e.g. a quad, by streaming it to a temporary file next to filename, which is renamed to filename once it is complete.
+        If the transfer fails, or a temporary file of a previous, interrupted download exists, the download is resumed using an HTTP Range request.
+        Downloads are limited by their own token bucket, and retried like requests.
+
+        Parameters
+        -------------
+
+        url: The url of the file.
+        type: str
+        values: Any.
+        default: No default value.
+
+        filename: The path the file is written to.
+        type: str
+        values: Any.
+        default: No default value.
+
+        chunk_size: The number of bytes written at once.
+        type: int
+        values: Any positive integer.
+        default: 1048576
+
+        Example
+        -------------
+
+        client.download(quads.at[id, 'link'], './data/tiff_tiles/{}/{}.tiff'.format(year, id))
+
+        """
+
+        part_filename = filename + '.part'
+        for attempt in range(self.max_retries):
+            offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else None
+
+            with self.get(url, stream=True, headers=headers, ok_status_codes=(416,), bucket=self.download_bucket) as res:
+                if res.status_code == 416:
+                    # the partial file does not fit the file on the server anymore, so the download is started over
+                    os.remove(part_filename)
+                    continue
+
+                # servers which do not support Range requests send the whole file again
+                mode = 'ab' if res.status_code == 206 else 'wb'
+                try:
+                    with open(part_filename, mode) as file:
+                        for chunk in res.iter_content(chunk_size=chunk_size):
+                            file.write(chunk)
+                except requests.exceptions.RequestException as e:
+                    # the received part is kept, so the next attempt only requests the rest of the file
+                    wait = self._backoff(attempt)
+                    print(f'Download failed on attempt {attempt + 1} after {os.path.getsize(part_filename)} bytes: {e!r}')
+                    self.breaker.record_failure()
+                    time.sleep(wait)
+                    continue
+
+            # renaming is atomic, so no other thread or process can read a partially written file
+            os.replace(part_filename, filename)
+            return
+
+        raise requests.exceptions.RetryError('Max retries reached for {}'.format(url))
@@ -0,0 +1,101 @@
+import geopandas as gpd
+
+'''
+This script contains the temporal filter of the predicted polygon datasets, which is imported into gpkg_dataset_postprocessing.py.
+It removes any polygons that do not have an intersecting polygon in the previous or subsequent year.
+'''
+
+
+def temporal_filter(datasets:dict, buffer_size:float=None) -> dict:
+    """
+    Removes any polygons that do not have an intersecting polygon in the previous or subsequent year.
+    The first and last year, which only have a single neighbouring year, are only compared to this year.
+    Returns the filtered datasets of all years, while the given datasets are not changed.
+
+    Parameters
+    -------------
+
+    datasets: The predicted polygons of consecutive years, by year and in the order of the years.
+    type: dict
+    values: A dict of GeoDataFrames in the same coordinate system, keyed by the years as str.
+    default: No default value.
+
+    buffer_size: The buffer added to the polygons of every year before comparing them to the neighbouring years, in units of the coordinate system,
+    or None for no buffer.
+    type: float
+    values: Any.
+    default: None
+
+    Example
+    -------------
+
+    from postprocessing import temporal_filter
+    postprocessed = temporal_filter({'2016': gdf_2016, '2017': gdf_2017, '2018': gdf_2018})
+    """
+
+    postprocessed = {}
+    for year, dataset in datasets.items():
+        postprocessed[year] = dataset.copy()
+
+    for i in range(len(datasets.keys())):
+        year = list(datasets.keys())[i]
+        print('Postprocessing', year)
+        previous_year = None
+        following_year = None
+
+        if i != 0:
+            previous_year = str(int(year) - 1)
+            postprocessed[year]['tempid'] = range(postprocessed[year].shape[0])
+
+            if buffer_size is not None:
+                # Adding a buffer for more generous postprocessing
+                buffered_current_year = postprocessed[year].copy()
+                buffered_current_year['geometry'] = buffered_current_year['geometry'].buffer(buffer_size)
+                matches_previous_year = gpd.sjoin(
+                    left_df=buffered_current_year,
+                    right_df=datasets[previous_year],
+                    how="inner"
+                ).tempid
+
+            else:
+                matches_previous_year = gpd.sjoin(
+                    left_df=postprocessed[year],
+                    right_df=datasets[previous_year],
+                    how="inner"
+                ).tempid
+
+
+        if i != len(datasets.keys())-1:
+            following_year = str(int(year) + 1)
+            postprocessed[year]['tempid'] = range(postprocessed[year].shape[0])
+
+            if buffer_size is not None:
+                # Adding a buffer for more generous postprocessing
+                buffered_current_year = postprocessed[year].copy()
+                buffered_current_year['geometry'] = buffered_current_year['geometry'].buffer(buffer_size)
+                matches_following_year = gpd.sjoin(
+                    left_df=buffered_current_year,
+                    right_df=datasets[following_year],
+                    how="inner"
+                ).tempid
+
+            else:
+                matches_following_year = gpd.sjoin(
+                    left_df=postprocessed[year],
+                    right_df=datasets[following_year],
+                    how="inner"
+                ).tempid
+
+        if (previous_year is not None) and (following_year is not None):
+            subset = [any(tup) for tup in zip(postprocessed[year].tempid.isin(matches_previous_year), postprocessed[year].tempid.isin(matches_following_year))]
+            postprocessed[year] = postprocessed[year].loc[subset].drop(columns="tempid")
+
+        elif (previous_year is not None):
+            postprocessed[year] = postprocessed[year].loc[postprocessed[year].tempid.isin(matches_previous_year)].drop(columns="tempid")
+
+        else:
+            postprocessed[year] = postprocessed[year].loc[postprocessed[year].tempid.isin(matches_following_year)].drop(columns="tempid")
+
+        postprocessed[year].reset_index(drop=True, inplace=True)
+
+    return postprocessed
@@ -0,0 +1,178 @@
+import os
+import hashlib
+import geopandas as gpd
+import shapely
+import shapely.geometry
+
+from utils import get_bbox_batch
+from countries import NATURAL_EARTH_PATH, CountryLookup
+from splits import SPLIT_SEED, VAL_FRACTION, HAND_VALIDATED_IDS, assign_splits
+
+'''
+This script contains the preprocessing of the ground truth dataset, which is imported into segmentation_dataset_generation.py and gpkg_dataset_generation.py.
+The ground truth polygons are assigned their countries, areas and splits, and filtered to the NICFI area, once.
+The result is cached in a GeoPackage keyed by a hash of the ground truth dataset, the country dataset and the filter parameters,
+so later runs, stages and years only need to read it, and it is rebuilt whenever one of them changes.
+'''
+
+# Reading the union of two datasets
+'''
+We are using the union since they intersect a lot
+Maus, Victor, et al. "An update on global mining land use." Scientific data 9.1 (2022): 1-11.
+https://www.nature.com/articles/s41597-022-01547-4.
+Tang, Liang, and Tim T. Werner. "Global mining footprint mapped from high-resolution satellite imagery." Communications Earth & Environment 4.1 (2023): 134.
+https://www.nature.com/articles/s43247-023-00805-6
+'''
+GROUND_TRUTH_PATH = './data/segmentation/mining_polygons_combined.gpkg'
+GROUND_TRUTH_DEMO_PATH = './data/segmentation/mining_polygons_combined_demo.gpkg'
+PREPROCESSED_DIR = './data/segmentation/preprocessed'
+
+# countries inside the tropical belt which are not covered by NICFI
+ISO_NON_NICFI = ['USA', 'CHN', 'RUS', 'CAN', 'AUS', 'SAU', 'MRT', 'DZA', 'LBA', 'EGY', 'OMN', 'YEM', 'NCL', 'MAR', 'ESH', 'LBY', 'TUN', 'JOR', 'ISR', 'PSE', 'SYR', 'LBN', 'IRQ', 'KWT', 'IRN', 'AFG', 'PAK', 'URY', 'TWN', 'KOR', 'PRK', 'JPN', 'ARE', 'QAT', 'PRI']
+NICFI_BOUNDS = (-180, -30, 180, 30)
+
+# This is the centroid of a really large and really badly delineated polygon contained in the ground truth dataset
+# We will remove this polygon from the dataset
+BAD_CENTROID = (-2.02629645, 5.8978455)
+
+
+def preprocess(gdf:gpd.geodataframe.GeoDataFrame, countries:CountryLookup) -> gpd.geodataframe.GeoDataFrame:
+    """
+    Assigns the country and area of every polygon of the ground truth dataset, its row in the dataset as 'id', and its 'split',
+    and removes all polygons outside of the NICFI area as well as the badly delineated polygon at BAD_CENTROID.
+
+    Parameters
+    -------------
+
+    gdf: The ground truth dataset.
+    type: geopandas.geodataframe.GeoDataFrame
+    values: A valid GeoDataFrame.
+    default: No default value.
+
+    countries: The country lookup.
+    type: countries.CountryLookup
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    gdf = preprocess(gpd.read_file(GROUND_TRUTH_PATH), CountryLookup.from_file())
+    """
+
+    assert (type(gdf) == gpd.geodataframe.GeoDataFrame), "gdf is not a GeoDataFrame."
+    gdf['ISO3_CODE'], gdf['COUNTRY_NAME'] = countries.lookup(gdf.geometry.to_crs('EPSG:4326').values)
+    # Checking in which country the individual polygons are located
+    gdf['AREA'] = gdf.geometry.area
+    gdf['id'] = gdf.index
+    # the split only depends on the id, so it is the same for every year and stage
+    gdf['split'] = assign_splits(gdf['id'].to_numpy())
+
+    gdf.reset_index(drop=True, inplace=True)
+
+    min_x, min_y, max_x, max_y = NICFI_BOUNDS
+    nicfi_bbox = gpd.GeoDataFrame(index=[0], crs=4326, geometry=[shapely.Polygon([(min_x, max_y), (max_x, max_y), (max_x, min_y), (min_x, min_y), (min_x, max_y)])])
+
+    in_nicfi = gdf.intersects(nicfi_bbox.geometry[0])
+    gdf = gdf[in_nicfi]
+
+    nicfi_subset = [False if iso in ISO_NON_NICFI else True for iso in gdf['ISO3_CODE']]
+    gdf = gdf[nicfi_subset]
+
+    bad_centroid = shapely.geometry.Point(*BAD_CENTROID)
+    gdf = gdf[~gdf.geometry.contains(bad_centroid)]
+
+    gdf.reset_index(drop=True, inplace=True)
+    return gdf
+
+
+def preprocessing_key(path:str, countries_path:str=NATURAL_EARTH_PATH) -> str:
+    """
+    Returns a hash of the contents of the ground truth dataset, the country dataset, the filter parameters and the split parameters,
+    which changes whenever the preprocessed ground truth dataset needs to be rebuilt.
+
+    Parameters
+    -------------
+
+    path: The path of the ground truth dataset.
+    type: str
+    values: Any.
+    default: No default value.
+
+    countries_path: The path of the country dataset.
+    type: str
+    values: Any.
+    default: './data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+    Example
+    -------------
+
+    key = preprocessing_key(GROUND_TRUTH_PATH)
+    """
+
+    key = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            key.update(chunk)
+
+    # the country dataset is identified the same way as by its own index
+    countries_stat = os.stat(countries_path)
+    key.update(repr((countries_stat.st_size, countries_stat.st_mtime_ns, ISO_NON_NICFI, NICFI_BOUNDS, BAD_CENTROID)).encode())
+    key.update(repr((SPLIT_SEED, VAL_FRACTION, HAND_VALIDATED_IDS)).encode())
+    return key.hexdigest()
+
+
+def load_ground_truth(path:str=GROUND_TRUTH_PATH, countries_path:str=NATURAL_EARTH_PATH, preprocessed_dir:str=PREPROCESSED_DIR) -> gpd.geodataframe.GeoDataFrame:
+    """
+    Loads the preprocessed ground truth dataset, or preprocesses and caches it if the ground truth dataset, the country dataset, the filter parameters or the split parameters changed.
+    Returns the polygons with their 'ISO3_CODE', 'COUNTRY_NAME', 'AREA', 'id', 'split', and 'bbox' as shapely polygon object.
+
+    Parameters
+    -------------
+
+    path: The path of the ground truth dataset.
+    type: str
+    values: Any.
+    default: './data/segmentation/mining_polygons_combined.gpkg'
+
+    countries_path: The path of the country dataset.
+    type: str
+    values: Any.
+    default: './data/ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+
+    preprocessed_dir: The directory the preprocessed ground truth datasets are cached in.
+    type: str
+    values: Any.
+    default: './data/segmentation/preprocessed'
+
+    Example
+    -------------
+
+    from preprocessing import GROUND_TRUTH_DEMO_PATH, load_ground_truth
+    gdf = load_ground_truth(GROUND_TRUTH_DEMO_PATH)
+    """
+
+    key = preprocessing_key(path, countries_path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    preprocessed_path = os.path.join(preprocessed_dir, '{}_{}.gpkg'.format(name, key[:16]))
+
+    if os.path.isfile(preprocessed_path):
+        print('Reading preprocessed ground truth dataset', preprocessed_path)
+        gdf = gpd.read_file(preprocessed_path)
+
+    else:
+        print('Preprocessing ground truth dataset', path)
+        # Loading the NaturalEarth country dataset and its spatial index, the same one used for postprocessing
+        gdf = preprocess(gpd.read_file(path), CountryLookup.from_file(countries_path))
+
+        # writing to a temporary file of this process first, so concurrently running scripts never read or write a partially written dataset
+        os.makedirs(preprocessed_dir, exist_ok=True)
+        temp_path = '{}.{}.tmp.gpkg'.format(preprocessed_path, os.getpid())
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        gdf.to_file(temp_path, driver='GPKG')
+        os.replace(temp_path, preprocessed_path)
+
+    # bboxes of all polygons as shapely polygon objects, which can not be stored next to the geometry in a GeoPackage
+    gdf['bbox'] = get_bbox_batch(gdf['geometry'].values)
+    return gdf
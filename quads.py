@@ -0,0 +1,1146 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import requests
+from affine import Affine
+
+from planet import PlanetClient
+
+'''
+This script contains helpers for looking up Planet basemap quads, which are imported into segmentation_dataset_generation.py and gpkg_dataset_generation.py.
+Quad search results are persisted in an on-disk SQLite catalog, so reruns and later stages do not need to query the Planet API again.
+Since NICFI quads lie on a fixed Web-Mercator grid, the quads a bounding box lies upon can also be calculated locally using QuadGrid.
+'''
+
+# radius of the sphere used by Web-Mercator (EPSG:3857)
+EARTH_RADIUS = 6378137.0
+# half of the extent of the Web-Mercator plane
+ORIGIN_SHIFT = np.pi * EARTH_RADIUS
+
+# This is the dict in which one needs to add the corresponding Planet parameters if one wants to include more recent data
+NICFI_URLS = {'2016':'planet_medres_normalized_analytic_2016-06_2016-11_mosaic',
+              '2017':'planet_medres_normalized_analytic_2017-06_2017-11_mosaic',
+              '2018':'planet_medres_normalized_analytic_2018-06_2018-11_mosaic',
+              '2019':'planet_medres_normalized_analytic_2019-06_2019-11_mosaic',
+              '2020':'planet_medres_normalized_analytic_2020-06_2020-08_mosaic',
+              '2021':'planet_medres_normalized_analytic_2021-11_mosaic',
+              '2022':'planet_medres_normalized_analytic_2022-11_mosaic',
+              '2023':'planet_medres_normalized_analytic_2023-11_mosaic',
+              '2024':'planet_medres_normalized_analytic_2024-11_mosaic'}
+
+
+def bbox_hash(bounds:tuple) -> str:
+    """
+    Returns a stable hash for a bounding box, used as key for cached quad searches.
+
+    Parameters
+    -------------
+
+    bounds: The bounds of the bounding box as (minx, miny, maxx, maxy).
+    type: tuple
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import bbox_hash
+    key = bbox_hash(my_bbox.bounds)
+
+    """
+
+    #rounding to 1e-9 degrees, so floating point noise does not change the key
+    string_bbox = ','.join('{:.9f}'.format(value) for value in bounds)
+    return hashlib.sha1(string_bbox.encode('utf-8')).hexdigest()
+
+
+class QuadCatalog:
+    """
+    A persistent catalog of Planet basemap quads and of the quads found for each searched bounding box.
+    Quads are stored once per (mosaic id, quad id) with their bbox and download link,
+    searches are stored as (mosaic id, bbox hash) -> list of quad ids.
+    The catalog can be shared by multiple threads.
+
+    Parameters
+    -------------
+
+    path: The path of the SQLite file, which is created if it does not exist.
+    type: str
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import QuadCatalog
+    catalog = QuadCatalog('./data/segmentation/quad_catalog.sqlite')
+    quad_ids = catalog.get_search(mosaic_id, my_bbox.bounds)
+
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS quads (
+                                            mosaic_id TEXT NOT NULL,
+                                            quad_id TEXT NOT NULL,
+                                            minx REAL, miny REAL, maxx REAL, maxy REAL,
+                                            link TEXT,
+                                            PRIMARY KEY (mosaic_id, quad_id))''')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS searches (
+                                            mosaic_id TEXT NOT NULL,
+                                            bbox_hash TEXT NOT NULL,
+                                            quad_ids TEXT NOT NULL,
+                                            PRIMARY KEY (mosaic_id, bbox_hash))''')
+
+
+    def get_search(self, mosaic_id:str, bounds:tuple):
+        """
+        Returns the ids of all quads found for a bounding box, or None if it has not been searched yet.
+
+        Parameters
+        -------------
+
+        mosaic_id: The id of the Planet mosaic.
+        type: str
+        values: Any.
+        default: No default value.
+
+        bounds: The bounds of the searched bounding box as (minx, miny, maxx, maxy).
+        type: tuple
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        quad_ids = catalog.get_search(mosaic_id, my_bbox.bounds)
+
+        """
+
+        with self._lock:
+            row = self._connection.execute('SELECT quad_ids FROM searches WHERE mosaic_id = ? AND bbox_hash = ?',
+                                           (mosaic_id, bbox_hash(bounds))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+
+    def put_search(self, mosaic_id:str, bounds:tuple, items:list):
+        """
+        Stores the quads returned by a quad search, as well as the search itself.
+
+        Parameters
+        -------------
+
+        mosaic_id: The id of the Planet mosaic.
+        type: str
+        values: Any.
+        default: No default value.
+
+        bounds: The bounds of the searched bounding box as (minx, miny, maxx, maxy).
+        type: tuple
+        values: Any.
+        default: No default value.
+
+        items: The quad items as returned by the Planet API, each containing 'id', 'bbox' and '_links'.
+        type: list
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        catalog.put_search(mosaic_id, my_bbox.bounds, quads['items'])
+
+        """
+
+        with self._lock, self._connection:
+            self._put_quads(mosaic_id, items)
+            self._connection.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?)',
+                                     (mosaic_id, bbox_hash(bounds), json.dumps([item['id'] for item in items])))
+
+
+    def put_quads(self, mosaic_id:str, items:list):
+        """
+        Stores quads returned by the Planet API without recording a search.
+
+        Parameters
+        -------------
+
+        mosaic_id: The id of the Planet mosaic.
+        type: str
+        values: Any.
+        default: No default value.
+
+        items: The quad items as returned by the Planet API, each containing 'id', 'bbox' and '_links'.
+        type: list
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        catalog.put_quads(mosaic_id, quads['items'])
+
+        """
+
+        with self._lock, self._connection:
+            self._put_quads(mosaic_id, items)
+
+
+    def _put_quads(self, mosaic_id:str, items:list):
+        rows = [(mosaic_id, item['id'], *item['bbox'], item['_links'].get('download')) for item in items]
+        self._connection.executemany('INSERT OR REPLACE INTO quads VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+    def quads_frame(self, mosaic_id:str) -> pd.DataFrame:
+        """
+        Returns all quads of a mosaic as a DataFrame indexed by quad id, with the columns minx, miny, maxx, maxy and link.
+        Quads without a download link have a missing link, which pd.notna tells apart.
+
+        Parameters
+        -------------
+
+        mosaic_id: The id of the Planet mosaic.
+        type: str
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        quads = catalog.quads_frame(mosaic_id)
+        link = quads.at[my_quad_id, 'link']
+
+        """
+
+        with self._lock:
+            quads = pd.read_sql_query('SELECT quad_id, minx, miny, maxx, maxy, link FROM quads WHERE mosaic_id = ?',
+                                      self._connection, params=(mosaic_id,), index_col='quad_id')
+        return quads
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+
+class CloudfreeIndex:
+    """
+    A (year, quad) -> link table of the quads selected for their clarity, compiled once from cloudfree_quads_info.csv into an SQLite file next to it,
+    which all years share and which is only recompiled when the csv file changes.
+    If a quad occurs multiple times for a year, its first link in the csv file is used.
+
+    Parameters
+    -------------
+
+    path: The path of the csv file with the columns year, quad and link.
+    type: str
+    values: Any.
+    default: './data/segmentation/cloudfree_quads_info.csv'
+
+    index_path: The path of the compiled SQLite file.
+    type: str
+    values: Any.
+    default: The path of the csv file with the suffix _index.sqlite.
+
+    Example
+    -------------
+
+    from quads import CloudfreeIndex
+    cloudfree = CloudfreeIndex('./data/segmentation/cloudfree_quads_info.csv')
+    links = cloudfree.links('2019', used_quads)
+
+    """
+
+    def __init__(self, path:str='./data/segmentation/cloudfree_quads_info.csv', index_path:str=None):
+        self.path = path
+        self.index_path = index_path if index_path is not None else os.path.splitext(path)[0] + '_index.sqlite'
+        self._years = {}
+        self._lock = threading.Lock()
+
+        source_stat = os.stat(path)
+        source_key = '{}-{}'.format(source_stat.st_size, source_stat.st_mtime_ns)
+        if self._source_key() != source_key:
+            self._compile(source_key)
+
+        self._connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        # the index is read only, so SQLite can map it into memory instead of reading it
+        self._connection.execute('PRAGMA mmap_size = 268435456')
+
+
+    def _source_key(self):
+        if not os.path.isfile(self.index_path):
+            return None
+        try:
+            with sqlite3.connect(self.index_path) as connection:
+                row = connection.execute("SELECT value FROM meta WHERE key = 'source_key'").fetchone()
+            return None if row is None else row[0]
+        except sqlite3.Error:
+            return None
+
+
+    def _compile(self, source_key:str):
+        print('Compiling cloudfree quad index from', self.path)
+        cloudfree_quads = pd.read_csv(self.path, sep=',', usecols=['year', 'quad', 'link'], dtype={'quad': str, 'link': str})
+        cloudfree_quads = cloudfree_quads.drop_duplicates(['year', 'quad'])
+
+        # compiling into a temporary file first, so scripts of other years running at the same time never read a partial index
+        temp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        with sqlite3.connect(temp_path) as connection:
+            connection.execute('CREATE TABLE cloudfree (year INTEGER NOT NULL, quad TEXT NOT NULL, link TEXT, PRIMARY KEY (year, quad)) WITHOUT ROWID')
+            connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            connection.executemany('INSERT INTO cloudfree VALUES (?, ?, ?)', cloudfree_quads[['year', 'quad', 'link']].itertuples(index=False, name=None))
+            connection.execute("INSERT INTO meta VALUES ('source_key', ?)", (source_key,))
+        connection.close()
+        os.replace(temp_path, self.index_path)
+
+
+    def year(self, year) -> pd.Series:
+        """
+        Returns the links of all cloudfree quads of a year as a Series indexed by quad id, which is cached for later calls.
+
+        Example
+        -------------
+
+        cloudfree_links = cloudfree.year('2019')
+
+        """
+
+        year = int(year)
+        with self._lock:
+            if year not in self._years:
+                self._years[year] = pd.read_sql_query('SELECT quad, link FROM cloudfree WHERE year = ?',
+                                                      self._connection, params=(year,), index_col='quad')['link']
+            return self._years[year]
+
+
+    def links(self, year, quad_ids) -> pd.Series:
+        """
+        Returns the cloudfree link of every given quad of a year in a single merge, as a Series indexed by quad id,
+        which is nan for quads without a cloudfree replacement.
+
+        Parameters
+        -------------
+
+        year: The year.
+        type: str or int
+        values: Any.
+        default: No default value.
+
+        quad_ids: The ids of the quads.
+        type: list or pd.Index
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        cloudfree_links = cloudfree.links(year, used_quads)
+        has_cloudfree = cloudfree_links.notna().to_numpy()
+
+        """
+
+        return self.year(year).reindex(pd.Index(quad_ids, dtype=object))
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+
+def tile_bboxes(quads:pd.DataFrame, tile_ids) -> list:
+    """
+    Returns the bounding boxes of the given quads as a list of [minx, miny, maxx, maxy] lists,
+    which is the format expected by count_tiles and global_to_local_coords.
+
+    Parameters
+    -------------
+
+    quads: A DataFrame of quads as returned by QuadCatalog.quads_frame.
+    type: pandas.core.frame.DataFrame
+    values: Any.
+    default: No default value.
+
+    tile_ids: The ids of the quads.
+    type: list or np.ndarray
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import tile_bboxes
+    bboxes = tile_bboxes(quads, gdf['tile_ids'][0])
+
+    """
+
+    return quads.loc[list(tile_ids), ['minx', 'miny', 'maxx', 'maxy']].values.tolist()
+
+
+
+def tile_bboxes_batch(quads:pd.DataFrame, tile_ids) -> (np.ndarray, np.ndarray):
+    """
+    Returns the bounding boxes of the quads of many polygons as one flat array of [minx, miny, maxx, maxy] rows,
+    and offsets so the bounding boxes of polygon i are bboxes[offsets[i]:offsets[i+1]], which is the format expected by count_tiles_batch.
+
+    Parameters
+    -------------
+
+    quads: A DataFrame of quads as returned by QuadCatalog.quads_frame.
+    type: pandas.core.frame.DataFrame
+    values: Any.
+    default: No default value.
+
+    tile_ids: The ids of the quads of every polygon.
+    type: list or pd.Series
+    values: Lists or arrays of quad ids.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import tile_bboxes_batch
+    bboxes, offsets = tile_bboxes_batch(quads, gdf['tile_ids'])
+
+    """
+
+    tile_ids = [np.array(ids, dtype=object, ndmin=1) for ids in tile_ids]
+    offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in tile_ids])]).astype(int)
+    all_ids = np.concatenate(tile_ids) if len(tile_ids) > 0 else np.array([], dtype=object)
+
+    return quads.loc[all_ids, ['minx', 'miny', 'maxx', 'maxy']].to_numpy(dtype=float), offsets
+
+
+
+class QuadGrid:
+    """
+    The fixed Web-Mercator grid of the NICFI basemap quads.
+    At zoom level 15, every quad is 4096x4096 pixels of roughly 4.77 m, and the quad with id 'x-y' (or 'L15-xxxxE-yyyyN')
+    is the x-th quad counted from the antimeridian eastwards and the y-th quad counted from the southern edge of the grid northwards.
+    All methods are vectorized, so the quads of all polygons can be computed in a single pass.
+
+    Parameters
+    -------------
+
+    zoom: The zoom level of the basemap.
+    type: int
+    values: Any.
+    default: 15
+
+    quad_pixels: The side length of a quad in pixels.
+    type: int
+    values: Any.
+    default: 4096
+
+    Example
+    -------------
+
+    from quads import QuadGrid
+    grid = QuadGrid()
+    tile_ids = grid.quads_for_bounds(gdf['bbox'].apply(lambda b: b.bounds).to_list())
+
+    """
+
+    def __init__(self, zoom:int=15, quad_pixels:int=4096):
+        self.zoom = zoom
+        self.quad_pixels = quad_pixels
+        # the basemap tiles of 256 pixels at this zoom level are grouped into quads
+        self.quads_per_side = (2**zoom * 256) // quad_pixels
+        self.quad_size = 2 * ORIGIN_SHIFT / self.quads_per_side
+        self.resolution = self.quad_size / quad_pixels
+
+
+    def quad_indices(self, lon, lat, upper:bool=False) -> (np.ndarray, np.ndarray):
+        """
+        Returns the x and y indices of the quads the given coordinates are located on.
+        Coordinates on the edge between two quads are located on the eastern or northern quad, unless upper is set.
+
+        Parameters
+        -------------
+
+        lon: Longitudes in degrees.
+        type: float or np.ndarray
+        values: -180 to 180.
+        default: No default value.
+
+        lat: Latitudes in degrees.
+        type: float or np.ndarray
+        values: Roughly -85 to 85.
+        default: No default value.
+
+        upper: States if coordinates on the edge between two quads are located on the western or southern quad, as for the max corners of bounding boxes.
+        type: bool
+        values: True or False.
+        default: False
+
+        Example
+        -------------
+
+        x, y = grid.quad_indices(-11.2, 7.1)
+
+        """
+
+        mx, my = lonlat_to_mercator(lon, lat)
+        x = (mx + ORIGIN_SHIFT) / self.quad_size
+        y = (my + ORIGIN_SHIFT) / self.quad_size
+        if upper:
+            x, y = np.ceil(x).astype(int) - 1, np.ceil(y).astype(int) - 1
+        else:
+            x, y = np.floor(x).astype(int), np.floor(y).astype(int)
+        return np.clip(x, 0, self.quads_per_side-1), np.clip(y, 0, self.quads_per_side-1)
+
+
+    def quad_id(self, x, y) -> np.ndarray:
+        """
+        Returns the quad ids 'x-y' as used by the Planet basemaps API.
+
+        Example
+        -------------
+
+        ids = grid.quad_id([480, 481], [1002, 1002])
+
+        """
+
+        return np.char.add(np.char.add(np.asarray(x).astype(str), '-'), np.asarray(y).astype(str)).astype(object)
+
+
+    def quad_name(self, x, y) -> np.ndarray:
+        """
+        Returns the quad names 'L15-xxxxE-yyyyN' as used for the downloaded quad files.
+
+        Example
+        -------------
+
+        names = grid.quad_name([480, 481], [1002, 1002])
+
+        """
+
+        return np.array(['L{}-{:04d}E-{:04d}N'.format(self.zoom, x_i, y_i) for x_i, y_i in zip(np.ravel(x), np.ravel(y))], dtype=object)
+
+
+    def parse_quad_id(self, quad_ids) -> (np.ndarray, np.ndarray):
+        """
+        Returns the x and y indices of the given quad ids, which can either be in the 'x-y' or in the 'L15-xxxxE-yyyyN' format.
+
+        Example
+        -------------
+
+        x, y = grid.parse_quad_id(['480-1002', 'L15-0481E-1002N'])
+
+        """
+
+        x, y = [], []
+        for quad_id in np.ravel(quad_ids):
+            match = re.fullmatch(r'(?:L\d+-)?(\d+)E?-(\d+)N?', quad_id)
+            if match is None:
+                raise ValueError('Invalid quad id {}'.format(quad_id))
+            x.append(int(match.group(1)))
+            y.append(int(match.group(2)))
+        return np.array(x), np.array(y)
+
+
+    def quad_bounds(self, x, y, crs:str='EPSG:4326') -> np.ndarray:
+        """
+        Returns the bounds of the given quads as an array of shape (n, 4) containing minx, miny, maxx, maxy.
+
+        Parameters
+        -------------
+
+        x: The x indices of the quads.
+        type: int or np.ndarray
+        values: Any.
+        default: No default value.
+
+        y: The y indices of the quads.
+        type: int or np.ndarray
+        values: Any.
+        default: No default value.
+
+        crs: The coordinate system of the bounds, either longitudes and latitudes or Web-Mercator meters.
+        type: str
+        values: 'EPSG:4326' or 'EPSG:3857'.
+        default: 'EPSG:4326'
+
+        Example
+        -------------
+
+        bounds = grid.quad_bounds(480, 1002)
+
+        """
+
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        minx = x * self.quad_size - ORIGIN_SHIFT
+        miny = y * self.quad_size - ORIGIN_SHIFT
+        maxx = minx + self.quad_size
+        maxy = miny + self.quad_size
+
+        if crs == 'EPSG:3857':
+            return np.stack([minx, miny, maxx, maxy], axis=1)
+        elif crs == 'EPSG:4326':
+            minlon, minlat = mercator_to_lonlat(minx, miny)
+            maxlon, maxlat = mercator_to_lonlat(maxx, maxy)
+            return np.stack([minlon, minlat, maxlon, maxlat], axis=1)
+        else:
+            raise ValueError('Unsupported crs {}'.format(crs))
+
+
+    def quad_transform(self, x:int, y:int) -> Affine:
+        """
+        Returns the affine transform from pixel coordinates of a quad to Web-Mercator coordinates, as found in the quads GeoTIFF.
+
+        Example
+        -------------
+
+        transform = grid.quad_transform(480, 1002)
+
+        """
+
+        minx, _, _, maxy = self.quad_bounds(x, y, crs='EPSG:3857')[0]
+        return Affine(self.resolution, 0.0, minx, 0.0, -self.resolution, maxy)
+
+
+    def quads_for_bounds(self, bounds) -> list:
+        """
+        Returns the ids of all quads each of the given bounding boxes intersects with, sorted by their x and y indices.
+        Quads which only touch a bounding box are left out, the same way as by assign_quads.
+
+        Parameters
+        -------------
+
+        bounds: An array of shape (n, 4) of bounding boxes containing minx, miny, maxx, maxy in longitudes and latitudes.
+        type: np.ndarray or list
+        values: Any.
+        default: No default value.
+
+        Example
+        -------------
+
+        tile_ids = grid.quads_for_bounds(gdf['bbox'].apply(lambda b: b.bounds).to_list())
+
+        """
+
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        x0, y0 = self.quad_indices(bounds[:, 0], bounds[:, 1])
+        x1, y1 = self.quad_indices(bounds[:, 2], bounds[:, 3], upper=True)
+        # bounding boxes without width or height on the edge between two quads still get one of them
+        x1, y1 = np.maximum(x1, x0), np.maximum(y1, y0)
+        width = x1 - x0 + 1
+        height = y1 - y0 + 1
+        counts = width * height
+
+        # flattening all (bbox, quad) pairs into a single array, so no python loop over the quads is needed
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        position = np.arange(counts.sum()) - np.repeat(offsets, counts)
+        x = np.repeat(x0, counts) + position // np.repeat(height, counts)
+        y = np.repeat(y0, counts) + position % np.repeat(height, counts)
+
+        ids = self.quad_id(x, y)
+        return np.split(ids, np.cumsum(counts)[:-1])
+
+
+    def validate(self, quads:pd.DataFrame, atol:float=1e-6) -> pd.DataFrame:
+        """
+        Compares the calculated quad bounds to the bounds returned by the Planet API, and returns all quads which do not match.
+
+        Parameters
+        -------------
+
+        quads: A DataFrame of quads as returned by QuadCatalog.quads_frame.
+        type: pandas.core.frame.DataFrame
+        values: Any.
+        default: No default value.
+
+        atol: The absolute tolerance in degrees.
+        type: float
+        values: Any.
+        default: 1e-6
+
+        Example
+        -------------
+
+        mismatches = grid.validate(catalog.quads_frame(mosaic_id))
+        assert len(mismatches) == 0
+
+        """
+
+        x, y = self.parse_quad_id(quads.index.to_list())
+        calculated = self.quad_bounds(x, y)
+        cached = quads[['minx', 'miny', 'maxx', 'maxy']].values
+        matches = np.isclose(calculated, cached, atol=atol).all(axis=1)
+        return quads[~matches]
+
+
+
+def lonlat_to_mercator(lon, lat) -> (np.ndarray, np.ndarray):
+    """
+    Projects longitudes and latitudes in degrees to Web-Mercator coordinates in meters.
+
+    Example
+    -------------
+
+    from quads import lonlat_to_mercator
+    mx, my = lonlat_to_mercator(-11.2, 7.1)
+
+    """
+
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    mx = np.radians(lon) * EARTH_RADIUS
+    my = np.log(np.tan(np.pi/4 + np.radians(lat)/2)) * EARTH_RADIUS
+    return mx, my
+
+
+
+def mercator_to_lonlat(mx, my) -> (np.ndarray, np.ndarray):
+    """
+    Projects Web-Mercator coordinates in meters to longitudes and latitudes in degrees.
+
+    Example
+    -------------
+
+    from quads import mercator_to_lonlat
+    lon, lat = mercator_to_lonlat(-1246764.7, 792499.6)
+
+    """
+
+    mx = np.asarray(mx, dtype=float)
+    my = np.asarray(my, dtype=float)
+    lon = np.degrees(mx / EARTH_RADIUS)
+    lat = np.degrees(2*np.arctan(np.exp(my / EARTH_RADIUS)) - np.pi/2)
+    return lon, lat
+
+
+
+def resolve_quad(quad_id:str, mosaic_id:str, api_url:str, client:PlanetClient, catalog:QuadCatalog):
+    """
+    Requests a single quad from the Planet API by its id and stores it in the quad catalog.
+    Quads which do not exist in the mosaic are stored without a download link, so they are not requested again.
+
+    Parameters
+    -------------
+
+    quad_id: The id of the quad.
+    type: str
+    values: Any.
+    default: No default value.
+
+    mosaic_id: The id of the Planet mosaic.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_url: The base url of the Planet basemaps API.
+    type: str
+    values: Any.
+    default: No default value.
+
+    client: The client for making API requests.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    catalog: The quad catalog in which the quad is stored.
+    type: quads.QuadCatalog
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import resolve_quad
+    resolve_quad('480-1002', MOSAIC_ID, API_URL, client, catalog)
+
+    """
+
+    quad_url = "{}/{}/quads/{}".format(api_url, mosaic_id, quad_id)
+
+    try:
+        res = client.get(quad_url, ok_status_codes=(404,))
+        if res.status_code == 404:
+            # the quad is not part of the mosaic, e.g. since it only covers the ocean
+            grid = QuadGrid()
+            x, y = grid.parse_quad_id([quad_id])
+            item = {'id': quad_id, 'bbox': list(grid.quad_bounds(x, y)[0]), '_links': {}}
+        else:
+            item = res.json()
+
+    except json.JSONDecodeError as e:
+        print('Caught error when reading JSON response from Planet for quad', quad_id, e)
+        print('Response:', res.content)
+        return
+
+    except requests.exceptions.RequestException as e:
+        print('Request failed for quad', quad_id, e)
+        return
+
+    catalog.put_quads(mosaic_id, [item])
+
+
+
+def plan_searches(bounds, cell_size:float=1.0) -> list:
+    """
+    Groups neighbouring bounding boxes into search regions, so that clustered polygons can share a single quad search.
+    Bounding boxes are grouped by the cell of a regular grid their center is located in,
+    and every region covers the union of the bounding boxes of its members.
+    Returns a list of (region bounds, member indices) tuples.
+
+    Parameters
+    -------------
+
+    bounds: An array of shape (n, 4) of bounding boxes containing minx, miny, maxx, maxy.
+    type: np.ndarray or list
+    values: Any.
+    default: No default value.
+
+    cell_size: The side length of the grid cells in degrees, which limits the size of the regions and thus the number of quads per search.
+    type: float
+    values: Any positive number.
+    default: 1.0
+
+    Example
+    -------------
+
+    from quads import plan_searches
+    for region_bounds, members in plan_searches(shapely.bounds(gdf['bbox'].to_numpy())):
+        ...
+
+    """
+
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    if len(bounds) == 0:
+        return []
+
+    x_cell = np.floor((bounds[:, 0] + bounds[:, 2]) / 2 / cell_size).astype(int)
+    y_cell = np.floor((bounds[:, 1] + bounds[:, 3]) / 2 / cell_size).astype(int)
+    _, cell, counts = np.unique(np.stack([x_cell, y_cell], axis=1), axis=0, return_inverse=True, return_counts=True)
+
+    # sorting the bounding boxes by their cell, so every region is a contiguous slice
+    order = np.argsort(cell.ravel(), kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_bounds = bounds[order]
+    region_bounds = np.stack([np.minimum.reduceat(sorted_bounds[:, 0], starts),
+                              np.minimum.reduceat(sorted_bounds[:, 1], starts),
+                              np.maximum.reduceat(sorted_bounds[:, 2], starts),
+                              np.maximum.reduceat(sorted_bounds[:, 3], starts)], axis=1)
+
+    return list(zip(region_bounds, np.split(order, np.cumsum(counts)[:-1])))
+
+
+
+def assign_quads(bounds, items:list) -> list:
+    """
+    Assigns the quads found for a search region to the bounding boxes of the regions members, by intersecting their bounding boxes.
+    Returns a list containing the quad items intersecting each bounding box.
+
+    Parameters
+    -------------
+
+    bounds: An array of shape (n, 4) of bounding boxes containing minx, miny, maxx, maxy.
+    type: np.ndarray or list
+    values: Any.
+    default: No default value.
+
+    items: The quad items as returned by the Planet API, each containing 'id' and 'bbox'.
+    type: list
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import assign_quads
+    member_items = assign_quads(member_bounds, search_quads(region_bounds, MOSAIC_ID, API_URL, client))
+
+    """
+
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    if len(items) == 0:
+        return [[] for _ in range(len(bounds))]
+
+    quad_bounds = np.array([item['bbox'] for item in items], dtype=float)
+    # quads which only touch a bounding box are not needed for its mosaic
+    intersects = ((quad_bounds[None, :, 0] < bounds[:, None, 2]) & (quad_bounds[None, :, 2] > bounds[:, None, 0]) &
+                  (quad_bounds[None, :, 1] < bounds[:, None, 3]) & (quad_bounds[None, :, 3] > bounds[:, None, 1]))
+    return [[items[i] for i in np.flatnonzero(row)] for row in intersects]
+
+
+
+def search_quads(bounds, mosaic_id:str, api_url:str, client:PlanetClient):
+    """
+    Searches all quads of a mosaic which intersect a bounding box via the Planet API, following all result pages.
+    Returns the list of quad items, or None if the search failed.
+
+    Parameters
+    -------------
+
+    bounds: The bounds of the bounding box as (minx, miny, maxx, maxy).
+    type: tuple
+    values: Any.
+    default: No default value.
+
+    mosaic_id: The id of the Planet mosaic.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_url: The base url of the Planet basemaps API.
+    type: str
+    values: Any.
+    default: No default value.
+
+    client: The client for making API requests.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import search_quads
+    items = search_quads(my_bbox.bounds, MOSAIC_ID, API_URL, client)
+
+    """
+
+    # Accessing tiles using metadata from mosaic
+    quads_url = "{}/{}/quads".format(api_url, mosaic_id)
+    # Search for mosaic tile using AOI
+    search_parameters = {
+        'bbox': ','.join(map(str, bounds)),
+        'minimal': False
+    }
+
+    items = []
+    while quads_url is not None:
+        try:
+            page = client.get_json(quads_url, params=search_parameters)
+
+        except json.JSONDecodeError as e:
+            print('Caught error when reading JSON response from Planet', e)
+            return None
+
+        except requests.exceptions.RequestException as e:
+            print('Request failed', e)
+            return None
+
+        items.extend(page['items'])
+        # the link to the next page already contains the search parameters
+        quads_url = page.get('_links', {}).get('_next')
+        search_parameters = None
+
+    return items
+
+
+
+def process_tile(region_bounds:np.ndarray, members:np.ndarray, gdf:gpd.geodataframe.GeoDataFrame, mosaic_id:str, api_url:str,
+                 client:PlanetClient, catalog:QuadCatalog) -> dict:
+    """
+    Processes a single search region by searching for mosaic tiles using the region as area of interest (AOI),
+    and returns the IDs of the found tiles for every polygon of the region whose bounding box they intersect, as a dict of row index to tile IDs.
+    The tiles found for every polygon are stored in the quad catalog, so each bounding box is only requested once.
+
+    Parameters
+    -------------
+
+    region_bounds: The bounds of the search region as (minx, miny, maxx, maxy).
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    members: The indices of the polygons in the GeoDataFrame which are located inside the search region.
+    type: np.ndarray
+    values: Positive integers corresponding to row indices in the GeoDataFrame.
+    default: No default value.
+
+    gdf: A GeoDataFrame.
+    type: geopandas.geodataframe.GeoDataFrame
+    values: A valid GeoDataFrame.
+    default: No default value.
+
+    mosaic_id: The id of the mosaic which is searched.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_url: The base url of the Planet basemaps API.
+    type: str
+    values: Any.
+    default: No default value.
+
+    client: The client for making API requests.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    catalog: The quad catalog in which quad searches are cached.
+    type: quads.QuadCatalog
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import plan_searches, process_tile
+    for region_bounds, members in plan_searches(shapely.bounds(gdf['bbox'].to_numpy())):
+        found_tile_ids = process_tile(region_bounds, members, gdf, MOSAIC_ID, API_URL, client, catalog)
+
+    """
+
+    found_tile_ids = {}
+    try:
+        items = search_quads(region_bounds, mosaic_id, api_url, client)
+        if items is None:
+            return found_tile_ids  # Exit the function if max retries are reached
+
+        # fanning the tiles of the region out to the polygons located in it
+        member_bboxes = gdf['bbox'].to_numpy()[members]
+        for j, bbox, member_items in zip(members, member_bboxes, assign_quads(shapely.bounds(member_bboxes), items)):
+            catalog.put_search(mosaic_id, bbox.bounds, member_items)
+            found_tile_ids[j] = np.array([item['id'] for item in member_items], dtype=object)
+
+    except json.JSONDecodeError as e:
+        print('Caught error when reading JSON response from Planet', e)
+        pass
+
+    except requests.exceptions.RequestException as e:
+        print('Request failed', e)
+        pass
+
+    return found_tile_ids
+
+
+
+def parallel_process_tile(gdf:gpd.geodataframe.GeoDataFrame, mosaic_id:str, api_url:str, client:PlanetClient, catalog:QuadCatalog):
+    """
+    Searches the tiles of all polygons whose bounding box has not been searched yet.
+    Neighbouring polygons are grouped into search regions, which are processed in parallel by worker threads,
+    so clustered polygons only require a single request.
+    The tiles returned by the workers are stored in gdf['tile_ids'] by the calling thread.
+
+    Parameters
+    -------------
+
+    gdf: A GeoDataFrame containing the bboxes of all polygons.
+    type: geopandas.geodataframe.GeoDataFrame
+    values: A valid GeoDataFrame.
+    default: No default value.
+
+    mosaic_id: The id of the mosaic which is searched.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_url: The base url of the Planet basemaps API.
+    type: str
+    values: Any.
+    default: No default value.
+
+    client: The client for making API requests, which also sets the number of worker threads.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    catalog: The quad catalog in which quad searches are cached.
+    type: quads.QuadCatalog
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import parallel_process_tile
+    parallel_process_tile(gdf, MOSAIC_ID, API_URL, client, catalog)
+
+    """
+
+    # Skipping the request for all bboxes which have already been searched
+    tile_ids = gdf['tile_ids'].to_list()
+    for j, bbox in enumerate(gdf['bbox']):
+        quad_ids = catalog.get_search(mosaic_id, bbox.bounds)
+        if quad_ids is not None:
+            tile_ids[j] = np.array(quad_ids, dtype=object)
+
+    unsearched = np.flatnonzero([ids.size == 0 for ids in tile_ids])
+    regions = plan_searches(shapely.bounds(gdf['bbox'].to_numpy()[unsearched]))
+    print('searching tiles of {} polygons in {} regions'.format(str(len(unsearched)), str(len(regions))))
+
+    # the client's token bucket keeps the requests of all workers within the rate limit
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+        futures = [
+            executor.submit(process_tile, region_bounds, unsearched[members], gdf, mosaic_id, api_url, client, catalog)
+            for region_bounds, members in regions
+        ]
+
+        for future in as_completed(futures):
+            for j, ids in future.result().items():
+                tile_ids[j] = ids
+
+    gdf['tile_ids'] = pd.Series(tile_ids, index=gdf.index, dtype=object)
+
+
+
+def parallel_resolve_quads(quad_ids:list, mosaic_id:str, api_url:str, client:PlanetClient, catalog:QuadCatalog):
+    """
+    Requests the given quads from the Planet API by delegating each quad to worker threads, and stores them in the quad catalog.
+
+    Parameters
+    -------------
+
+    quad_ids: The ids of the quads.
+    type: list
+    values: Any.
+    default: No default value.
+
+    mosaic_id: The id of the Planet mosaic.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_url: The base url of the Planet basemaps API.
+    type: str
+    values: Any.
+    default: No default value.
+
+    client: The client for making API requests, which also sets the number of worker threads.
+    type: planet.PlanetClient
+    values: Any.
+    default: No default value.
+
+    catalog: The quad catalog in which the quads are stored.
+    type: quads.QuadCatalog
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from quads import parallel_resolve_quads
+    parallel_resolve_quads(['480-1002', '481-1002'], MOSAIC_ID, API_URL, client, catalog)
+
+    """
+
+    # the client's token bucket keeps the requests of all workers within the rate limit
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+        futures = [
+            executor.submit(resolve_quad, quad_id, mosaic_id, api_url, client, catalog)
+            for quad_id in quad_ids
+        ]
+
+        for future in as_completed(futures):
+            future.result()
@@ -0,0 +1,187 @@
+import io
+import os
+import zlib
+import json
+import sqlite3
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+'''
+This script contains a record and replay layer for the requests of the Planet API, which is imported into planet.py.
+On first contact, every API response is recorded to a compressed archive, and reruns are answered from the archive without sending any request,
+so they return identical quads and tile assignments. In offline mode, requests missing from the archive fail instead of being sent,
+so runs on machines without network access, or after the end of the NICFI program, only use recorded responses.
+Quad downloads are not recorded, since the downloaded quads are kept in ./data/tiff_tiles anyway.
+'''
+
+# query parameters which are credentials, and neither part of the archive keys nor stored in the archive
+CREDENTIAL_PARAMETERS = ('api_key',)
+# the API key in recorded responses, e.g. in download links, is replaced by this placeholder
+API_KEY_PLACEHOLDER = '__PLANET_API_KEY__'
+# headers which describe the transfer of the original response, not its content
+TRANSFER_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+
+class ReplayMissError(RuntimeError):
+    """
+    Raised in offline mode instead of sending a request whose response is not in the archive.
+    This is no requests.exceptions.RequestException on purpose, so it is not retried, and stops quad searches and lookups.
+    Downloads missing from the archive only skip the polygons on their tiles.
+    """
+
+
+
+def archive_key(method:str, url:str, params:dict=None) -> str:
+    """
+    Returns the key of a request in the archive, i.e. its method, path and sorted query parameters without credentials.
+    The host is not part of the key, so responses recorded from the Planet API can also be replayed for a local server set via API_URL, and vice versa.
+
+    Parameters
+    -------------
+
+    method: The HTTP method of the request.
+    type: str
+    values: Any.
+    default: No default value.
+
+    url: The url of the request, which may already contain query parameters.
+    type: str
+    values: Any.
+    default: No default value.
+
+    params: Further query parameters of the request.
+    type: dict
+    values: Any.
+    default: None
+
+    Example
+    -------------
+
+    from replay import archive_key
+    key = archive_key('GET', API_URL, params={"name__is": NICFI_URLS[year]})
+
+    """
+
+    if params:
+        url = requests.Request(method, url, params=params).prepare().url
+    parts = urllib.parse.urlsplit(url)
+    query = sorted((name, value) for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if name not in CREDENTIAL_PARAMETERS)
+    url = urllib.parse.urlunsplit(('', '', parts.path, urllib.parse.urlencode(query), ''))
+    return '{} {}'.format(method.upper(), url)
+
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    A transport adapter for requests.Session, which answers requests from an archive of recorded responses.
+    Responses missing from the archive are requested and recorded, or raise a ReplayMissError in offline mode.
+    Retried status codes are never recorded, and streamed requests, i.e. downloads, are sent without being recorded.
+    The API key is replaced by a placeholder before a response is recorded, and by the current API key when it is replayed,
+    so archives can be shared without sharing the API key. The adapter can be shared by multiple threads.
+
+    Parameters
+    -------------
+
+    path: The path of the SQLite archive.
+    type: str
+    values: Any.
+    default: No default value.
+
+    api_key: The Planet API key, which is removed from recorded responses.
+    type: str
+    values: Any.
+    default: None
+
+    offline: States if requests missing from the archive fail instead of being sent.
+    type: bool
+    values: True or False.
+    default: False
+
+    skip_status_codes: Status codes of responses which are not recorded, since they are temporary.
+    type: tuple
+    values: Any.
+    default: ()
+
+    kwargs: Further keyword arguments passed to requests.adapters.HTTPAdapter.
+
+    Example
+    -------------
+
+    from replay import ReplayAdapter
+    adapter = ReplayAdapter('./data/segmentation/planet_archive.sqlite', PLANET_API_KEY, offline=True)
+    session.mount('https://', adapter)
+
+    """
+
+    def __init__(self, path:str, api_key:str=None, offline:bool=False, skip_status_codes:tuple=(), **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.api_key = api_key
+        self.offline = offline
+        self.skip_status_codes = skip_status_codes
+        self.hits, self.misses = 0, 0
+
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                            key TEXT PRIMARY KEY,
+                                            status INTEGER NOT NULL,
+                                            reason TEXT,
+                                            headers TEXT NOT NULL,
+                                            body BLOB NOT NULL)''')
+
+
+    def __contains__(self, key:str) -> bool:
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+
+
+    def _replay(self, request:requests.PreparedRequest, row:tuple) -> requests.Response:
+        status, reason, headers, body = row
+        body = zlib.decompress(body)
+        if self.api_key:
+            body = body.replace(API_KEY_PLACEHOLDER.encode(), self.api_key.encode())
+        raw = HTTPResponse(body=io.BytesIO(body), headers=json.loads(headers), status=status, reason=reason,
+                           preload_content=False, decode_content=False)
+        return self.build_response(request, raw)
+
+
+    def _record(self, key:str, res:requests.Response):
+        body = res.content
+        if self.api_key:
+            body = body.replace(self.api_key.encode(), API_KEY_PLACEHOLDER.encode())
+        headers = {name: value for name, value in res.headers.items() if name.lower() not in TRANSFER_HEADERS}
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                     (key, res.status_code, res.reason, json.dumps(headers), zlib.compress(body, 9)))
+
+
+    def send(self, request:requests.PreparedRequest, stream:bool=False, **kwargs) -> requests.Response:
+        key = archive_key(request.method, request.url)
+        with self._lock:
+            row = self._connection.execute('SELECT status, reason, headers, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if row is not None:
+            return self._replay(request, row)
+        if self.offline:
+            raise ReplayMissError('No recorded response for {} in {}, which is required in offline mode.'.format(key, self.path))
+
+        res = super().send(request, stream=stream, **kwargs)
+        if not stream and res.status_code not in self.skip_status_codes:
+            self._record(key, res)
+        return res
+
+
+    def close(self):
+        super().close()
+        with self._lock:
+            self._connection.close()
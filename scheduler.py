@@ -0,0 +1,108 @@
+import time
+import threading
+from contextlib import contextmanager
+
+'''
+This script contains a memory budget for the tasks of a shared worker pool, which is imported into segmentation_dataset_generation.py.
+When several years are processed by the same workers, the number of workers bounds how many tasks run at the same time,
+and the memory budget bounds how much memory these tasks are estimated to use together.
+Tasks are submitted longest first, so the longest tasks do not start last and keep a single worker busy after all others are done.
+'''
+
+
+class MemoryBudget:
+    """
+    Bounds the estimated memory of all tasks running at the same time.
+    Tasks wait until enough of the budget is free, and a task which is larger than the whole budget runs as soon as no other task is running,
+    so every task is eventually run.
+
+    Parameters
+    -------------
+
+    budget: The memory budget in bytes.
+    type: int
+    values: Any positive integer.
+    default: No default value.
+
+    Example
+    -------------
+
+    from scheduler import MemoryBudget
+    budget = MemoryBudget(8 * 2**30)
+    with budget.reserve(estimate_memory(my_jobs)) as waited:
+        save_chip_set(my_jobs, my_tile_filenames, my_img_dir)
+
+    """
+
+    def __init__(self, budget:int):
+        self.budget = budget
+        self.used = 0
+        # the highest estimated memory of all tasks running at the same time so far
+        self.peak = 0
+        self._condition = threading.Condition()
+
+
+    def acquire(self, size:int) -> float:
+        """
+        Waits until size bytes of the budget are free, and reserves them. Returns the number of seconds it waited.
+        """
+
+        start = time.perf_counter()
+        with self._condition:
+            while self.used > 0 and self.used + size > self.budget:
+                self._condition.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+        return time.perf_counter() - start
+
+
+    def release(self, size:int):
+        """
+        Frees size bytes of the budget, which were reserved by acquire.
+        """
+
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+    @contextmanager
+    def reserve(self, size:int):
+        """
+        Reserves size bytes of the budget while the with block is running, and yields the number of seconds it waited for them.
+        """
+
+        waited = self.acquire(size)
+        try:
+            yield waited
+        finally:
+            self.release(size)
+
+
+
+def longest_first(tasks:list, cost) -> list:
+    """
+    Orders tasks by their estimated cost, most expensive first, keeping the order of tasks with the same cost.
+    Submitting the longest tasks first shortens the time the last tasks run alone, while all other workers are idle.
+
+    Parameters
+    -------------
+
+    tasks: The tasks.
+    type: list
+    values: Any.
+    default: No default value.
+
+    cost: A function returning the estimated cost of a task, e.g. its estimated run time or number of bytes read.
+    type: function
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    from scheduler import longest_first
+    groups = longest_first(groups, lambda group: sum(estimate_read_memory(job) for job in group))
+    """
+
+    return sorted(tasks, key=cost, reverse=True)
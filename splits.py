@@ -0,0 +1,111 @@
+import numpy as np
+
+'''
+This script contains the assignment of the polygons to the train, val and test splits, which is imported into preprocessing.py and segmentation_dataset_generation.py.
+Every polygon is assigned by a stable hash of its id and a seed, instead of drawing random rows of a year,
+so a polygon is in the same split in every year and every stage, no matter which other polygons are located on a tile in this year.
+'''
+
+SPLIT_SEED = 2023
+VAL_FRACTION = 0.1
+SPLITS = ['train', 'val', 'test']
+
+# These ids were hand validated
+# These polygons are validated to be well delineated mining areas for 2019
+HAND_VALIDATED_IDS = [1867, 2720, 3660, 3743, 3757, 3849, 3853, 4288, 4323, 4704, 4838, 4853,
+                        5139, 5162, 6808, 6809, 9227, 9945, 10256, 10258, 10338, 10514, 10753, 10844,
+                        11109, 11139, 11507, 11726, 12540, 13004, 13144, 13540, 14844, 15550, 15619,
+                        15872, 16087, 16242, 16516, 16656, 17616, 17764, 17766, 17895, 18058, 18126,
+                        18196, 18210, 18314, 18315, 18321, 18323, 18381, 18412, 18427, 18452, 18502,
+                        18520, 18529, 18545, 18558, 18586, 18596, 18603, 18605, 18624, 18636, 18691,
+                        18747, 18787, 18844, 18977, 18994, 19134, 19227, 19284, 19315, 19401, 19534,
+                        19716, 20578, 21048, 21194, 21217, 21234, 21532, 21938, 22017, 22215, 22386,
+                        23466, 23502, 23970, 24052, 24788, 26464, 26598, 26788, 26808, 27189, 27244,
+                        27249, 27250, 27573, 27588, 27672, 27698, 27823, 28043, 28235, 28245, 28299,
+                        28368, 28418, 28422, 28426, 28642, 28680, 28721, 28742, 29305, 29336, 29463,
+                        29538, 29766, 29978, 29994, 30216, 30268, 30276, 30643, 30931, 31638, 36191,
+                        36601, 37344, 37367, 37397, 37455, 37458, 37534, 37541, 37568, 37646, 37771,
+                        37786, 37813, 38412, 38459, 38510, 38555, 38579, 41338, 41855, 42268, 42783,
+                        43194, 43217, 43255, 43996, 44044, 44047, 44071, 44531, 44532, 44572, 45042,
+                        45878, 46161, 59191, 60251, 60501, 60522, 60528, 60573, 61268, 61330, 61758,
+                        62302, 62345, 63034, 63036, 64468, 64490, 64511, 64666, 65496, 66038, 67045,
+                        72444, 72479, 72733, 72779, 73184, 73470, 73528, 75192, 75926, 76524, 79590]
+
+# the increment and multipliers of splitmix64
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_MULTIPLIERS = (0xBF58476D1CE4E5B9, 0x94D049BB133111EB)
+
+
+def split_hash(ids:np.ndarray, seed:int=SPLIT_SEED) -> np.ndarray:
+    """
+    Returns a stable 64 bit hash of every polygon id, which only depends on the id and the seed, using the splitmix64 finalizer.
+    The hashes are uniformly distributed, so comparing them with a threshold selects a random fraction of the polygons.
+
+    Parameters
+    -------------
+
+    ids: The ids of the polygons.
+    type: np.ndarray
+    values: Any integers.
+    default: No default value.
+
+    seed: The seed of the hash.
+    type: int
+    values: Any non-negative integer.
+    default: 2023
+
+    Example
+    -------------
+
+    from splits import split_hash
+    hashes = split_hash(gdf['id'].to_numpy())
+    """
+
+    # unsigned integer arithmetic wraps around, as the hash requires
+    offset = np.uint64((seed + 1) * GOLDEN_GAMMA % 2**64)
+    z = np.asarray(ids, dtype=np.int64).astype(np.uint64) + offset
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX_MULTIPLIERS[0])
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX_MULTIPLIERS[1])
+    return z ^ (z >> np.uint64(31))
+
+
+def assign_splits(ids:np.ndarray, seed:int=SPLIT_SEED, val_fraction:float=VAL_FRACTION, test_ids:list=HAND_VALIDATED_IDS) -> np.ndarray:
+    """
+    Assigns every polygon to the 'train', 'val' or 'test' split in a single pass.
+    The hand validated polygons form the test split, and a val_fraction of the remaining polygons, selected by their hash, the val split.
+
+    Parameters
+    -------------
+
+    ids: The ids of the polygons.
+    type: np.ndarray
+    values: Any integers.
+    default: No default value.
+
+    seed: The seed of the hash, which selects the val split.
+    type: int
+    values: Any non-negative integer.
+    default: 2023
+
+    val_fraction: The expected fraction of the remaining polygons in the val split.
+    type: float
+    values: Between 0 and 1.
+    default: 0.1
+
+    test_ids: The ids of the polygons in the test split.
+    type: list
+    values: Any.
+    default: HAND_VALIDATED_IDS
+
+    Example
+    -------------
+
+    from splits import assign_splits
+    gdf['split'] = assign_splits(gdf['id'].to_numpy())
+    """
+
+    ids = np.asarray(ids, dtype=np.int64)
+    threshold = np.uint64(min(int(val_fraction * 2**64), 2**64 - 1))
+    splits = np.where(split_hash(ids, seed) < threshold, 'val', 'train').astype(object)
+    splits[np.isin(ids, test_ids)] = 'test'
+    return splits
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the pipeline are located in the repository root, which is not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+import numpy as np
+import rasterio
+import rasterio.merge
+import rasterio.transform
+import cv2
+
+from jobs import ChipJob
+from chips import save_chip
+from chipstore import PngChipWriter, ShardedChipWriter, ChipStore
+
+
+def write_tile(path, size=1024, seed=0):
+    # a four band uint16 reflectance tile like the NICFI quads
+    pixels = np.random.default_rng(seed).integers(0, 10000, (4, size, size)).astype(np.uint16)
+    transform = rasterio.transform.from_bounds(0, 0, size, size, size, size)
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=4, dtype='uint16', crs='EPSG:3857', transform=transform) as tile:
+        tile.write(pixels)
+
+
+def read_png(path):
+    # mmcv.imread reads .png files with cv2 as three channel 8 bit images by default
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def test_uint16_chip_is_read_the_same_from_png_and_shards(tmp_path):
+    write_tile(str(tmp_path / 'tile.tiff'))
+    job = ChipJob(7, ('0-0',), ((0, 0, 1024, 1024),), (0, 0, 1024, 1024), 1, 1, 256, 128, 512)
+
+    (tmp_path / 'img_dir').mkdir()
+    png_writer = PngChipWriter(str(tmp_path / 'img_dir'))
+    shard_writer = ShardedChipWriter(str(tmp_path / 'chips'))
+    with rasterio.open(str(tmp_path / 'tile.tiff')) as tile:
+        assert save_chip(job, [tile], png_writer) is not None
+        assert save_chip(job, [tile], shard_writer) is not None
+        chip = rasterio.merge.merge([tile], bounds=(256, 384, 768, 896), indexes=[1, 2, 3, 4])[0].T
+
+    png = read_png(str(tmp_path / 'img_dir' / '7.png'))
+    shard = np.ascontiguousarray(ChipStore(str(tmp_path / 'chips')).image('7')[:, :, :3])
+    assert png.dtype == shard.dtype == np.uint8
+    assert np.array_equal(png, shard)
+
+    # the same pixels stage 1 read from the 16 bit .png files written before both formats shared the conversion
+    cv2.imwrite(str(tmp_path / 'legacy.png'), 255*chip)
+    assert np.array_equal(read_png(str(tmp_path / 'legacy.png')), shard)
+    # and not saturated, as by clipping the uint16 pixels to 0 to 255
+    assert (shard < 255).mean() > 0.9
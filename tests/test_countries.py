@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from countries import CountryLookup
+
+
+def synthetic_countries():
+    # a 4x4 grid of countries, and one country overlapping four of them, so polygons intersect up to five countries
+    boxes = [shapely.box(x, y, x + 1, y + 1) for x in range(4) for y in range(4)] + [shapely.box(1.5, 1.5, 2.5, 2.5)]
+    names = ['Country {}'.format(i) for i in range(len(boxes))]
+    iso_codes = ['C{:02d}'.format(i) for i in range(len(boxes))]
+    return gpd.GeoDataFrame({'name': pd.Series(names, dtype=object), 'iso_a3': pd.Series(iso_codes, dtype=object)}, geometry=boxes, crs='EPSG:4326')
+
+
+def test_lookup_matches_the_former_ffill_over_all_countries(tmp_path):
+    countries = synthetic_countries()
+    rng = np.random.default_rng(2023)
+    centers = rng.uniform(-0.5, 4.5, (300, 2))
+    gdf = gpd.GeoDataFrame(geometry=[shapely.Point(center).buffer(radius) for center, radius in zip(centers, rng.uniform(0.01, 0.4, 300))], crs='EPSG:4326')
+
+    # the country assignment of the scripts before the lookup, which picks the last intersecting country
+    a = gdf['geometry'].apply(lambda x: x.intersects(countries.geometry))
+    expected_iso = (a * countries['iso_a3']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
+    expected_name = (a * countries['name']).replace('', np.nan).ffill(axis='columns').iloc[:, -1]
+
+    lookup = CountryLookup(countries.geometry.values, countries['name'].values, countries['iso_a3'].values)
+    # the saved index is looked up the same way
+    lookup.save(str(tmp_path / 'countries_index.npz'))
+    with np.load(str(tmp_path / 'countries_index.npz')) as index:
+        loaded = CountryLookup._from_index(index)
+
+    for countries_lookup in (lookup, loaded):
+        iso_codes, names = countries_lookup.lookup(gdf['geometry'].values)
+        pd.testing.assert_series_equal(pd.Series(iso_codes, name='iso'), expected_iso.rename('iso').reset_index(drop=True), check_dtype=False)
+        pd.testing.assert_series_equal(pd.Series(names, name='name'), expected_name.rename('name').reset_index(drop=True), check_dtype=False)
+    assert pd.isna(iso_codes).any() and (a.sum(axis=1) > 1).any()
+
+
+def test_largest_overlap_picks_the_country_covering_most_of_the_polygon():
+    countries = synthetic_countries()
+    lookup = CountryLookup(countries.geometry.values, countries['name'].values, countries['iso_a3'].values)
+    # mostly in the lower left country C00, slightly in C04 to the east
+    polygon = shapely.box(0.2, 0.2, 1.1, 0.8)
+
+    assert lookup.lookup(np.array([polygon]))[0][0] == 'C04'
+    assert lookup.lookup(np.array([polygon]), largest_overlap=True)[0][0] == 'C00'
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from cog import is_cog
+from downloads import TileDownloader
+from manifest import RunManifest
+from tilecache import TileCache
+
+
+def test_existing_quads_are_converted_when_cog_is_set(tmp_path):
+    filename = str(tmp_path / '1130-1013.tiff')
+    image = np.random.default_rng(2023).integers(0, 2**16, (4, 256, 256), dtype=np.uint16)
+    with rasterio.open(filename, 'w', driver='GTiff', width=256, height=256, count=4, dtype='uint16', crs='EPSG:3857',
+                       transform=from_origin(0, 0, 4.77, 4.77)) as dst:
+        dst.write(image)
+    assert not is_cog(filename)
+
+    manifest = RunManifest(str(tmp_path / 'manifest.sqlite'))
+    manifest.record('download', '1130-1013', filename)
+    cache = TileCache(str(tmp_path), budget=None)
+    # the quad already exists, so the client is never used
+    downloader = TileDownloader(None, str(tmp_path), manifest=manifest, cache=cache, cog=True)
+    assert downloader.fetch('1130-1013', None).result() == filename
+    downloader.shutdown()
+
+    assert is_cog(filename)
+    with rasterio.open(filename) as src:
+        assert (src.read() == image).all()
+    # the manifest and the cache know the converted quad
+    assert manifest.completed('download', ['1130-1013'], verify=True) == {'1130-1013'}
+    assert cache.usage == os.path.getsize(filename)
+    manifest.close()
+    cache.close()
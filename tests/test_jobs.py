@@ -0,0 +1,36 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from quads import QuadGrid
+from jobs import ChipPolygons, compile_chip_jobs, window_jobs
+from chips import rasterize_mask
+from utils import local_to_global_bounds
+from benchmarks.world import quads_frame
+
+
+def test_window_inside_polygon_has_full_mask():
+    # a large square mine on a single quad, whose native resolution windows mostly contain none of its points
+    grid = QuadGrid()
+    x, y = grid.quad_indices(np.array([20.5]), np.array([-4.5]))
+    minx, miny, maxx, maxy = grid.quad_bounds(x, y)[0]
+    center_x, center_y = (minx + maxx) / 2, (miny + maxy) / 2
+    size = 0.8 * (maxx - minx) / 2
+    mine = shapely.box(center_x - size, center_y - size, center_x + size, center_y + size)
+
+    gdf = gpd.GeoDataFrame({'id': [0]}, geometry=[mine], crs='EPSG:4326')
+    gdf['tile_ids'] = [np.array(grid.quads_for_bounds([mine.bounds])[0], dtype=object)]
+    polygons = ChipPolygons(gdf['geometry'].values)
+    windows = window_jobs(compile_chip_jobs(gdf, quads_frame(gdf['tile_ids'][0])))
+    assert len(windows) > 1
+
+    inside = 0
+    for job in windows:
+        mask = rasterize_mask(job, polygons)
+        window = local_to_global_bounds(job.x_offset, job.y_offset, job.bbox_size, job.tile_bboxes)
+        if mine.contains(window):
+            inside += 1
+            assert mask.all(), 'window {} is inside the polygon but its mask is not full'.format(job.name)
+        elif not mine.intersects(window):
+            assert not mask.any()
+    assert inside > 0
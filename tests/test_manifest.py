@@ -0,0 +1,71 @@
+import os
+import numpy as np
+
+from jobs import ChipJob
+from chipstore import PngChipWriter, ShardedChipWriter
+from manifest import RunManifest
+
+
+def chip_job(id):
+    return ChipJob(id, ('0-0',), ((0, 0, 1, 1),), (0, 0, 1, 1), 1, 1, 0, 0, 512)
+
+
+def test_png_chips_are_skipped_only_while_unchanged(tmp_path):
+    for directory in ('img_dir', 'ann_dir'):
+        os.makedirs(str(tmp_path / directory))
+    writer = PngChipWriter(str(tmp_path / 'img_dir'), str(tmp_path / 'ann_dir'))
+    manifest = RunManifest(str(tmp_path / 'manifest.sqlite'))
+    paths = {}
+    for id in range(4):
+        entries = writer.write(chip_job(id), np.full((8, 8, 4), 10 * id, np.uint8), np.ones((8, 8), np.uint8))
+        manifest.record_many(entries)
+        paths[str(id)] = entries[0][2]
+    manifest.close()
+
+    # a restarted run reads the manifest again
+    manifest = RunManifest(str(tmp_path / 'manifest.sqlite'))
+    ids = ['0', '1', '2', '3', '4']
+    assert manifest.completed('image', ids) == {'0', '1', '2', '3'}
+    assert manifest.completed('mask', ids) == {'0', '1', '2', '3'}
+
+    os.remove(paths['0'])
+    with open(paths['1'], 'ab') as file:
+        file.write(b'\x00')
+    # a changed chip of the same size is only found by verifying
+    with open(paths['2'], 'r+b') as file:
+        file.seek(-5, os.SEEK_END)
+        file.write(b'\xff')
+    assert manifest.completed('image', ids) == {'2', '3'}
+    assert manifest.completed('image', ids, verify=True) == {'3'}
+
+    # rewriting a chip records it again, and the latest entry counts
+    manifest.record_many(writer.write(chip_job(1), np.full((8, 8, 4), 10, np.uint8), np.ones((8, 8), np.uint8)))
+    assert manifest.completed('image', ids, verify=True) == {'1', '3'}
+    manifest.close()
+
+
+def write_shard_chips(tmp_path, manifest, n=3):
+    writer = ShardedChipWriter(str(tmp_path / 'chips'), masks=True, chip_size=8)
+    for id in range(n):
+        entries = writer.write(chip_job(id), np.full((8, 8, 4), id), np.ones((8, 8), np.uint8))
+        manifest.record_many(entries)
+    return entries[0][2], entries[1][2]
+
+
+def test_shard_records_are_skipped_only_while_complete(tmp_path):
+    manifest = RunManifest(str(tmp_path / 'manifest.sqlite'))
+    images, masks = write_shard_chips(tmp_path, manifest)
+    assert manifest.completed('shard_image', ['0', '1', '2']) == {'0', '1', '2'}
+    assert manifest.completed('shard_mask', ['0', '1', '2']) == {'0', '1', '2'}
+
+    # the last record was not completely written
+    with open(images, 'r+b') as file:
+        file.truncate(2 * 8 * 8 * 4 + 10)
+    assert manifest.completed('shard_image', ['0', '1', '2']) == {'0', '1'}
+
+    # a changed record is only found by verifying
+    with open(masks, 'r+b') as file:
+        file.seek(8 * 8)
+        file.write(b'\x00')
+    assert manifest.completed('shard_mask', ['0', '1', '2']) == {'0', '1', '2'}
+    assert manifest.completed('shard_mask', ['0', '1', '2'], verify=True) == {'0', '2'}
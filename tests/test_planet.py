@@ -0,0 +1,107 @@
+import os
+import time
+import pytest
+
+from benchmarks.world import StubPlanetAPI, MOSAIC_NAME, download_url
+from planet import PlanetClient, CircuitOpenError
+
+QUAD_ID = '1130-1013'
+
+
+class RateLimitedAPI(StubPlanetAPI):
+    """
+    A stub of the Planet API which rejects the first requests with 429 and a Retry-After header,
+    cuts off the first download halfway, and fails every request with 503 while failing is set.
+    """
+
+    def __init__(self, quad_dir, rejected=2, retry_after=0.2):
+        super().__init__(quad_dir)
+        self.rejected = rejected
+        self.retry_after = retry_after
+        self.failing = False
+        self.attempts = 0
+        self.ranges = []
+        self._truncated = False
+
+    def _handle(self, handler):
+        with self._lock:
+            self.attempts += 1
+        if self.failing:
+            return self._send(handler, 503, b'{}')
+        with self._lock:
+            rejected = self.rejected > 0
+            self.rejected -= rejected
+        if rejected:
+            return self._send(handler, 429, b'{}', headers={'Retry-After': str(self.retry_after)})
+
+        if handler.path.endswith('/full'):
+            self.ranges.append(handler.headers.get('Range'))
+            if not self._truncated:
+                self._truncated = True
+                with open(os.path.join(self.quad_dir, QUAD_ID + '.tiff'), 'rb') as file:
+                    data = file.read()
+                handler.send_response(200)
+                handler.send_header('Content-Length', str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data[:len(data) // 2])
+                handler.wfile.flush()
+                handler.close_connection = True
+                return
+        return super()._handle(handler)
+
+
+@pytest.fixture
+def quad(tmp_path):
+    quad_dir = tmp_path / 'quads'
+    quad_dir.mkdir()
+    data = os.urandom(3 * 2**20)
+    (quad_dir / (QUAD_ID + '.tiff')).write_bytes(data)
+    return str(quad_dir), data
+
+
+def test_rate_limited_requests_wait_for_retry_after(quad):
+    quad_dir, _ = quad
+    client = PlanetClient('key', rate=100, burst=1, backoff_base=0.01, failure_threshold=1)
+    with RateLimitedAPI(quad_dir, rejected=2, retry_after=0.2) as api:
+        start = time.monotonic()
+        mosaic = client.get_json(api.url, params={'name__is': MOSAIC_NAME})
+        elapsed = time.monotonic() - start
+
+    assert mosaic['mosaics'][0]['name'] == MOSAIC_NAME
+    assert api.attempts == 3
+    # both 429 responses paused the bucket, and being rate limited never opens the circuit breaker
+    assert elapsed >= 0.4
+    client.breaker.check()
+
+
+def test_interrupted_downloads_are_resumed_without_using_the_api_quota(quad, tmp_path):
+    quad_dir, data = quad
+    client = PlanetClient('key', rate=1e-3, burst=1, backoff_base=0.01)
+    filename = str(tmp_path / 'quad.tiff')
+    with RateLimitedAPI(quad_dir, rejected=1, retry_after=0.1) as api:
+        client.download(download_url(api.url, QUAD_ID), filename)
+        # the only token of the API bucket is still available, so this request is not delayed by the downloads
+        start = time.monotonic()
+        client.get_json(api.url, params={'name__is': MOSAIC_NAME})
+        assert time.monotonic() - start < 1
+
+    with open(filename, 'rb') as file:
+        assert file.read() == data
+    assert not os.path.exists(filename + '.part')
+    assert api.ranges[0] is None and api.ranges[1].startswith('bytes=') and api.ranges[1] != 'bytes=0-'
+
+
+def test_persistent_server_errors_open_the_circuit_breaker(quad):
+    quad_dir, _ = quad
+    client = PlanetClient('key', rate=100, max_retries=5, backoff_base=0.01, failure_threshold=3, cooldown=60)
+    with RateLimitedAPI(quad_dir, rejected=0) as api:
+        api.failing = True
+        with pytest.raises(CircuitOpenError):
+            client.get(api.url, params={'name__is': MOSAIC_NAME})
+        assert api.attempts == 3
+
+        # the breaker stays open for all further requests, which are not sent at all
+        api.failing = False
+        with pytest.raises(CircuitOpenError):
+            client.get(api.url, params={'name__is': MOSAIC_NAME})
+        assert api.attempts == 3
@@ -0,0 +1,94 @@
+import math
+import numpy as np
+import pandas as pd
+import shapely
+
+from benchmarks.world import MOSAIC_ID, StubPlanetAPI, synthetic_mines
+from planet import PlanetClient
+from quads import QuadCatalog, QuadGrid, assign_quads, parallel_process_tile
+
+
+def test_quad_searches_are_kept_across_catalogs(tmp_path):
+    path = str(tmp_path / 'quad_catalog.sqlite')
+    items = [{'id': '1015-1061', 'bbox': [-1.58, 6.49, -1.41, 6.66], '_links': {'download': 'https://example.com/1015-1061/full'}},
+             {'id': '1016-1061', 'bbox': [-1.41, 6.49, -1.23, 6.66], '_links': {}}]
+    bounds = (-1.5, 6.5, -1.3, 6.6)
+
+    catalog = QuadCatalog(path)
+    assert catalog.get_search('mosaic', bounds) is None
+    catalog.put_search('mosaic', bounds, items)
+    catalog.close()
+
+    catalog = QuadCatalog(path)
+    # floating point noise does not change the key of a search, but other mosaics do
+    assert catalog.get_search('mosaic', tuple(value + 1e-12 for value in bounds)) == ['1015-1061', '1016-1061']
+    assert catalog.get_search('other mosaic', bounds) is None
+
+    quads = catalog.quads_frame('mosaic')
+    assert quads.loc['1015-1061', ['minx', 'miny', 'maxx', 'maxy']].tolist() == items[0]['bbox']
+    assert quads.at['1015-1061', 'link'] == 'https://example.com/1015-1061/full'
+    assert pd.isna(quads.at['1016-1061', 'link'])
+    catalog.close()
+
+
+def slippy_tile(lon, lat, zoom=15):
+    # the XYZ tile of a coordinate, counted from the north, which NICFI quads group by 16x16
+    n = 2**zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def test_quad_ids_match_the_nicfi_names_of_their_xyz_tiles():
+    grid = QuadGrid()
+    for lon, lat in [(-1.5, 6.5), (-60.2, -3.1), (20.5, -4.5), (113.9, 0.7), (0.0001, 0.0001)]:
+        tile_x, tile_y = slippy_tile(lon, lat)
+        expected = 'L15-{:04d}E-{:04d}N'.format(tile_x // 16, (2**15 - 1 - tile_y) // 16)
+
+        x, y = grid.quad_indices(np.array([lon]), np.array([lat]))
+        assert grid.quad_name(x, y)[0] == expected
+        assert grid.quad_id(x, y)[0] == '{}-{}'.format(x[0], y[0])
+        parsed_x, parsed_y = grid.parse_quad_id([expected])
+        assert (parsed_x[0], parsed_y[0]) == (x[0], y[0])
+
+    # the quad starting at the equator and the prime meridian
+    assert grid.quad_name(*grid.quad_indices(0.0, 0.0))[0] == 'L15-1024E-1024N'
+    np.testing.assert_allclose(grid.quad_bounds(1024, 1024)[0, :2], [0.0, 0.0], atol=1e-9)
+
+
+def test_quads_touching_a_bbox_are_left_out_like_by_assign_quads():
+    grid = QuadGrid()
+    x, y = grid.quad_indices(0.0, 6.5)
+    minx, miny, _, maxy = grid.quad_bounds(x - 1, y)[0]
+    # a bbox ending exactly on the western edge of quad x
+    bbox = (minx + 0.01, miny + 0.01, grid.quad_bounds(x, y)[0, 0], maxy - 0.01)
+
+    ids = grid.quads_for_bounds([bbox])[0]
+    assert list(ids) == grid.quad_id([x - 1], [y]).tolist()
+
+    items = [{'id': id, 'bbox': bounds.tolist()} for id, bounds in zip(grid.quad_id([x - 1, x], [y, y]), grid.quad_bounds([x - 1, x], [y, y]))]
+    assert [item['id'] for item in assign_quads([bbox], items)[0]] == list(ids)
+
+
+def test_searched_quads_match_the_quads_on_the_grid(tmp_path):
+    grid = QuadGrid()
+    gdf = synthetic_mines(200)
+    grid_tile_ids = grid.quads_for_bounds(shapely.bounds(gdf['bbox'].to_numpy()))
+    for quad_id in np.unique(np.concatenate(grid_tile_ids)):
+        (tmp_path / '{}.tiff'.format(quad_id)).write_bytes(b'')
+
+    gdf['tile_ids'] = [np.array([], dtype=object) for _ in range(len(gdf))]
+    catalog = QuadCatalog(str(tmp_path / 'quad_catalog.sqlite'))
+    with StubPlanetAPI(str(tmp_path)) as api:
+        parallel_process_tile(gdf, MOSAIC_ID, api.url, PlanetClient('key', rate=1e6, burst=10**6), catalog)
+        requests = api.requests
+        # searches are only sent once, later runs read them from the catalog
+        searched_tile_ids = gdf['tile_ids']
+        gdf['tile_ids'] = [np.array([], dtype=object) for _ in range(len(gdf))]
+        parallel_process_tile(gdf, MOSAIC_ID, api.url, PlanetClient('key', rate=1e6, burst=10**6), catalog)
+        assert api.requests == requests
+    assert all(sorted(a) == sorted(b) for a, b in zip(searched_tile_ids, gdf['tile_ids']))
+
+    for searched, calculated in zip(gdf['tile_ids'], grid_tile_ids):
+        assert sorted(searched) == sorted(calculated)
+    catalog.close()
@@ -0,0 +1,28 @@
+import numpy as np
+
+from splits import split_hash, assign_splits, HAND_VALIDATED_IDS
+
+
+def test_split_hash_is_splitmix64():
+    # the first two outputs of splitmix64 seeded with 0, which states seed + 1 and seed + 2 times the golden gamma
+    assert int(split_hash([0], seed=0)[0]) == 0xE220A8397B1DCDAF
+    assert int(split_hash([0], seed=1)[0]) == 0x6E789E6AA1B965F4
+
+
+def test_splits_are_stable_and_independent_of_other_polygons():
+    ids = np.arange(1, 41)
+    # the splits of the default seed must never change, since they decide which polygons the models are trained on
+    splits = assign_splits(ids)
+    assert ids[splits == 'val'].tolist() == [5, 8, 12, 30]
+    assert (splits[splits != 'val'] == 'train').all()
+
+    rng = np.random.default_rng(2023)
+    all_ids = rng.choice(10**6, 20000, replace=False)
+    splits = assign_splits(all_ids)
+    subset = rng.choice(len(all_ids), 1000, replace=False)
+    assert (assign_splits(all_ids[subset]) == splits[subset]).all()
+    assert (assign_splits(all_ids[::-1]) == splits[::-1]).all()
+
+    assert abs((splits == 'val').mean() - 0.1) < 0.01
+    assert (assign_splits(np.array(HAND_VALIDATED_IDS)) == 'test').all()
+    assert (assign_splits(all_ids, seed=1) != splits).any()
@@ -0,0 +1,51 @@
+import os
+from tilecache import TileCache
+
+
+def write_quad(directory, name, size=1000):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+
+def test_quads_are_evicted_by_demand_then_use(tmp_path):
+    cache = TileCache(str(tmp_path), budget=None)
+    rare, frequent, planned = (write_quad(str(tmp_path), name) for name in ('rare.tiff', 'frequent.tiff', 'planned.tiff'))
+    for path in (rare, frequent, planned):
+        cache.add(path)
+    for _ in range(3):
+        cache.pin([frequent])
+        cache.unpin([frequent])
+    cache.pin([rare])
+    cache.unpin([rare])
+    cache.plan([planned])
+
+    cache.budget = 2000
+    assert cache.evict() == 1000
+    assert not os.path.exists(rare) and os.path.exists(frequent) and os.path.exists(planned)
+
+    # the remaining demand keeps a quad longer than any number of earlier uses
+    cache.budget = 1000
+    assert cache.evict() == 1000
+    assert not os.path.exists(frequent) and os.path.exists(planned)
+    cache.close()
+
+
+def test_quads_pinned_by_another_cache_are_kept(tmp_path):
+    first = TileCache(str(tmp_path), budget=None)
+    pinned = write_quad(str(tmp_path), 'pinned.tiff')
+    first.add(pinned)
+    first.pin([pinned])
+
+    # a second run on the same directory neither resets the statistics nor deletes the quad in use
+    second = TileCache(str(tmp_path), budget=0)
+    other = write_quad(str(tmp_path), 'other.tiff')
+    second.add(other)
+    assert os.path.exists(pinned) and not os.path.exists(other)
+
+    first.unpin([pinned])
+    assert second.evict() == 1000
+    assert not os.path.exists(pinned)
+    first.close()
+    second.close()
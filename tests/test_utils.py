@@ -0,0 +1,107 @@
+import numpy as np
+import shapely
+
+from quads import QuadGrid
+from utils import get_bbox_batch, count_tiles_batch, global_to_local_coords_batch, check_if_inside_bbox_batch, replace_at_bbox_borders_batch
+
+
+# the scalar helpers as they were before the batch versions, which the batch versions need to reproduce
+
+def reference_get_bbox(polygon):
+    minx, miny, maxx, maxy = polygon.bounds
+    max_len = max([maxx-minx, maxy-miny])
+    return shapely.Point([(maxx+minx)/2, (maxy+miny)/2]).buffer(distance=max_len, quad_segs=1, cap_style='square')
+
+
+def reference_count_tiles(tile_bboxes):
+    mosaic_bbox = list(tile_bboxes[0])
+    x_tile_counter, y_tile_counter = 1, 1
+    for bbox in tile_bboxes[1:]:
+        if bbox[0] < mosaic_bbox[0]:
+            mosaic_bbox[0] = bbox[0]
+            x_tile_counter += 1
+        if bbox[1] < mosaic_bbox[1]:
+            mosaic_bbox[1] = bbox[1]
+            y_tile_counter += 1
+        if bbox[2] > mosaic_bbox[2]:
+            mosaic_bbox[2] = bbox[2]
+            x_tile_counter += 1
+        if bbox[3] > mosaic_bbox[3]:
+            mosaic_bbox[3] = bbox[3]
+            y_tile_counter += 1
+    return mosaic_bbox, x_tile_counter, y_tile_counter
+
+
+def reference_global_to_local_coords(poly, tile_bboxes, is_bbox=False):
+    mosaic_bbox, x_tile_counter, y_tile_counter = reference_count_tiles(tile_bboxes)
+    tile_size_x = mosaic_bbox[2] - mosaic_bbox[0]
+    tile_size_y = mosaic_bbox[3] - mosaic_bbox[1]
+    poly = np.array(poly.exterior.coords)
+    for i in range(len(poly)):
+        poly[i][0] = np.round(((poly[i][0] - mosaic_bbox[0])/tile_size_x) * 4096 * x_tile_counter)
+        poly[i][1] = np.round(((poly[i][1] - mosaic_bbox[1])/tile_size_y) * 4096 * y_tile_counter)
+        poly[i][1] = 4096 * y_tile_counter - poly[i][1]
+    if is_bbox:
+        bbox_size = int(poly[1][0] - poly[3][0])
+        delta = ((bbox_size // 512) + 1) * 512 - bbox_size
+        poly[0][0] = poly[1][0] = poly[4][0] = poly[0][0] + delta
+        poly[1][1] = poly[2][1] = poly[1][1] + delta
+    return poly[:, 0], poly[:, 1]
+
+
+def reference_replace_at_bbox_borders(x, y, bbox_size, poly_positions):
+    new_x, new_y = list(x), list(y)
+    for i in range(len(poly_positions)):
+        if not poly_positions[i]:
+            new_x[i] = min(max(new_x[i], 0), bbox_size)
+            new_y[i] = min(max(new_y[i], 0), bbox_size)
+    return new_x, new_y
+
+
+def random_mines(n, seed=2023):
+    # mines of different sizes on one, two or four quads around the corner of quad 1130-1013
+    grid = QuadGrid()
+    rng = np.random.default_rng(seed)
+    corner = grid.quad_bounds(1130, 1013)[0, :2]
+    centers = corner + rng.uniform(-0.01, 0.01, (n, 2))
+    radii = rng.uniform(0.0005, 0.005, n)
+    return np.array([shapely.Point(center).buffer(radius, quad_segs=rng.integers(2, 8)) for center, radius in zip(centers, radii)])
+
+
+def test_batch_helpers_match_the_scalar_helpers():
+    grid = QuadGrid()
+    mines = random_mines(200)
+    bboxes = get_bbox_batch(mines)
+    for mine, bbox in zip(mines, bboxes):
+        # global_to_local_coords relies on the vertex order of the bboxes
+        np.testing.assert_allclose(shapely.get_coordinates(bbox), shapely.get_coordinates(reference_get_bbox(mine)), atol=1e-12)
+
+    tile_bboxes = [grid.quad_bounds(*grid.parse_quad_id(ids)) for ids in grid.quads_for_bounds(shapely.bounds(bboxes))]
+    assert set(map(len, tile_bboxes)) == {1, 2, 4}
+    offsets = np.concatenate([[0], np.cumsum([len(tiles) for tiles in tile_bboxes])])
+    mosaic_bboxes, widths, heights = count_tiles_batch(np.concatenate(tile_bboxes), offsets)
+    for i, tiles in enumerate(tile_bboxes):
+        mosaic_bbox, width, height = reference_count_tiles(tiles)
+        np.testing.assert_array_equal(mosaic_bboxes[i], mosaic_bbox)
+        assert (widths[i], heights[i]) == (width, height)
+
+    for polys, is_bbox in ((mines, False), (bboxes, True)):
+        x, y, coord_offsets = global_to_local_coords_batch(polys, mosaic_bboxes, widths, heights, is_bbox)
+        for i, (poly, tiles) in enumerate(zip(polys, tile_bboxes)):
+            expected_x, expected_y = reference_global_to_local_coords(poly, tiles, is_bbox)
+            np.testing.assert_array_equal(x[coord_offsets[i]:coord_offsets[i+1]], expected_x)
+            np.testing.assert_array_equal(y[coord_offsets[i]:coord_offsets[i+1]], expected_y)
+
+    # clipping every mine to a random 512x512 window of its mosaic
+    x, y, coord_offsets = global_to_local_coords_batch(mines, mosaic_bboxes, widths, heights)
+    rng = np.random.default_rng(2023)
+    x_offsets, y_offsets = rng.integers(0, 4096, len(mines)), rng.integers(0, 4096, len(mines))
+    counts = np.diff(coord_offsets)
+    positions = check_if_inside_bbox_batch(x, y, np.repeat(x_offsets, counts), np.repeat(y_offsets, counts), 512)
+    new_x, new_y = replace_at_bbox_borders_batch(x - np.repeat(x_offsets, counts), y - np.repeat(y_offsets, counts), 512, positions)
+    for i in range(len(mines)):
+        part = slice(coord_offsets[i], coord_offsets[i+1])
+        assert positions[part].tolist() == [bool((x_offsets[i] <= x_i <= x_offsets[i]+512) and (y_offsets[i] <= y_i <= y_offsets[i]+512))
+                                            for x_i, y_i in zip(x[part], y[part])]
+        expected_x, expected_y = reference_replace_at_bbox_borders(x[part] - x_offsets[i], y[part] - y_offsets[i], 512, positions[part])
+        assert new_x[part].tolist() == expected_x and new_y[part].tolist() == expected_y
@@ -0,0 +1,244 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+'''
+This script contains a size-bounded cache of the downloaded quads of all years, which is imported into segmentation_dataset_generation.py.
+Once the quads exceed the byte budget, quads are deleted until they fit again. Quads which are still needed by polygons of the current run are kept longest,
+and quads which are in use are never deleted. How often and when every quad was used is persisted, so eviction decisions survive across runs.
+The statistics and the quads in use are kept in a SQLite file, so runs of several years at the same time can share the same directory.
+'''
+
+CACHE_POLICIES = ['lfu', 'lru']
+
+
+class TileCache:
+    """
+    Keeps track of the size, use and remaining demand of all quads in a directory, and deletes quads once their total size exceeds the budget.
+    Quads without remaining demand in the current run are deleted first, then the ones with the lowest remaining demand.
+    Among these, either the least frequently used quads (lfu) or the least recently used quads (lru) are deleted first.
+    If all quads are in use, the budget may be exceeded until some of them are released. The cache can be shared by multiple threads,
+    and by multiple processes on the same machine using the same directory, which never delete quads used by each other.
+
+    Parameters
+    -------------
+
+    directory: The directory containing the quads of all years, in one subdirectory per year.
+    type: str
+    values: Any.
+    default: './data/tiff_tiles'
+
+    budget: The maximum total size of the quads in bytes, or None for an unbounded cache which only keeps statistics.
+    type: int
+    values: Any positive integer.
+    default: None
+
+    policy: The order quads with the same remaining demand are deleted in.
+    type: str
+    values: 'lfu' or 'lru'.
+    default: 'lfu'
+
+    stats_path: The path of the SQLite file the statistics are persisted in.
+    type: str
+    values: Any.
+    default: cache.sqlite inside directory.
+
+    Example
+    -------------
+
+    from tilecache import TileCache
+    cache = TileCache('./data/tiff_tiles', budget=500 * 2**30)
+    cache.plan(my_tile_paths)
+    cache.pin(my_tile_paths)
+    ...
+    cache.unpin(my_tile_paths, done=True)
+
+    """
+
+    def __init__(self, directory:str='./data/tiff_tiles', budget:int=None, policy:str='lfu', stats_path:str=None):
+        assert (policy in CACHE_POLICIES), "Unknown cache policy {}.".format(policy)
+        self.directory = directory
+        self.budget = budget
+        self.policy = policy
+        self.stats_path = stats_path if stats_path is not None else os.path.join(directory, 'cache.sqlite')
+
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._demand = {}
+        # pins are owned by every cache, so several caches of the same process do not release each other's pins
+        self._owner = uuid.uuid4().hex
+
+        os.makedirs(directory, exist_ok=True)
+        # other processes may hold the database while they evict quads
+        self._connection = sqlite3.connect(self.stats_path, timeout=600, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS tiles (
+                                            path TEXT PRIMARY KEY,
+                                            size INTEGER NOT NULL,
+                                            hits INTEGER NOT NULL,
+                                            last_used REAL NOT NULL)''')
+            # the quads in use by every process, which must not be deleted by any of them
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS pins (
+                                            path TEXT NOT NULL,
+                                            owner TEXT NOT NULL,
+                                            pid INTEGER NOT NULL,
+                                            count INTEGER NOT NULL,
+                                            PRIMARY KEY (path, owner))''')
+
+            # quads which were downloaded without the cache are registered, and quads which were deleted by hand are forgotten,
+            # without touching the statistics of all other quads, which may be updated by other processes at the same time
+            paths = []
+            for root, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    if filename.endswith('.tiff'):
+                        path = os.path.normpath(os.path.join(root, filename))
+                        paths.append((path, os.path.getsize(path), os.path.getmtime(path)))
+            self._connection.executemany('INSERT OR IGNORE INTO tiles VALUES (?, ?, 0, ?)', paths)
+            existing = set(path for path, _, _ in paths)
+            missing = [(path,) for path, in self._connection.execute('SELECT path FROM tiles') if path not in existing]
+            self._connection.executemany('DELETE FROM tiles WHERE path = ?', missing)
+
+
+    @property
+    def usage(self) -> int:
+        """
+        The total size of all cached quads in bytes.
+        """
+
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+
+
+    def plan(self, paths:list):
+        """
+        Registers that the given quads will be used by the current run, once per use, so they are kept until they were used as often.
+        """
+
+        with self._lock:
+            for path in map(os.path.normpath, paths):
+                self._demand[path] = self._demand.get(path, 0) + 1
+
+
+    def pin(self, paths:list):
+        """
+        Marks the given quads as in use, so they are not deleted by any process until they are unpinned, and records their use.
+        Quads can be pinned before they are downloaded.
+        """
+
+        now = time.time()
+        with self._lock, self._connection:
+            for path in map(os.path.normpath, paths):
+                self._pins[path] = self._pins.get(path, 0) + 1
+                self._connection.execute('''INSERT INTO pins VALUES (?, ?, ?, 1)
+                                            ON CONFLICT (path, owner) DO UPDATE SET count = count + 1''', (path, self._owner, os.getpid()))
+                self._connection.execute('UPDATE tiles SET hits = hits + 1, last_used = ? WHERE path = ?', (now, path))
+
+
+    def unpin(self, paths:list, done:bool=True):
+        """
+        Releases the given quads, and if done is set, also one of their planned uses. Afterwards, quads are deleted if the budget is exceeded.
+        """
+
+        with self._lock, self._connection:
+            for path in map(os.path.normpath, paths):
+                self._pins[path] -= 1
+                if self._pins[path] == 0:
+                    del self._pins[path]
+                    self._connection.execute('DELETE FROM pins WHERE path = ? AND owner = ?', (path, self._owner))
+                else:
+                    self._connection.execute('UPDATE pins SET count = count - 1 WHERE path = ? AND owner = ?', (path, self._owner))
+                if done and self._demand.get(path, 0) > 0:
+                    self._demand[path] -= 1
+        self.evict()
+
+
+    def add(self, path:str):
+        """
+        Registers a downloaded quad, and deletes other quads if the budget is exceeded.
+        """
+
+        path = os.path.normpath(path)
+        now = time.time()
+        with self._lock, self._connection:
+            # quads which were pinned while being downloaded count their use now, known quads which were rewritten already counted it
+            hits = 1 if path in self._pins else 0
+            self._connection.execute('''INSERT INTO tiles VALUES (?, ?, ?, ?)
+                                        ON CONFLICT (path) DO UPDATE SET size = excluded.size, last_used = excluded.last_used''',
+                                     (path, os.path.getsize(path), hits, now))
+        self.evict()
+
+
+    def _eviction_order(self, path:str, hits:int, last_used:float) -> tuple:
+        demand = self._demand.get(path, 0)
+        if self.policy == 'lfu':
+            return (demand, hits, last_used)
+        return (demand, last_used)
+
+
+    def _pinned(self) -> set:
+        # pins of processes which ended without unpinning their quads are dropped
+        pinned = set()
+        for pid, in self._connection.execute('SELECT DISTINCT pid FROM pins').fetchall():
+            if not process_exists(pid):
+                self._connection.execute('DELETE FROM pins WHERE pid = ?', (pid,))
+        for path, in self._connection.execute('SELECT DISTINCT path FROM pins'):
+            pinned.add(path)
+        return pinned
+
+
+    def evict(self) -> int:
+        """
+        Deletes quads which are not pinned by any process until the cached quads fit into the budget, and returns the number of deleted bytes.
+        """
+
+        if self.budget is None:
+            return 0
+
+        freed = 0
+        with self._lock, self._connection:
+            # the whole eviction is one write transaction, so no other process pins or deletes quads in the meantime
+            self._connection.execute('BEGIN IMMEDIATE')
+            tiles = self._connection.execute('SELECT path, size, hits, last_used FROM tiles').fetchall()
+            usage = sum(size for _, size, _, _ in tiles)
+            if usage <= self.budget:
+                return 0
+
+            pinned = self._pinned()
+            candidates = sorted((tile for tile in tiles if tile[0] not in pinned), key=lambda tile: self._eviction_order(tile[0], tile[2], tile[3]))
+            for path, size, _, _ in candidates:
+                if usage - freed <= self.budget:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                freed += size
+                self._connection.execute('DELETE FROM tiles WHERE path = ?', (path,))
+
+        if freed > 0:
+            print('Evicted {:.1f} GB of quads from the tile cache'.format(freed / 2**30))
+        return freed
+
+
+    def close(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM pins WHERE owner = ?', (self._owner,))
+        with self._lock:
+            self._connection.close()
+
+
+
+def process_exists(pid:int) -> bool:
+    """
+    Returns True if a process with the given id is running on this machine.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -3,6 +3,7 @@ import pandas as pd
 import shapely
 import shapely.geometry
 import shapely.ops
+import cv2
 from scipy.ndimage import binary_erosion, binary_opening, binary_fill_holes
 
 '''
@@ -29,16 +30,41 @@ def get_bbox(polygon:shapely.geometry.polygon.Polygon) -> shapely.geometry.polyg
 
     """
 
-    minx, miny, maxx, maxy = polygon.bounds
+    return get_bbox_batch(np.array([polygon]))[0]
+
+
+
+def get_bbox_batch(polygons) -> np.ndarray:
+    """
+    Returns a square bounding box for every polygon in an array of polygons, in a single pass.
+    The bounding boxes have the same vertex order as a square buffer around the centroid of the polygon bounds,
+    starting at the upper right corner, which global_to_local_coords relies on.
+
+    Parameters
+    -------------
+
+    polygons: An array of shapely polygons for which bounding boxes should be generated.
+    type: np.ndarray or geopandas.array.GeometryArray
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    import get_bbox_batch from utils
+    gdf['bbox'] = get_bbox_batch(gdf['geometry'].values)
+
+    """
+
+    minx, miny, maxx, maxy = shapely.bounds(np.asarray(polygons)).T
     #Using three times the max side length of the polygon for the bbox side length
-    max_len = max([maxx-minx, maxy-miny])
+    max_len = np.maximum(maxx-minx, maxy-miny)
     x_centroid = (maxx+minx)/2
     y_centroid = (maxy+miny)/2
 
-    #centroid = [random.uniform(x_centroid - max_len/4, x_centroid + max_len/4), random.uniform(y_centroid - max_len/4, y_centroid + max_len/4)]
-    centroid = [x_centroid, y_centroid]
-    #return shapely.Point(centroid).buffer(distance=random.uniform(3*max_len/4, max_len), quad_segs=1, cap_style='square')
-    return shapely.Point(centroid).buffer(distance=max_len, quad_segs=1, cap_style='square')
+    x = np.stack([x_centroid + max_len, x_centroid + max_len, x_centroid - max_len, x_centroid - max_len, x_centroid + max_len], axis=1)
+    y = np.stack([y_centroid + max_len, y_centroid - max_len, y_centroid - max_len, y_centroid + max_len, y_centroid + max_len], axis=1)
+    return shapely.polygons(np.stack([x, y], axis=2))
 
 
 
@@ -63,33 +89,63 @@ def count_tiles(tile_bboxes:list) -> (int, int):
 
     """
 
-    mosaic_bbox = tile_bboxes[0].copy()
-    x_tile_counter = 1
-    y_tile_counter = 1
-
-    #if the polygon is located on more than one tile
-    if len(tile_bboxes) > 1:
-        #calculating the bounding box of the mosaic composed by the individual tiles
-        #and noting the tile positioning
-        for bbox in tile_bboxes[1:]:
-            #x+
-            if bbox[0] < mosaic_bbox[0]: 
-                mosaic_bbox[0] = bbox[0]
-                x_tile_counter += 1
-            #y+
-            if bbox[1] < mosaic_bbox[1]: 
-                mosaic_bbox[1] = bbox[1]
-                y_tile_counter += 1
-            #x-
-            if bbox[2] > mosaic_bbox[2]: 
-                mosaic_bbox[2] = bbox[2]
-                x_tile_counter += 1
-            #y-
-            if bbox[3] > mosaic_bbox[3]: 
-                mosaic_bbox[3] = bbox[3]
-                y_tile_counter += 1
-
-    return mosaic_bbox, x_tile_counter, y_tile_counter
+    mosaic_bboxes, x_tile_counters, y_tile_counters = count_tiles_batch(tile_bboxes, [0, len(tile_bboxes)])
+
+    return mosaic_bboxes[0].tolist(), int(x_tile_counters[0]), int(y_tile_counters[0])
+
+
+
+def count_tiles_batch(tile_bboxes, offsets) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Does the same as count_tiles for many mosaics at once.
+    The bounding boxes of the tiles of all mosaics are passed as one flat array, where the tiles of mosaic i are tile_bboxes[offsets[i]:offsets[i+1]].
+    Every mosaic needs to consist of at least one tile.
+    Returns an array of mosaic bounding boxes and two arrays of how many tiles wide and high every mosaic is.
+
+    Parameters
+    -------------
+
+    tile_bboxes: The bounding boxes of the tiles of all mosaics as rows of [minx, miny, maxx, maxy].
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    offsets: The position of the first tile of every mosaic in tile_bboxes, followed by the total number of tiles.
+    type: np.ndarray
+    values: Increasing integers starting at 0.
+    default: No default value.
+
+    Example
+    -------------
+
+    import count_tiles_batch from utils
+    my_mosaic_bboxes, widths, heights = count_tiles_batch(my_tile_bboxes, my_offsets)
+
+    """
+
+    tile_bboxes = np.asarray(tile_bboxes, dtype=float).reshape(-1, 4)
+    offsets = np.asarray(offsets, dtype=int)
+    starts = offsets[:-1]
+    mosaic_ids = np.repeat(np.arange(len(starts)), np.diff(offsets))
+
+    mosaic_bboxes = np.stack([
+        np.minimum.reduceat(tile_bboxes[:, 0], starts),
+        np.minimum.reduceat(tile_bboxes[:, 1], starts),
+        np.maximum.reduceat(tile_bboxes[:, 2], starts),
+        np.maximum.reduceat(tile_bboxes[:, 3], starts),
+    ], axis=1)
+
+    #a mosaic is as many tiles wide and high as it has distinct tile columns and rows
+    x_tile_counters = _count_distinct(mosaic_ids, tile_bboxes[:, 0], len(starts))
+    y_tile_counters = _count_distinct(mosaic_ids, tile_bboxes[:, 1], len(starts))
+
+    return mosaic_bboxes, x_tile_counters, y_tile_counters
+
+
+def _count_distinct(groups:np.ndarray, values:np.ndarray, n_groups:int) -> np.ndarray:
+    #rounding, so tile borders which only differ by floating point errors are counted once
+    pairs = np.unique(np.stack([groups, np.round(values, 9)], axis=1), axis=0)
+    return np.bincount(pairs[:, 0].astype(int), minlength=n_groups)
 
 
 def global_to_local_coords(poly:shapely.geometry.polygon.Polygon, tile_bboxes:list, is_bbox:bool=False) -> np.ndarray:
@@ -126,37 +182,142 @@ def global_to_local_coords(poly:shapely.geometry.polygon.Polygon, tile_bboxes:li
     """
 
     mosaic_bbox, x_tile_counter, y_tile_counter = count_tiles(tile_bboxes)
+    x, y, _ = global_to_local_coords_batch(np.array([poly]), [mosaic_bbox], [x_tile_counter], [y_tile_counter], is_bbox)
 
-    tile_size_x = (mosaic_bbox[2] - mosaic_bbox[0])
-    tile_size_y = (mosaic_bbox[3] - mosaic_bbox[1])
-    poly = np.array(poly.exterior.coords)
+    return x, y
 
-    #moving from a global coordinate system to the tile/mosaic coordinate system
-    for i in range(len(poly)):
-        #removing the offset and rescaling it according to the number of tiles forming the mosaic
-        #and upscaling it to the next greatest multiple of 512 is its a bbox
-        poly[i][0] -= mosaic_bbox[0]
-        poly[i][0] = np.round((poly[i][0]/tile_size_x) * 4096 * x_tile_counter)
 
-        poly[i][1] -= mosaic_bbox[1]
-        poly[i][1] = np.round((poly[i][1]/tile_size_y) * 4096 * y_tile_counter)
+
+def global_to_local_coords_batch(polys, mosaic_bboxes, x_tile_counters, y_tile_counters, is_bbox:bool=False) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Does the same as global_to_local_coords for many polygons at once, each on its own tile/mosaic.
+    Returns flat arrays of the x and y coordinates of all polygons, and offsets so the coordinates of polygon i are x[offsets[i]:offsets[i+1]].
+    The mosaics can be calculated using count_tiles_batch.
+
+    Parameters
+    -------------
+
+    polys: An array of shapely polygons of either mines or their bounding boxes.
+    type: np.ndarray or geopandas.array.GeometryArray
+    values: Any.
+    default: No default value.
+
+    mosaic_bboxes: The bounding box of the tile/mosaic of every polygon as rows of [minx, miny, maxx, maxy].
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    x_tile_counters: How many tiles wide the tile/mosaic of every polygon is.
+    type: np.ndarray
+    values: Positive integers.
+    default: No default value.
+
+    y_tile_counters: How many tiles high the tile/mosaic of every polygon is.
+    type: np.ndarray
+    values: Positive integers.
+    default: No default value.
+
+    is_bbox: States if polys are mines or bounding boxes of mines.
+    type: bool
+    values: Any.
+    default: False
+
+    Example
+    -------------
+
+    import count_tiles_batch, global_to_local_coords_batch from utils
+    my_mosaic_bboxes, widths, heights = count_tiles_batch(my_tile_bboxes, my_tile_offsets)
+    x, y, offsets = global_to_local_coords_batch(gdf['geometry'].values, my_mosaic_bboxes, widths, heights)
+
+    """
+
+    polys = np.asarray(polys)
+    mosaic_bboxes = np.asarray(mosaic_bboxes, dtype=float).reshape(-1, 4)
+    x_tile_counters = np.asarray(x_tile_counters)
+    y_tile_counters = np.asarray(y_tile_counters)
+
+    coords, poly_ids = shapely.get_coordinates(shapely.get_exterior_ring(polys), return_index=True)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(poly_ids, minlength=len(polys)))])
+
+    #every coordinate gets the mosaic of its polygon
+    mosaic = mosaic_bboxes[poly_ids]
+    tile_size_x = (mosaic[:, 2] - mosaic[:, 0])
+    tile_size_y = (mosaic[:, 3] - mosaic[:, 1])
+    x_tiles = x_tile_counters[poly_ids]
+    y_tiles = y_tile_counters[poly_ids]
+
+    #moving from a global coordinate system to the tile/mosaic coordinate system
+    #removing the offset and rescaling it according to the number of tiles forming the mosaic
+    x = np.round(((coords[:, 0] - mosaic[:, 0])/tile_size_x) * 4096 * x_tiles)
+    y = np.round(((coords[:, 1] - mosaic[:, 1])/tile_size_y) * 4096 * y_tiles)
 
     #y coordinates count from top to bottom
-    for i in range(len(poly)):
-        poly[i][1] = 4096 * y_tile_counter - poly[i][1]
+    y = 4096 * y_tiles - y
 
     #bbox sizes need to be a multiple of 512, so they can be scaled down to 512x512 if needed
     if is_bbox:
-        bbox_size = int(poly[1][0] - poly[3][0])
+        starts = offsets[:-1]
+        bbox_size = (x[starts+1] - x[starts+3]).astype(int)
         delta = ((bbox_size // 512) + 1) * 512 - bbox_size
 
         #adding the needed extra space
-        poly[0][0] = poly[1][0] = poly[4][0] = poly[0][0] + delta
-        poly[1][1] = poly[2][1] = poly[1][1] + delta
+        x_right = x[starts] + delta
+        x[starts] = x[starts+1] = x[starts+4] = x_right
+        y_bottom = y[starts+1] + delta
+        y[starts+1] = y[starts+2] = y_bottom
+
+    return x, y, offsets
+
+
 
-    poly_x, poly_y = zip(*poly)
+def local_to_global_bounds(x_offset:int, y_offset:int, bbox_size:int, tile_bboxes:list) -> shapely.geometry.polygon.Polygon:
+    """
+    Turns a square bounding box inside the coordinate system of the tile/mosaic back into a shapely polygon in the global coordinate system.
+    This is the inverse of global_to_local_coords, used for querying which polygons are located inside a bounding box.
+
+    Parameters
+    -------------
+
+    x_offset: The x axis offset of this bounding box in the tile/mosaic coordinate system.
+    type: int
+    values: Any.
+    default: No default value.
 
-    return np.array(poly_x), np.array(poly_y)
+    y_offset: The y axis offset of this bounding box in the tile/mosaic coordinate system.
+    type: int
+    values: Any.
+    default: No default value.
+
+    bbox_size: The sidelength of this square bounding box.
+    type: int
+    values: Any.
+    default: No default value.
+
+    tile_bboxes: A list of bounding boxes of the individual tiles forming the tile/mosaic.
+    type: list
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    import local_to_global_bounds from utils
+    my_global_bbox = local_to_global_bounds(my_bbox_x_offset, my_bbox_y_offset, my_bbox_size, my_tile_bboxes)
+
+    """
+
+    mosaic_bbox, x_tile_counter, y_tile_counter = count_tiles(tile_bboxes)
+
+    x_scaling_factor = (mosaic_bbox[2] - mosaic_bbox[0]) / (4096 * x_tile_counter)
+    y_scaling_factor = (mosaic_bbox[3] - mosaic_bbox[1]) / (4096 * y_tile_counter)
+
+    #y coordinates count from top to bottom
+    minx = mosaic_bbox[0] + x_offset * x_scaling_factor
+    maxx = mosaic_bbox[0] + (x_offset + bbox_size) * x_scaling_factor
+    miny = mosaic_bbox[3] - (y_offset + bbox_size) * y_scaling_factor
+    maxy = mosaic_bbox[3] - y_offset * y_scaling_factor
+
+    return shapely.box(minx, miny, maxx, maxy)
 
 
 
@@ -201,16 +362,53 @@ def check_if_inside_bbox(x:list, y:list, x_offset:int, y_offset:int, bbox_size:i
 
     """
 
-    poly_positions = []
+    return check_if_inside_bbox_batch(np.asarray(x), np.asarray(y), x_offset, y_offset, bbox_size).tolist()
+
 
-    for x_poly, y_poly in zip(x, y):
-        #checking if point is inside bbox
-        if (x_poly >= x_offset) and (x_poly <= x_offset+bbox_size) and (y_poly >= y_offset) and (y_poly <= y_offset+bbox_size):
-            poly_positions.append(True)
-        else:
-            poly_positions.append(False)
 
-    return poly_positions
+def check_if_inside_bbox_batch(x:np.ndarray, y:np.ndarray, x_offsets, y_offsets, bbox_sizes) -> np.ndarray:
+    """
+    Does the same as check_if_inside_bbox for the points of many polygons at once, e.g. as returned by global_to_local_coords_batch.
+    The bounding box offsets and sizes can either be single values or arrays with a value per point.
+    Returns a boolean array.
+
+    Parameters
+    -------------
+
+    x: An array of x coordinates.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    y: An array of y coordinates.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    x_offsets: The x axis offsets of the bounding boxes in the same coordinate system as the x and y coordinates.
+    type: int or np.ndarray
+    values: Any.
+    default: No default value.
+
+    y_offsets: The y axis offsets of the bounding boxes in the same coordinate system as the x and y coordinates.
+    type: int or np.ndarray
+    values: Any.
+    default: No default value.
+
+    bbox_sizes: The sidelengths of these square bounding boxes.
+    type: int or np.ndarray
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    import check_if_inside_bbox_batch from utils
+    positions = check_if_inside_bbox_batch(x, y, np.repeat(my_x_offsets, np.diff(offsets)), np.repeat(my_y_offsets, np.diff(offsets)), 512)
+
+    """
+
+    return (x >= x_offsets) & (x <= x_offsets+bbox_sizes) & (y >= y_offsets) & (y <= y_offsets+bbox_sizes)
 
 
 
@@ -252,21 +450,50 @@ def replace_at_bbox_borders(x:list, y:list, bbox_size:int, poly_positions:list)
 
     """
     
-    new_x = x.copy()
-    new_y = y.copy()
-
-    for i in range(len(poly_positions)):
-        #only takes poly points which are outside the bbox
-        if not poly_positions[i]:
-            if new_x[i] < 0:
-                new_x[i] = 0
-            elif new_x[i] > bbox_size:
-                new_x[i] = bbox_size
-
-            if new_y[i] < 0:
-                new_y[i] = 0
-            elif new_y[i] > bbox_size:
-                new_y[i] = bbox_size
+    return replace_at_bbox_borders_batch(np.asarray(x), np.asarray(y), bbox_size, np.asarray(poly_positions, dtype=bool))
+
+
+
+def replace_at_bbox_borders_batch(x:np.ndarray, y:np.ndarray, bbox_sizes, poly_positions:np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Does the same as replace_at_bbox_borders for the points of many polygons at once.
+    The bounding box sizes can either be a single value or an array with a value per point.
+
+    Parameters
+    -------------
+
+    x: An array of x coordinates relative to the bounding box offsets.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    y: An array of y coordinates relative to the bounding box offsets.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    bbox_sizes: The sidelengths of the square bounding boxes.
+    type: int or np.ndarray
+    values: Any.
+    default: No default value.
+
+    poly_positions: A boolean array specifying if the points are inside the bounding boxes.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    Example
+    -------------
+
+    import check_if_inside_bbox_batch, replace_at_bbox_borders_batch from utils
+    positions = check_if_inside_bbox_batch(x, y, x_offsets, y_offsets, bbox_sizes)
+    new_x, new_y = replace_at_bbox_borders_batch(x - x_offsets, y - y_offsets, bbox_sizes, positions)
+
+    """
+
+    #only takes poly points which are outside the bbox
+    new_x = np.where(poly_positions, x, np.clip(x, 0, bbox_sizes))
+    new_y = np.where(poly_positions, y, np.clip(y, 0, bbox_sizes))
 
     return new_x, new_y
 
@@ -359,4 +586,115 @@ def close_holes(poly: shapely.Polygon) -> shapely.Polygon:
     if poly.interiors:
         return shapely.Polygon(list(poly.exterior.coords))
     else:
-        return poly
\ No newline at end of file
+        return poly
+
+
+def vectorize_prediction(pred_logits:np.ndarray, job, threshold:float, margins:tuple=None) -> list:
+    """
+    Turns the logits of a chip predicted by the segmentation model into polygons in the global coordinate system.
+    The logits are thresholded and postprocessed, their contours are simplified, and moved from the chip to the bbox of the job on its tile mosaic.
+    Used on the predictions of the segmentation model.
+
+    Parameters
+    -------------
+
+    pred_logits: The logits of the mining class as returned by the segmentation model, in the same orientation as the image chip.
+    type: np.ndarray
+    values: Any.
+    default: No default value.
+
+    job: The job the chip was saved from.
+    type: jobs.ChipJob
+    values: Any.
+    default: No default value.
+
+    threshold: The probability threshold for the predictions.
+    type: float
+    values: 0 to 1.
+    default: No default value.
+
+    margins: The part of the chip which is used as (left, top, right, bottom) in pixels, or None for the whole chip.
+    type: tuple
+    values: Any, e.g. as returned by jobs.window_margins.
+    default: None
+
+    Example
+    -------------
+
+    import vectorize_prediction from utils
+    polygons = vectorize_prediction(pred_logits, jobs[job_positions[id]], 0.5)
+
+    """
+
+    #predictions need to be passed back to the cpu for further processing
+    pred_logits = pred_logits.T
+    # transforming the logits into probabilities using the sigmoid function
+    pred = 1 / (1 + np.exp(-pred_logits))
+    # applying the threshold to the predictions
+    pred = np.where(pred >= threshold, 1, 0)
+    pred = postprocess(pred)
+
+    if margins is not None:
+        left, top, right, bottom = margins
+        inner = np.zeros_like(pred)
+        inner[top:bottom, left:right] = pred[top:bottom, left:right]
+        pred = inner
+
+    # using findContours for processing the segmentation predictions into polygon coordinates
+    borders, _ = cv2.findContours(pred.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    multipoly = []
+    for border in borders:
+        #skipping polygons with less than 3 edges
+        if border.shape[0] >= 3:
+            border = np.reshape(border, (border.shape[0], 2))
+            multipoly.append(shapely.Polygon(border))
+
+    x_poly = []
+    y_poly = []
+
+    # offset of the polygons inside the bounding box
+    x_offset = job.x_offset
+    y_offset = job.y_offset
+    bbox_scaling_factor = job.bbox_size / 512
+
+    # the bbox and shape of the tile mosaic
+    mosaic_bbox, x_tile_counter, y_tile_counter = job.mosaic_bbox, job.x_tiles, job.y_tiles
+
+    for poly in multipoly:
+        # simplifying the polygons for data reduction
+        poly_simple = poly.simplify(1, preserve_topology=False)
+        # in some cases, a polygon may be split up into a multiple polygons making up a multipolygon wenn calling simplify
+        if type(poly_simple) == shapely.geometry.multipolygon.MultiPolygon:
+            for geom in poly_simple.geoms:
+                # getting the polygon coordinates inside the bbox coordinate system
+                # and adding the bbox offset
+                x,y = geom.exterior.xy
+                x = [(x_i * bbox_scaling_factor) + x_offset for x_i in x]
+                y = [(y_i * bbox_scaling_factor) + y_offset for y_i in y]
+                x_poly.append(x)
+                y_poly.append(y)
+        # processing polygons which have not been split up
+        else:
+            # getting the polygon coordinates inside the bbox coordinate system
+            # and adding the bbox offset
+            x,y = poly_simple.exterior.xy
+            x = [(x_i * bbox_scaling_factor) + x_offset for x_i in x]
+            y = [(y_i * bbox_scaling_factor) + y_offset for y_i in y]
+            x_poly.append(x)
+            y_poly.append(y)
+
+    # factor for scaling from the bbox coordinate system to the global coordinate system
+    x_scaling_factor = (mosaic_bbox[0] - mosaic_bbox[2]) / (4096 * x_tile_counter)
+    y_scaling_factor = (mosaic_bbox[1] - mosaic_bbox[3]) / (4096 * y_tile_counter)
+    # prediction usually returns multiple polygons which will be merged into a multipolygon
+    multipoly = []
+
+    # processing the polygon coordinates into actual polygons
+    for x,y in zip(x_poly, y_poly):
+        x = [mosaic_bbox[0] - (x_i * x_scaling_factor) for x_i in x]
+        y = [4096 * y_tile_counter - y_i for y_i in y]
+        y = [mosaic_bbox[1] - (y_i * y_scaling_factor) for y_i in y]
+        poly = shapely.Polygon(list(zip(x, y)))
+        multipoly.append(poly)
+
+    return multipoly